@@ -53,6 +53,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = (
     'django_prometheus.middleware.PrometheusBeforeMiddleware',
     'log_request_id.middleware.RequestIDMiddleware',
+    'qabel_provider.middleware.QueryMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -212,6 +213,48 @@ MENU = (
 
 # No trailing slash please
 BLOCK_URL = 'https://block.qabel.org'
+# Connect and read timeouts (in seconds) of requests to the block server
+BLOCK_TIMEOUT = (3.05, 10)
+# Retries of requests to the block server which failed to connect or were answered with 502, 503 or 504
+BLOCK_RETRIES = 2
 OUTGOING_REQUEST_ID_HEADER = 'X-Request-ID'
 
 FACET_USER_PROFILE = False
+
+# Maximum time (in seconds) an answer of the auth resource for the block server is cached
+AUTH_CACHE_TIMEOUT = 300
+
+# Database alias the auth resource reads from. This may be a read replica (add it to DATABASES then);
+# writes always go to the default database.
+AUTH_READ_DATABASE = 'default'
+
+# Maximum lifetime (in seconds) of the signed auth tickets issued to the block server
+AUTH_TICKET_LIFETIME = 60
+# Answers that change sooner (in seconds) are returned without a ticket
+AUTH_TICKET_MIN_LIFETIME = 5
+
+# Days the changes of the change feed are kept, see qabel_provider.changes
+CHANGE_FEED_RETENTION = 7
+
+# Directory for the compressed JSONL files of archived plan log months, see qabel_provider.plan_log_archive
+PLAN_LOG_ARCHIVE_DIR = env('PLAN_LOG_ARCHIVE_DIR', default=str(ROOT_DIR.path('plan-log-archive')))
+
+# Session based, so that messages can still be added after a streaming response was sent (see qabel_provider.admin)
+MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
+
+# Directory for the files of background exports, see qabel_provider.export_jobs
+EXPORT_JOB_DIR = env('EXPORT_JOB_DIR', default=str(ROOT_DIR.path('export-jobs')))
+
+# User selections larger than this are exported in the background by the run_export_jobs command
+ADMIN_EXPORT_BACKGROUND_THRESHOLD = 10000
+# Running export jobs without progress for this many seconds are considered abandoned and run again
+EXPORT_JOB_STALE_AFTER = 10 * 60
+
+# Maximum age (in seconds) of the business metrics served to Prometheus before they are refreshed, see
+# qabel_provider.monitoring
+METRICS_REFRESH_INTERVAL = 60
+
+# Record the number of SQL queries and the database time per view, see qabel_provider.middleware
+QUERY_METRICS = env.bool('QUERY_METRICS', default=False)
+# Requests making more queries than this are logged as warnings (if QUERY_METRICS is enabled)
+QUERY_BUDGET = 50
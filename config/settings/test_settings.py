@@ -7,3 +7,8 @@ AUTH_PASSWORD_VALIDATORS = [
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
     },
 ]
+
+# A second database, for tests reading from a replica (see AUTH_READ_DATABASE). It is not a mirror of default.
+DATABASES['replica'] = dict(DATABASES['default'])
+if 'sqlite' not in DATABASES['replica']['ENGINE']:
+    DATABASES['replica']['TEST'] = {'NAME': 'test_%s_replica' % DATABASES['replica']['NAME']}
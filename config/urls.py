@@ -30,7 +30,6 @@ from rest_auth.registration.views import VerifyEmailView
 from rest_auth.registration import urls as registration_urls
 from allauth.account.views import ConfirmEmailView, EmailVerificationSentView
 import nested_admin.urls
-import django_prometheus.urls
 
 from qabel_web_theme import urls as theme_urls
 from dispatch_service.views import dispatch
@@ -61,7 +60,11 @@ rest_urls = [
     url(r'^auth/', include(rest_auth_urls)),
     url(r'^auth/registration/', include(registration_urls)),
     url(r'^internal/user/$', views.auth_resource, name='api-auth'),
+    url(r'^internal/user/batch/$', views.auth_resource_batch, name='api-auth-batch'),
+    url(r'^internal/user/ticket/$', views.auth_ticket, name='api-auth-ticket'),
     url(r'^internal/user/register/$', views.register_on_behalf),
+    url(r'^internal/changes/$', views.auth_changes, name='api-auth-changes'),
+    url(r'^internal/plan-log/$', views.plan_log, name='api-plan-log-export'),
 
     url(r'^plan/subscription/$', views.plan_subscription),
     url(r'^plan/add-interval/$', views.plan_add_interval),
@@ -99,7 +102,7 @@ urlpatterns = [
     url(r'^accounts/', include(auth_urls)),
     url(r'^api/v0/', include(rest_urls)),
     url('', include(profile_urls)),
-    url('', include(django_prometheus.urls)),
+    url(r'^metrics$', views.metrics, name='prometheus-django-metrics'),
     url(r'^account-confirm-email/(?P<key>[-:\w]+)/$', ConfirmEmailView.as_view(),
         name='account_confirm_email'),
     url(r'^account-email-verification-sent/$', EmailVerificationSentView.as_view(),
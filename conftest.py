@@ -56,6 +56,13 @@ def token(user):
     return Token.objects.create(user=user).key
 
 
+@pytest.fixture
+def send_queued_mail(db):
+    """Send the mails queued in the outbox (into django.core.mail.outbox)."""
+    from qabel_provider.outbox import send_queued
+    return send_queued
+
+
 @pytest.fixture
 def api_client():
     return APIClient()
@@ -11,6 +11,11 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
+from qabel_provider import prometheus_multiprocess
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "qabel_id.settings")
 
+# Before Django imports prometheus_client
+prometheus_multiprocess.setup()
+
 application = get_wsgi_application()
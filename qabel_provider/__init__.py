@@ -0,0 +1 @@
+default_app_config = 'qabel_provider.apps.QabelProviderConfig'
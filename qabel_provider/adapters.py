@@ -1,8 +1,11 @@
 from allauth.account.adapter import DefaultAccountAdapter
 
+from .outbox import enqueue
+
 
 class IgnoreInvalidMailsAdapter(DefaultAccountAdapter):
 
     def send_mail(self, template_prefix, email, context):
+        # Sending (and failing to send to invalid addresses) happens in the background, see outbox.py.
         msg = self.render_mail(template_prefix, email, context)
-        msg.send(fail_silently=True)
+        enqueue(msg)
@@ -1,41 +1,183 @@
 import csv
+import json
 
-from django.contrib import admin
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
 from django.contrib.auth.admin import UserAdmin as OriginalUserAdmin
 from django.contrib.auth.models import User
-from django.http import HttpResponse
+from django.contrib.messages.storage.session import SessionStorage
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.http import FileResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
 from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from django.utils.text import capfirst, smart_split, unescape_string_literal
 from django.utils.translation import ugettext_lazy as _
 
 from allauth.account.models import EmailAddress
 
 import nested_admin
+from nested_admin.formsets import NestedInlineFormSetMixin
+
+from . import export_jobs, plan_log_export
+from .models import Profile, Plan, PlanInterval, ProfilePlanLog, ExportJob
+
+
+class Echo:
+    """File-like object returning what is written, to stream the output of csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def add_message_after_response(request, level, message):
+    """
+    Add *message* for the next page, after the response for *request* was sent (e.g. at the end of a stream).
+
+    The response can't carry a message cookie anymore then, so the message is stored in the session.
+    """
+    storage = SessionStorage(request)
+    storage.add(level, message)
+    storage.update(None)
+    request.session.save()
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using the estimates of the PostgreSQL planner instead of exact counts for large querysets.
+
+    Unfiltered querysets use the row estimate of the table (pg_class.reltuples), filtered ones the estimate of the
+    query plan. Estimates below EXACT_COUNT_LIMIT are replaced by exact counts, which are cheap then.
+    """
+    EXACT_COUNT_LIMIT = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return super().count
+        with connection.cursor() as cursor:
+            if not queryset.query.where:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+                estimate = cursor.fetchone()[0]
+            else:
+                sql, params = queryset.query.sql_with_params()
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                estimate = plan[0]['Plan']['Plan Rows']
+        # Tables that were never analyzed have no estimate (-1).
+        if estimate < self.EXACT_COUNT_LIMIT:
+            return super().count
+        return int(estimate)
 
-from .models import Profile, Plan, PlanInterval, ProfilePlanLog
 
 admin.site.site_title = _('Accounting')
 admin.site.site_header = _('Qabel Account Management')
 admin.site.index_title = _('Qabel Account Management')
 
 
-class PlanIntervalInline(nested_admin.NestedTabularInline):
+class CappedInlineFormSet(nested_admin.NestedInlineFormSet):
+    """
+    Shows only the first *limit* objects of the queryset (set by CappedInlineMixin.get_formset). Bound formsets only
+    load the objects whose forms were submitted.
+    """
+    limit = None
+
+    def get_queryset(self):
+        if not hasattr(self, '_capped_queryset'):
+            if self.is_bound:
+                # nested_admin narrows bound formsets to the submitted PKs too, but on all objects of the model rather
+                # than those of the parent object, and fails on malformed PKs.
+                queryset = super(NestedInlineFormSetMixin, self).get_queryset().filter(pk__in=self.submitted_pks())
+            else:
+                queryset = super().get_queryset()
+                if self.limit is not None:
+                    queryset = queryset[:self.limit]
+            self._capped_queryset = queryset
+        return self._capped_queryset
+
+    def submitted_pks(self):
+        pk_field = self.model._meta.pk
+        pks = []
+        for i in range(self.initial_form_count()):
+            try:
+                pks.append(pk_field.to_python(self.data.get('%s-%s' % (self.add_prefix(i), pk_field.name))))
+            except ValidationError:
+                # Like BaseModelFormSet._construct_form, which treats the form as a new object then.
+                pass
+        return [pk for pk in pks if pk is not None]
+
+
+class CappedInlineMixin:
+    """
+    Shows only the latest *per_page* objects of a (nested) inline, with a link in the title to show *per_page* more.
+
+    The number of shown objects is passed in the query string (the *shown_parameter*), so it is kept when saving.
+    """
+    formset = CappedInlineFormSet
+    per_page = 20
+
+    @property
+    def shown_parameter(self):
+        return '%s_shown' % self.model._meta.model_name
+
+    def get_formset(self, request, obj=None, **kwargs):
+        try:
+            shown = max(self.per_page, int(request.GET.get(self.shown_parameter, self.per_page)))
+        except ValueError:
+            shown = self.per_page
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.limit = shown
+        if obj is not None:
+            total = self.get_queryset(request).filter(**{formset.fk.name: obj}).count()
+            self.title = self.capped_title(request, shown, total)
+        return formset
+
+    def capped_title(self, request, shown, total):
+        title = capfirst(self.verbose_name_plural)
+        if total <= shown:
+            return title
+        query = request.GET.copy()
+        query[self.shown_parameter] = shown + self.per_page
+        return format_html('{} ({}) <a href="?{}">{}</a>', title,
+                           _('admin inline latest {shown} of {total}').format(shown=shown, total=total),
+                           query.urlencode(), _('admin inline show more'))
+
+
+class PlanIntervalInline(CappedInlineMixin, nested_admin.NestedTabularInline):
     model = PlanInterval
     can_delete = False
     extra = 1
+    ordering = ('-id',)
+    autocomplete_fields = ('plan',)
 
     fields = (
         'plan', 'duration', 'state', 'started_at',
     )
 
 
-class ProfilePlanLogInline(nested_admin.NestedTabularInline):
+class ProfilePlanLogInline(CappedInlineMixin, nested_admin.NestedTabularInline):
     model = ProfilePlanLog
     extra = 0
     can_delete = False
+    ordering = ('-timestamp', '-id')
 
     def has_add_permission(self, request):
         return False
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('plan', 'interval')
+
     fields = (
         'timestamp', 'action', 'plan', 'interval',
     )
@@ -47,6 +189,7 @@ class UserProfileInline(nested_admin.NestedStackedInline):
     inlines = [PlanIntervalInline, ProfilePlanLogInline]
     model = Profile
     can_delete = False
+    autocomplete_fields = ('subscribed_plan',)
 
     fields = (
         'plus_notification_mail', 'pro_notification_mail',
@@ -62,29 +205,182 @@ class UserAdmin(OriginalUserAdmin, nested_admin.NestedModelAdmin):
          'profile__subscribed_plan',
          'profile__next_confirmation_mail', 'profile__needs_confirmation_after',)
 
-    actions = ('export_user_data',)
+    list_display = OriginalUserAdmin.list_display + ('subscribed_plan',)
+    # Keep the changelist fast with millions of users: estimated counts, no second count of all users, and no
+    # query per row for the plan.
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_select_related = ('profile', 'profile__subscribed_plan')
+
+    actions = ('export_user_data', 'export_user_data_extended')
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Return the users matching every word of *search_term* in one of the search_fields or any of their email
+        addresses (including secondary ones).
+
+        The matching user IDs of each word are the union of two icontains searches, one per table, so that each can
+        use the trigram indexes of migration 0026 on PostgreSQL.
+        """
+        for term in smart_split(search_term):
+            if term.startswith(('"', "'")) and term[0] == term[-1]:
+                term = unescape_string_literal(term)
+            user_matches = Q()
+            for field in self.search_fields:
+                user_matches |= Q(**{field + '__icontains': term})
+            matching_ids = (User.objects.filter(user_matches).values('pk')
+                            .union(EmailAddress.objects.filter(email__icontains=term).values('user_id')))
+            queryset = queryset.filter(pk__in=matching_ids)
+        return queryset, False
+
+    def subscribed_plan(self, obj):
+        return obj.profile.subscribed_plan
+    subscribed_plan.short_description = 'plan'
+    subscribed_plan.admin_order_field = 'profile__subscribed_plan'
 
     def export_user_data(self, request, queryset):
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename=Qabel-User-Data-%s.csv' % timezone.now().replace(microsecond=0).isoformat()
+        return self._export(request, queryset, 'users')
+    export_user_data.short_description = _('admin user action export data label')
+
+    def export_user_data_extended(self, request, queryset):
+        return self._export(request, queryset, 'users-extended')
+    export_user_data_extended.short_description = _('admin user action export extended data label')
+
+    def _export(self, request, queryset, kind):
+        """
+        Stream a *kind* export (see export_jobs.USER_EXPORTS) of the users in *queryset* as CSV.
+
+        The numbers of written and skipped users are only known at the end; they are added as a message for the
+        next admin page then. Large selections are exported in the background instead.
+        """
+        if queryset.count() > settings.ADMIN_EXPORT_BACKGROUND_THRESHOLD:
+            # Only the selection is stored, the worker lists the users again (see export_jobs.queue_user_export).
+            if forms.BooleanField(required=False).clean(request.POST.get('select_across')):
+                job = export_jobs.queue_user_export(kind, changelist=request.GET.urlencode(), created_by=request.user)
+            else:
+                job = export_jobs.queue_user_export(kind, user_ids=request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+                                                    created_by=request.user)
+            url = reverse('admin:qabel_provider_exportjob_change', args=[job.pk])
+            self.message_user(request, format_html(_('admin user data export queued {link}'),
+                                                   link=format_html('<a href="{}">{}</a>', url, job)))
+            return None
 
-        csv_writer = csv.writer(response)
-        csv_writer.writerow(['username', 'email'])
-
-        emails = EmailAddress.objects.filter(user__in=queryset, primary=True, verified=True).select_related('user')
-        written_rows = emails.count()
-        failed_no_address = queryset.count() - written_rows
-        csv_writer.writerows((email.user.username, email.email) for email in emails)
-        self.message_user(request, _('admin user data export {written_rows} {failed_no_address}').format(
-            written_rows=written_rows,
-            failed_no_address=failed_no_address,
-        ))
+        def stream():
+            csv_writer = csv.writer(Echo())
+            yield csv_writer.writerow(export_jobs.user_header(kind))
+            written_rows = failed_no_address = 0
+            for row in export_jobs.user_rows(queryset, kind):
+                if row is None:
+                    failed_no_address += 1
+                    continue
+                written_rows += 1
+                yield csv_writer.writerow(row)
+            add_message_after_response(request, messages.INFO, _(
+                'admin user data export {written_rows} {failed_no_address}').format(
+                written_rows=written_rows,
+                failed_no_address=failed_no_address,
+            ))
+
+        response = StreamingHttpResponse(stream(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=Qabel-User-Data-%s.csv' % timezone.now().replace(microsecond=0).isoformat()
         return response
-    export_user_data.short_description = _('admin user action export data label')
+
+
+class PlanLogExportJobForm(forms.ModelForm):
+    """Queues a plan log export; user exports are queued by the export actions of the user admin."""
+    since = forms.DateTimeField(required=False)
+    until = forms.DateTimeField(required=False)
+    plan = forms.ModelChoiceField(Plan.objects.all(), required=False)
+    action = forms.ChoiceField(choices=[('', '---------')] + [(action, action) for action in plan_log_export.ACTIONS],
+                               required=False)
+    output = forms.ChoiceField(choices=[(output, output) for output in plan_log_export.FORMATS])
+
+    class Meta:
+        model = ExportJob
+        fields = ()
+
+    def save(self, commit=True):
+        data = self.cleaned_data
+        self.instance.kind = 'plan-log'
+        self.instance.parameters = json.dumps({
+            'since': data['since'] and data['since'].isoformat(),
+            'until': data['until'] and data['until'].isoformat(),
+            'plan': data['plan'] and data['plan'].pk,
+            'action': data['action'],
+            'output': data['output'],
+        })
+        return super().save(commit)
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    model = ExportJob
+    add_form = PlanLogExportJobForm
+    list_display = ('id', 'kind', 'created_by', 'created_at', 'state', 'progress_display', 'download_link')
+    list_filter = ('kind', 'state')
+    fields = ('kind', 'created_by', 'created_at', 'parameters', 'state', 'started_at', 'finished_at',
+              'total', 'processed', 'written', 'progress_display', 'download_link', 'error')
+    readonly_fields = fields
+
+    def get_form(self, request, obj=None, **kwargs):
+        if obj is None:
+            kwargs['form'] = self.add_form
+        return super().get_form(request, obj, **kwargs)
+
+    def get_fields(self, request, obj=None):
+        if obj is None:
+            return ('since', 'until', 'plan', 'action', 'output')
+        return self.fields
+
+    def get_readonly_fields(self, request, obj=None):
+        return () if obj is None else self.readonly_fields
+
+    def has_change_permission(self, request, obj=None):
+        # Jobs can only be viewed once queued.
+        return False
+
+    def save_model(self, request, obj, form, change):
+        obj.created_by = request.user
+        super().save_model(request, obj, form, change)
+
+    def delete_model(self, request, obj):
+        export_jobs.remove_file(obj)
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        for job in queryset:
+            export_jobs.remove_file(job)
+        super().delete_queryset(request, queryset)
+
+    def progress_display(self, obj):
+        if obj.progress is None:
+            return '-'
+        return '%d %%' % obj.progress
+    progress_display.short_description = 'progress'
+
+    def download_link(self, obj):
+        if obj.state != 'done':
+            return '-'
+        return format_html('<a href="{}">{}</a>', reverse('admin:qabel_provider_exportjob_download', args=[obj.pk]),
+                           obj.file_name)
+    download_link.short_description = 'file'
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/', self.admin_site.admin_view(self.download),
+                 name='qabel_provider_exportjob_download'),
+        ] + super().get_urls()
+
+    def download(self, request, pk):
+        job = get_object_or_404(ExportJob, pk=pk, state='done')
+        if not self.has_view_permission(request, job):
+            raise PermissionDenied
+        return FileResponse(open(export_jobs.path(job), 'rb'), as_attachment=True, filename=job.file_name)
 
 
 class PlanAdmin(admin.ModelAdmin):
     model = Plan
+    # For the autocomplete of the plans in the user admin
+    search_fields = ('id', 'name')
 
     fields = (
         'id', 'name', 'block_quota', 'monthly_traffic_quota',
@@ -96,3 +392,4 @@ try:
 finally:
     admin.site.register(User, UserAdmin)
 admin.site.register(Plan, PlanAdmin)
+admin.site.register(ExportJob, ExportJobAdmin)
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class QabelProviderConfig(AppConfig):
+    name = 'qabel_provider'
+    verbose_name = 'Qabel accounting'
+
+    def ready(self):
+        # Connect the signal handlers for cache invalidation and the change feed.
+        from . import auth_cache, changes, history  # noqa: F401
@@ -0,0 +1,189 @@
+"""
+Cache for the answers of the auth resource (see views.auth_resource).
+
+Entries are stored per token and per user ID in the default cache (Redis). They are invalidated by the signal
+handlers below whenever a model that influences an answer changes. Changing a plan bumps the version of that plan,
+which invalidates the entries of all subscribers at once. Each plan has its own version key, which is incremented
+atomically (cache.incr), so that concurrent bumps can't get lost.
+"""
+
+import logging
+import random
+from collections import defaultdict
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .models import Plan, PlanInterval, Profile
+
+logger = logging.getLogger(__name__)
+
+
+def token_key(token):
+    return 'auth-token-%s' % token
+
+
+def user_key(user_id):
+    return 'auth-user-%d' % user_id
+
+
+def plan_version_key(plan_id):
+    return 'auth-plan-version-%s' % plan_id
+
+
+def plan_versions(plan_ids, create=False):
+    """Return a dict mapping *plan_ids* to their current versions. Missing versions are left out, or *create*d."""
+    keys = {plan_version_key(plan_id): plan_id for plan_id in plan_ids}
+    versions = {keys[key]: version for key, version in cache.get_many(list(keys)).items()}
+    if create:
+        for plan_id in set(plan_ids) - set(versions):
+            initialize_plan_version(plan_id)
+        versions.update(plan_versions(set(plan_ids) - set(versions)))
+    return versions
+
+
+def initialize_plan_version(plan_id):
+    # Random initial versions, so that an evicted version key can never make old entries valid again.
+    return cache.add(plan_version_key(plan_id), random.getrandbits(62), None)
+
+
+def lookup(token=None, user_id=None):
+    """Return the cached answer for *token* or *user_id*, or None."""
+    if token is not None:
+        return lookup_many(tokens=[token])[0].get(token)
+    return lookup_many(user_ids=[user_id])[1].get(user_id)
+
+
+def lookup_many(tokens=(), user_ids=()):
+    """Return cached answers as two dicts, mapping *tokens* and *user_ids* to answers. Misses are left out."""
+    keys = {token_key(token): ('token', token) for token in tokens}
+    keys.update({user_key(user_id): ('user_id', user_id) for user_id in user_ids})
+    values = cache.get_many(list(keys))
+    versions = plan_versions({entry['plan'] for entry in values.values()}) if values else {}
+    answers = {'token': {}, 'user_id': {}}
+    for key, entry in values.items():
+        if versions.get(entry['plan']) != entry['plan_version']:
+            continue
+        kind, identifier = keys[key]
+        answers[kind][identifier] = entry['data']
+    return answers['token'], answers['user_id']
+
+
+def timeout_for(profile, interval=None, timeout=None):
+    """
+    Return for how many seconds (at most *timeout*, default AUTH_CACHE_TIMEOUT) an answer about *profile* stays
+    valid, or None if it should not be cached.
+
+    The answer changes without any write to the database when the plan *interval* in use expires, or when the
+    confirmation period of the profile ends.
+    """
+    now = timezone.now()
+    if timeout is None:
+        timeout = settings.AUTH_CACHE_TIMEOUT
+    deadlines = []
+    if interval:
+        deadlines.append(interval.expires_at)
+    if not profile.created_on_behalf and profile.needs_confirmation_after > now:
+        deadlines.append(profile.needs_confirmation_after)
+    for deadline in deadlines:
+        timeout = min(timeout, (deadline - now).total_seconds())
+    if timeout < 1:
+        return
+    return int(timeout)
+
+
+def store(resolved):
+    """Cache the answer of a resolver.Resolved, see store_many."""
+    store_many([resolved])
+
+
+def store_many(resolved):
+    """
+    Cache the answers of the resolver.Resolved in *resolved* under their user IDs and, if known, tokens.
+
+    Only answers for active users are cached, since inactive users trigger confirmation mails.
+    """
+    entries = defaultdict(dict)
+    for answer in resolved:
+        timeout = timeout_for(answer.profile, answer.interval)
+        if not answer.active or not timeout:
+            continue
+        entry = {
+            'data': answer.data,
+            'plan': answer.plan.id,
+        }
+        entries[timeout][user_key(answer.data['user_id'])] = entry
+        if answer.token is not None:
+            entries[timeout][token_key(answer.token)] = entry
+    if not entries:
+        return
+    versions = plan_versions({entry['plan'] for batch in entries.values() for entry in batch.values()}, create=True)
+    for timeout, batch in entries.items():
+        for entry in batch.values():
+            entry['plan_version'] = versions[entry['plan']]
+        cache.set_many(batch, timeout)
+
+
+def invalidate_user(user_id):
+    keys = [user_key(user_id)]
+    keys.extend(token_key(key) for key in Token.objects.filter(user_id=user_id).values_list('key', flat=True))
+    cache.delete_many(keys)
+
+
+def bump_plan_version(plan_id):
+    try:
+        cache.incr(plan_version_key(plan_id))
+    except ValueError:
+        # Not stored (anymore): a new random version invalidates the entries just as well, unless a concurrent
+        # store created it first.
+        if not initialize_plan_version(plan_id):
+            cache.incr(plan_version_key(plan_id))
+
+
+def on_change(invalidate, *args):
+    """
+    Invalidate now and again after the current transaction commits.
+
+    The second run removes entries which a concurrent request computed from the not yet committed state.
+    """
+    invalidate(*args)
+    transaction.on_commit(lambda: invalidate(*args))
+
+
+@receiver((post_save, post_delete), sender=Token)
+def token_changed(sender, instance, **kwargs):
+    on_change(cache.delete_many, [token_key(instance.key), user_key(instance.user_id)])
+
+
+@receiver((post_save, post_delete), sender=User)
+def user_changed(sender, instance, **kwargs):
+    on_change(invalidate_user, instance.pk)
+
+
+@receiver((post_save, post_delete), sender=EmailAddress)
+def email_address_changed(sender, instance, **kwargs):
+    on_change(invalidate_user, instance.user_id)
+
+
+@receiver((post_save, post_delete), sender=Profile)
+def profile_changed(sender, instance, **kwargs):
+    on_change(invalidate_user, instance.pk)
+
+
+@receiver((post_save, post_delete), sender=PlanInterval)
+def plan_interval_changed(sender, instance, **kwargs):
+    on_change(invalidate_user, instance.profile_id)
+
+
+@receiver((post_save, post_delete), sender=Plan)
+def plan_changed(sender, instance, **kwargs):
+    # This includes quota changes made through the PlanAdmin.
+    logger.info('Plan %r changed, invalidating cached auth answers of its subscribers', instance.pk)
+    on_change(bump_plan_version, instance.pk)
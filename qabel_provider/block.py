@@ -1,17 +1,64 @@
+"""
+Client for the API of the block server.
+
+All calls go through request(), which uses one module-level session: its connections to BLOCK_URL are kept alive
+and reused across calls, so that not every call pays for a TCP and TLS handshake. Calls have connect and read
+timeouts (BLOCK_TIMEOUT), failed connections and 502/503/504 answers to idempotent requests are retried up to
+BLOCK_RETRIES times, and latency, status codes and errors are recorded in the BLOCK_* metrics of monitoring.
+"""
+
 import logging
+import time
 
+import requests
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from log_request_id.session import Session
 
 from rest_auth.app_settings import create_token
 from rest_auth.models import TokenModel
 
+from .monitoring import BLOCK_ERRORS, BLOCK_REQUEST_SECONDS, BLOCK_RESPONSES
 
 module_logger = logging.getLogger(__name__)
 
 BASE_URL = settings.BLOCK_URL + '/api/v0/'
 
+# Connections kept open per process; uWSGI workers handle one request at a time, plus the background threads.
+POOL_SIZE = 4
+
+
+def create_session():
+    session = Session()
+    retries = Retry(total=settings.BLOCK_RETRIES, backoff_factor=0.1, status_forcelist=(502, 503, 504),
+                    raise_on_status=False)
+    session.mount(settings.BLOCK_URL, HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retries))
+    return session
+
+
+session = create_session()
+
+
+def request(method, path, **kwargs):
+    """
+    Send a request for *path* (relative to BASE_URL) to the block server and return the response.
+
+    Connection errors and timeouts are raised as requests.RequestException.
+    """
+    kwargs.setdefault('timeout', settings.BLOCK_TIMEOUT)
+    start = time.perf_counter()
+    try:
+        response = session.request(method, BASE_URL + path, **kwargs)
+    except requests.RequestException as exc:
+        BLOCK_ERRORS.labels(path, type(exc).__name__).inc()
+        raise
+    finally:
+        BLOCK_REQUEST_SECONDS.labels(path).observe(time.perf_counter() - start)
+    BLOCK_RESPONSES.labels(path, str(response.status_code)).inc()
+    return response
+
 
 def check_response(response, logger=None, ok_codes=(200,)):
     """Raise exception if *response.status_code* is not in *ok_codes*."""
@@ -30,7 +77,7 @@ def check_response(response, logger=None, ok_codes=(200,)):
 def get_block_quota_of_user(user):
     logger = module_logger.getChild('get_block_quota_of_user')
     logger.info('Retrieving quota of user %r on %r', user.username, settings.BLOCK_URL)
-    response = Session().get(BASE_URL + 'quota/', headers={
+    response = request('GET', 'quota/', headers={
         'Authorization': 'Token %s' % create_token(TokenModel, user, None),
     })
     check_response(response, logger)
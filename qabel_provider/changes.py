@@ -0,0 +1,196 @@
+"""
+Change feed of the auth resource.
+
+The signal handlers below write an AuthChange row for every change that may affect the answer of the auth resource,
+in the transaction making the change. Consumers (the block server) read them via views.auth_changes and refresh their
+copy of the affected answers. A change may be reported more than once, e.g. as 'interval-changed' and
+'start-interval'.
+
+The feed is ordered by (txid, id), where txid is the ID of the writing transaction (set by a trigger on PostgreSQL).
+Only changes of transactions older than the oldest one still running are returned, so a transaction that commits
+late can never end up behind the cursor of a consumer. Elsewhere txid is 0 and the feed is in ID order, which is
+commit order for databases that serialize writers (SQLite).
+
+The answer of the auth resource also changes without any write when the confirmation period of a profile ends; the
+maintain_change_feed command records 'confirmation-expired' changes for those (record_confirmation_deadlines), and
+deletes changes older than CHANGE_FEED_RETENTION days (prune).
+"""
+
+import datetime
+import logging
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .models import AuthChange, Plan, PlanInterval, Profile, ProfilePlanLog, plan_logs_written
+
+logger = logging.getLogger(__name__)
+
+# Fields of users and profiles that affect the answer of the auth resource
+USER_FIELDS = ('is_active',)
+PROFILE_FIELDS = ('needs_confirmation_after', 'created_on_behalf', 'subscribed_plan_id')
+
+# Profiles whose confirmation period ended longer ago are not looked at by record_confirmation_deadlines. Must be
+# shorter than CHANGE_FEED_RETENTION, since the recorded changes tell which profiles are done.
+CONFIRMATION_LOOKBACK = datetime.timedelta(days=1)
+
+
+def record(kind, user_id=None, plan_id=''):
+    AuthChange.objects.create(kind=kind, user_id=user_id, plan_id=plan_id)
+
+
+def parse_cursor(value):
+    """
+    Return the (txid, id) tuple of the cursor string *value*. Raise ValueError if it is malformed.
+
+    Plain IDs (the cursors of the feed before it was ordered by txid) are the IDs of changes with txid 0.
+    """
+    txid, separator, change_id = value.partition('-')
+    cursor = (int(txid), int(change_id)) if separator else (0, int(txid))
+    if min(cursor) < 0:
+        raise ValueError('Malformed cursor %r' % value)
+    return cursor
+
+
+def format_cursor(cursor):
+    return '%d-%d' % cursor
+
+
+def feed(since=(0, 0), limit=1000):
+    """Return a list of up to *limit* AuthChanges after the cursor *since*, in feed order."""
+    txid, change_id = since
+    changes = AuthChange.objects.filter(Q(txid__gt=txid) | Q(txid=txid, id__gt=change_id))
+    if connection.vendor == 'postgresql':
+        changes = changes.filter(txid__lt=RawSQL('txid_snapshot_xmin(txid_current_snapshot())', []))
+    return list(changes.order_by('txid', 'id')[:limit])
+
+
+def record_confirmation_deadlines(now=None):
+    """
+    Record a 'confirmation-expired' change for each profile whose confirmation period ended (at the latest at *now*)
+    without a confirmed email address and which has not got one yet. Return the number of recorded changes.
+    """
+    now = now or timezone.now()
+    recorded = AuthChange.objects.filter(kind='confirmation-expired', user_id=OuterRef('pk'),
+                                         timestamp__gte=OuterRef('needs_confirmation_after'))
+    verified = EmailAddress.objects.filter(user=OuterRef('pk'), primary=True, verified=True)
+    expired = (Profile.objects
+               .filter(needs_confirmation_after__range=(now - CONFIRMATION_LOOKBACK, now), created_on_behalf=False)
+               .annotate(recorded=Exists(recorded), verified=Exists(verified))
+               .filter(recorded=False, verified=False)
+               .values_list('pk', flat=True))
+    changes = AuthChange.objects.bulk_create(AuthChange(kind='confirmation-expired', user_id=user_id)
+                                             for user_id in expired)
+    if changes:
+        logger.info('Recorded the end of the confirmation period of %d profiles', len(changes))
+    return len(changes)
+
+
+def prune(now=None):
+    """Delete the changes older than CHANGE_FEED_RETENTION days. Return their number."""
+    now = now or timezone.now()
+    deleted, _ = AuthChange.objects.filter(
+        timestamp__lt=now - datetime.timedelta(days=settings.CHANGE_FEED_RETENTION)).delete()
+    if deleted:
+        logger.info('Pruned %d changes', deleted)
+    return deleted
+
+
+def remember(instance, fields):
+    """Remember the loaded values of *fields* of *instance*, so that changed() needs no query."""
+    instance._auth_fields = {field: instance.__dict__[field] for field in fields if field in instance.__dict__}
+
+
+def changed(instance, fields):
+    """
+    Return whether any of *fields* of *instance* differ from the values it was loaded with (see remember).
+
+    Fields that were deferred when the instance was loaded count as changed once they are set.
+    """
+    loaded = getattr(instance, '_auth_fields', {})
+    current = instance.__dict__
+    return any(field in current and (field not in loaded or loaded[field] != current[field]) for field in fields)
+
+
+@receiver(post_save, sender=Token)
+def token_saved(sender, instance, created, **kwargs):
+    if created:
+        record('token-created', instance.user_id)
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    record('token-deleted', instance.user_id)
+
+
+@receiver(post_init, sender=User)
+def user_loaded(sender, instance, **kwargs):
+    remember(instance, USER_FIELDS)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or update_fields is not None and 'is_active' not in update_fields:
+        # New users are not changes; the other case are e.g. last_login updates.
+        pass
+    elif changed(instance, USER_FIELDS):
+        record('user-activated' if instance.is_active else 'user-deactivated', instance.pk)
+    remember(instance, USER_FIELDS)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    record('user-deleted', instance.pk)
+
+
+@receiver((post_save, post_delete), sender=EmailAddress)
+def email_address_changed(sender, instance, **kwargs):
+    record('email-changed', instance.user_id)
+
+
+@receiver(post_init, sender=Profile)
+def profile_loaded(sender, instance, **kwargs):
+    remember(instance, PROFILE_FIELDS)
+
+
+@receiver(post_save, sender=Profile)
+def profile_saved(sender, instance, created, **kwargs):
+    if not created and changed(instance, PROFILE_FIELDS):
+        record('profile-changed', instance.pk)
+    remember(instance, PROFILE_FIELDS)
+
+
+@receiver((post_save, post_delete), sender=PlanInterval)
+def plan_interval_changed(sender, instance, **kwargs):
+    record('interval-changed', instance.profile_id, instance.plan_id)
+
+
+@receiver(post_save, sender=ProfilePlanLog)
+def plan_log_written(sender, instance, created, **kwargs):
+    if created:
+        record(instance.action, instance.profile_id, instance.plan_id)
+
+
+@receiver(plan_logs_written)
+def plan_logs_written_handler(sender, entries, **kwargs):
+    AuthChange.objects.bulk_create(AuthChange(kind=entry.action, user_id=entry.profile_id, plan_id=entry.plan_id)
+                                   for entry in entries)
+
+
+@receiver(post_save, sender=Plan)
+def plan_saved(sender, instance, created, **kwargs):
+    if not created:
+        record('plan-changed', plan_id=instance.pk)
+
+
+@receiver(post_delete, sender=Plan)
+def plan_deleted(sender, instance, **kwargs):
+    record('plan-changed', plan_id=instance.pk)
@@ -0,0 +1,90 @@
+"""
+Set-based expiry of plan intervals.
+
+expire_due() expires due intervals in chunks, one UPDATE ... RETURNING per chunk, and starts the next pristine interval
+of each affected profile. The expire_intervals management command runs it periodically, so that auth requests
+rarely find a due interval (PlanInterval.check_expiry and resolver.use_interval still handle those that slip through).
+"""
+
+import logging
+
+from django.db import connections
+from django.db.models import DateTimeField, ExpressionWrapper, F, Value
+from django.db.models.sql import UpdateQuery
+from django.utils import timezone
+
+from .models import PlanInterval, Profile, ProfilePlanLog, update_effective_plans
+
+logger = logging.getLogger(__name__)
+
+ORIGIN = 'expire_intervals'
+
+
+def _update_returning(queryset, **fields):
+    """
+    Update the intervals in *queryset* like queryset.update(**fields), in one UPDATE ... RETURNING statement.
+
+    Return (id, profile_id, plan_id) of the updated intervals.
+    """
+    query = queryset.query.chain(UpdateQuery)
+    query.add_update_values(fields)
+    sql, params = query.get_compiler(queryset.db).as_sql()
+    connection = connections[queryset.db]
+    opts = PlanInterval._meta
+    returning = ', '.join(connection.ops.quote_name(opts.get_field(name).column) for name in ('id', 'profile', 'plan'))
+    with connection.cursor() as cursor:
+        cursor.execute('%s RETURNING %s' % (sql, returning), params)
+        return cursor.fetchall()
+
+
+def _log(action, rows):
+    for interval_id, profile_id, plan_id in rows:
+        ProfilePlanLog.objects.log(profile_id=profile_id, plan_id=plan_id, interval_id=interval_id, action=action,
+                                   origin=ORIGIN)
+
+
+def expire_chunk(now, chunk_size):
+    """
+    Expire up to *chunk_size* intervals that are due at *now* and start the next pristine interval of their profiles.
+
+    Return the number of expired intervals.
+    """
+    due = PlanInterval.objects.filter(state='in_use', expires_at__lt=now).order_by('expires_at')[:chunk_size]
+    with ProfilePlanLog.objects.buffered():
+        expired = _update_returning(PlanInterval.objects.filter(pk__in=due.values('pk'), state='in_use'),
+                                    state='expired')
+        if not expired:
+            return 0
+        _log('expired-interval', expired)
+
+        profile_ids = {profile_id for interval_id, profile_id, plan_id in expired}
+        next_intervals, started = {}, []
+        pristine = (PlanInterval.objects
+                    .filter(profile__in=profile_ids, state='pristine')
+                    .order_by('-id')
+                    .values_list('pk', 'profile'))
+        for interval_id, profile_id in pristine:
+            next_intervals.setdefault(profile_id, interval_id)
+        if next_intervals:
+            expires_at = ExpressionWrapper(Value(now, output_field=DateTimeField()) + F('duration'),
+                                           output_field=DateTimeField())
+            started = _update_returning(PlanInterval.objects.filter(pk__in=next_intervals.values(), state='pristine'),
+                                        state='in_use', started_at=now, expires_at=expires_at)
+            _log('start-interval', started)
+
+        update_effective_plans(Profile.objects
+                               .filter(pk__in=profile_ids)
+                               .only('pk', 'subscribed_plan', 'effective_plan', 'effective_until'))
+    logger.info('Expired %d intervals, started %d', len(expired), len(started))
+    return len(expired)
+
+
+def expire_due(chunk_size=500, now=None):
+    """Expire all intervals due at *now* (default: the current time). Return the number of expired intervals."""
+    now = now or timezone.now()
+    total = 0
+    while True:
+        expired = expire_chunk(now, chunk_size)
+        total += expired
+        if expired < chunk_size:
+            return total
@@ -0,0 +1,277 @@
+"""
+Exports of users and the plan log that run in the background (ExportJob).
+
+The admin streams exports of small user selections directly (see admin.UserAdmin). Larger selections (more than
+ADMIN_EXPORT_BACKGROUND_THRESHOLD users) and plan log exports are queued as ExportJobs instead. The run_export_jobs
+management command runs them: it writes gzip compressed files to EXPORT_JOB_DIR and updates the progress of the job
+every CHUNK_SIZE rows. The admin shows the progress and serves the finished files.
+
+User exports store the selection of the admin: the query string of the user changelist when all matching users are
+selected, or the IDs of hand-picked users. The worker rebuilds the queryset from it. Jobs whose worker died (no
+progress for EXPORT_JOB_STALE_AFTER seconds) are run again, up to MAX_ATTEMPTS times.
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+import zlib
+from datetime import timedelta
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.http import HttpRequest, QueryDict
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import plan_log_export
+from .models import ExportJob
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 2000
+MAX_ATTEMPTS = 3
+
+# Columns of the extended user export, in addition to username and email
+EXTENDED_USER_COLUMNS = (
+    ('email_verified', 'primary_email_verified'),
+    ('plan', 'profile__subscribed_plan'),
+    ('created_at', 'profile__created_at'),
+    ('created_on_behalf', 'profile__created_on_behalf'),
+    ('needs_confirmation_after', 'profile__needs_confirmation_after'),
+)
+
+# kind: (only users with a verified primary address, additional columns)
+USER_EXPORTS = {
+    'users': (True, ()),
+    'users-extended': (False, EXTENDED_USER_COLUMNS),
+}
+
+
+def user_header(kind):
+    verified_only, columns = USER_EXPORTS[kind]
+    return ['username', 'email'] + [name for name, field in columns]
+
+
+def user_rows(queryset, kind):
+    """
+    Yield the CSV rows of the users in *queryset* for a *kind* user export (see USER_EXPORTS).
+
+    Users without a primary (or, if the export requires it, verified) email address yield None.
+    """
+    verified_only, columns = USER_EXPORTS[kind]
+    primary_email = EmailAddress.objects.filter(user=OuterRef('pk'), primary=True)
+    rows = (queryset
+            .order_by('pk')
+            .annotate(primary_email=Subquery(primary_email.values('email')[:1]),
+                      primary_email_verified=Subquery(primary_email.values('verified')[:1]))
+            .values_list('username', 'primary_email', 'primary_email_verified', *[field for name, field in columns])
+            .iterator(chunk_size=CHUNK_SIZE))
+    for username, email, verified, *extra in rows:
+        if not email or (verified_only and not verified):
+            yield None
+        else:
+            yield [username, email] + extra
+
+
+def queue_user_export(kind, changelist=None, user_ids=None, created_by=None):
+    """
+    Queue a *kind* user export of either the users listed by the user changelist for the query string *changelist*
+    or the users with *user_ids*. Return the ExportJob.
+    """
+    if (changelist is None) == (user_ids is None):
+        raise ValueError('Pass either a changelist query string or user IDs')
+    if changelist is not None:
+        parameters = {'changelist': changelist}
+    else:
+        parameters = {'user_ids': sorted(int(user_id) for user_id in user_ids)}
+    job = ExportJob.objects.create(kind=kind, created_by=created_by, parameters=json.dumps(parameters))
+    logger.info('Queued export job %d (%s)', job.pk, kind)
+    return job
+
+
+def queue_plan_log_export(output='csv', created_by=None, **filters):
+    """Queue an export of the plan log entries matching *filters* (see plan_log_export.filtered). Return the ExportJob."""
+    # Reject invalid filters now rather than in the job.
+    plan_log_export.filtered(**filters)
+    parameters = dict(filters, output=output)
+    for name in ('since', 'until'):
+        if parameters.get(name):
+            parameters[name] = parameters[name].isoformat()
+    job = ExportJob.objects.create(kind='plan-log', created_by=created_by, parameters=json.dumps(parameters))
+    logger.info('Queued export job %d (plan-log)', job.pk)
+    return job
+
+
+def directory():
+    return settings.EXPORT_JOB_DIR
+
+
+def path(job):
+    return os.path.join(directory(), job.file_name)
+
+
+def remove_file(job):
+    if job.file_name and os.path.exists(path(job)):
+        os.unlink(path(job))
+
+
+def _save_progress(job):
+    job.heartbeat_at = timezone.now()
+    ExportJob.objects.filter(pk=job.pk).update(total=job.total, processed=job.processed, written=job.written,
+                                               heartbeat_at=job.heartbeat_at)
+
+
+def _tracked(job, rows):
+    """Pass through *rows*, counting them in *job* and saving its progress every CHUNK_SIZE rows."""
+    for row in rows:
+        job.processed += 1
+        if row is not None:
+            job.written += 1
+        yield row
+        if job.processed % CHUNK_SIZE == 0:
+            _save_progress(job)
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def _csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        if row is not None:
+            writer.writerow(row)
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def changelist_queryset(query_string, user=None):
+    """Return the users listed by the user changelist of the admin for *query_string*, as seen by *user*."""
+    # Imported here, the admin imports this module.
+    from .admin import UserAdmin
+    request = HttpRequest()
+    request.method = 'GET'
+    request.GET = QueryDict(query_string)
+    request.user = user or AnonymousUser()
+    model_admin = UserAdmin(User, admin.site)
+    return model_admin.get_changelist_instance(request).get_queryset(request)
+
+
+def _user_export(job):
+    parameters = json.loads(job.parameters)
+    if 'changelist' in parameters:
+        queryset = changelist_queryset(parameters['changelist'], job.created_by)
+    else:
+        # Users deleted since the job was queued are left out.
+        queryset = User.objects.filter(pk__in=parameters['user_ids'])
+    job.total = queryset.count()
+    _save_progress(job)
+    return _gzip(_csv(user_header(job.kind), _tracked(job, user_rows(queryset, job.kind)))), 'csv.gz'
+
+
+def _plan_log_export(job):
+    filters = json.loads(job.parameters)
+    output = filters.pop('output')
+    for name in ('since', 'until'):
+        if filters.get(name):
+            filters[name] = parse_datetime(filters[name])
+    job.total = plan_log_export.filtered(**filters).count()
+    _save_progress(job)
+    rows = _tracked(job, plan_log_export.entries(**filters))
+    if output == 'ndjson':
+        return _gzip(plan_log_export.ndjson(rows)), 'ndjson.gz'
+    return plan_log_export.gzip_csv(rows), plan_log_export.FILE_EXTENSIONS['csv']
+
+
+EXPORTS = {
+    'users': _user_export,
+    'users-extended': _user_export,
+    'plan-log': _plan_log_export,
+}
+
+
+def run(job):
+    """Run the (claimed) *job*, writing its file. Failures are recorded in the job."""
+    os.makedirs(directory(), exist_ok=True)
+    # Written under a temporary name first, so that the file is never served incomplete.
+    fd, temporary = tempfile.mkstemp(dir=directory(), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            chunks, extension = EXPORTS[job.kind](job)
+            for chunk in chunks:
+                file.write(chunk)
+        job.file_name = 'export-%d-%s.%s' % (job.pk, job.kind, extension)
+        os.rename(temporary, path(job))
+    except Exception as exc:
+        logger.exception('Export job %d failed', job.pk)
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        job.state = 'failed'
+        job.error = repr(exc)
+    else:
+        logger.info('Export job %d wrote %d of %d rows to %s', job.pk, job.written, job.processed, job.file_name)
+        job.state = 'done'
+    job.finished_at = timezone.now()
+    job.save()
+
+
+def claim():
+    """Mark the oldest pending job as running and return it, None if there is none."""
+    with transaction.atomic():
+        job = (ExportJob.objects
+               .select_for_update(skip_locked=True)
+               .filter(state='pending')
+               .order_by('created_at')
+               .first())
+        if job is None:
+            return None
+        job.state = 'running'
+        job.started_at = job.heartbeat_at = timezone.now()
+        job.attempts += 1
+        # Counted again by a new attempt
+        job.processed = job.written = 0
+        job.save(update_fields=['state', 'started_at', 'heartbeat_at', 'attempts', 'processed', 'written'])
+    return job
+
+
+def requeue_stale(now=None):
+    """
+    Return running jobs without progress for EXPORT_JOB_STALE_AFTER seconds to pending, or fail them after
+    MAX_ATTEMPTS attempts. Return the number of requeued jobs.
+    """
+    now = now or timezone.now()
+    stale = ExportJob.objects.filter(state='running',
+                                     heartbeat_at__lt=now - timedelta(seconds=settings.EXPORT_JOB_STALE_AFTER))
+    failed = stale.filter(attempts__gte=MAX_ATTEMPTS).update(state='failed', finished_at=now,
+                                                             error='Worker stopped responding')
+    requeued = stale.update(state='pending')
+    if failed or requeued:
+        logger.warning('Requeued %d stale export jobs, failed %d', requeued, failed)
+    return requeued
+
+
+def run_pending():
+    """Requeue stale jobs, then run pending jobs until there are none left. Return the number of jobs run."""
+    requeue_stale()
+    count = 0
+    job = claim()
+    while job:
+        run(job)
+        count += 1
+        job = claim()
+    return count
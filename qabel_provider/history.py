@@ -0,0 +1,131 @@
+"""
+Pages of the account history (views.user_history).
+
+Pages are keyset-paginated on (timestamp, id) of the ProfilePlanLog, newest first, continuing into the archived
+months (see plan_log_archive). Described pages are cached per user and language; writing a log entry for a profile
+invalidates all of its pages by changing its cache version.
+"""
+
+import uuid
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone, translation
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import utc
+from django.utils.translation import ugettext_lazy as _
+
+from . import plan_log_archive
+from .auth_cache import on_change
+from .models import ProfilePlanLog, plan_logs_written
+
+PAGE_SIZE = 50
+CACHE_TIMEOUT = 24 * 60 * 60
+
+event_describers = {
+    'start-interval': _('Started using prepaid plan {.plan}').format,
+    'expired-interval': _('Prepaid plan {.plan} expired').format,
+    'add-interval': _('Prepaid plan {0.plan} of duration {0.interval.duration} added').format,
+    'set-plan': _('Subscribed to {.plan}').format,
+}
+
+
+def version_key(profile_id):
+    return 'user-history-version-%d' % profile_id
+
+
+def page_key(profile_id, version, position):
+    cursor = format_position(position) if position else ''
+    return 'user-history-%d-%s-%s-%s' % (profile_id, version, translation.get_language(), cursor)
+
+
+def format_position(position):
+    timestamp, id = position
+    return '%s_%d' % (timestamp.astimezone(utc).isoformat(), id)
+
+
+def format_cursor(entry):
+    return format_position((entry.timestamp, entry.id))
+
+
+def parse_cursor(cursor):
+    """Return (timestamp, id) of *cursor*, normalized to UTC, or None if it is malformed."""
+    try:
+        timestamp, id = cursor.rsplit('_', 1)
+        timestamp = parse_datetime(timestamp)
+        id = int(id)
+    except (AttributeError, TypeError, ValueError):
+        # parse_datetime raises ValueError for well formatted, but invalid dates like 2020-02-30.
+        return
+    if timestamp is None:
+        return
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, utc)
+    return timestamp.astimezone(utc), id
+
+
+def describe(entry):
+    return {
+        'timestamp': entry.timestamp,
+        'description': event_describers[entry.action](entry),
+    }
+
+
+def load_page(profile_id, position=None):
+    """
+    Return the page of log entries of *profile_id* after *position* (see parse_cursor; None for the first page)
+    and the cursor of the next page (None for the last page).
+    """
+    entries = (ProfilePlanLog.objects
+               .filter(profile_id=profile_id)
+               .select_related('plan', 'interval')
+               .order_by('-timestamp', '-id'))
+    if position:
+        timestamp, id = position
+        entries = entries.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=id))
+    entries = list(entries[:PAGE_SIZE + 1])
+    if len(entries) <= PAGE_SIZE:
+        # Past the live entries; archived ones are all older.
+        entries.extend(plan_log_archive.archived_entries(profile_id, before=position,
+                                                         limit=PAGE_SIZE + 1 - len(entries)))
+    next_cursor = format_cursor(entries[PAGE_SIZE - 1]) if len(entries) > PAGE_SIZE else None
+    return entries[:PAGE_SIZE], next_cursor
+
+
+def page(profile_id, position=None):
+    """
+    Return ``{'events': [{'timestamp', 'description'}, ...], 'next_page': cursor}`` for the page after *position*,
+    from the cache if possible.
+    """
+    version = cache.get(version_key(profile_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(version_key(profile_id), version, None)
+    key = page_key(profile_id, version, position)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    entries, next_cursor = load_page(profile_id, position)
+    cached = {
+        'events': [describe(entry) for entry in entries],
+        'next_page': next_cursor,
+    }
+    cache.set(key, cached, CACHE_TIMEOUT)
+    return cached
+
+
+def invalidate(profile_ids):
+    cache.delete_many([version_key(profile_id) for profile_id in profile_ids])
+
+
+@receiver(plan_logs_written)
+def plan_logs_written_handler(sender, entries, **kwargs):
+    on_change(invalidate, {entry.profile_id for entry in entries})
+
+
+@receiver(post_save, sender=ProfilePlanLog)
+def plan_log_saved(sender, instance, created, **kwargs):
+    if created:
+        on_change(invalidate, [instance.profile_id])
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from ...plan_log_archive import archive, ensure_partitions
+
+
+class Command(BaseCommand):
+    help = 'Move plan log entries of whole months into compressed JSONL files and create upcoming partitions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', type=parse_date, required=True,
+                            help='Archive all months before the month of this date (YYYY-MM-DD).')
+        parser.add_argument('--directory',
+                            help='Directory of the archive files. Default: the PLAN_LOG_ARCHIVE_DIR setting')
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help='Number of months ahead to create partitions for (PostgreSQL only). Default: 3')
+
+    def handle(self, *args, before, directory, months_ahead, **options):
+        if before is None:
+            raise CommandError('--before must be a date (YYYY-MM-DD)')
+        before = timezone.make_aware(timezone.datetime(before.year, before.month, 1))
+        if before > timezone.now():
+            raise CommandError('Cannot archive the current month or later')
+        ensure_partitions(months_ahead)
+        archived = archive(before, directory)
+        self.stdout.write('Archived %d plan log entries' % archived)
@@ -0,0 +1,33 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...expiry import expire_due
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Expire due plan intervals and start the next pristine interval of their profiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of intervals expired per transaction. Default: 500')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, checking for due intervals every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=30,
+                            help='Seconds between checks in --loop mode. Default: 30')
+
+    def handle(self, *args, chunk_size, loop, interval, **options):
+        if not loop:
+            expired = expire_due(chunk_size)
+            self.stdout.write('Expired %d intervals' % expired)
+            return
+        while True:
+            try:
+                expire_due(chunk_size)
+            except Exception:
+                # E.g. the database restarting; the next round catches up.
+                logger.exception('Failed to expire due intervals')
+            time.sleep(interval)
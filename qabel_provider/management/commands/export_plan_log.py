@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...plan_log_export import ACTIONS, FORMATS, export
+from ...utils import timestamp_argument
+
+
+class Command(BaseCommand):
+    help = 'Export the plan log as NDJSON or gzip compressed CSV, oldest entries first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=timestamp_argument, help='Only entries at or after this ISO 8601 timestamp.')
+        parser.add_argument('--until', type=timestamp_argument, help='Only entries before this ISO 8601 timestamp.')
+        parser.add_argument('--plan', help='Only entries of this plan (ID).')
+        parser.add_argument('--action', choices=ACTIONS, help='Only entries with this action.')
+        parser.add_argument('--format', choices=FORMATS, default='ndjson', help='Default: ndjson')
+        parser.add_argument('--output', help='Output file. Default: standard output')
+
+    def handle(self, *args, since, until, plan, action, format, output, **options):
+        if output:
+            file = open(output, 'wb')
+        elif format == 'csv' and sys.stdout.isatty():
+            raise CommandError('Refusing to write compressed data to a terminal, use --output')
+        else:
+            file = sys.stdout.buffer
+        try:
+            for chunk in export(format, since=since, until=until, plan=plan, action=action):
+                file.write(chunk)
+        finally:
+            if output:
+                file.close()
+            else:
+                file.flush()
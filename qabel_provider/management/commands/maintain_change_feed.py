@@ -0,0 +1,33 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...changes import prune, record_confirmation_deadlines
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Record the ends of confirmation periods in the change feed and delete old changes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, checking for ended confirmation periods every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=30,
+                            help='Seconds between checks in --loop mode. Default: 30')
+
+    def handle(self, *args, loop, interval, **options):
+        if not loop:
+            recorded = record_confirmation_deadlines()
+            pruned = prune()
+            self.stdout.write('Recorded %d ended confirmation periods, pruned %d changes' % (recorded, pruned))
+            return
+        while True:
+            try:
+                record_confirmation_deadlines()
+                prune()
+            except Exception:
+                # E.g. the database restarting; the next round catches up.
+                logger.exception('Failed to maintain the change feed')
+            time.sleep(interval)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Profile, ProfilePlanLog, update_effective_plans
+from ...utils import timestamp_argument
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized effective plan columns of all profiles from their plan intervals.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of profiles updated per query. Default: 1000')
+        parser.add_argument('--changed-since', type=timestamp_argument,
+                            help='Only recompute profiles with plan log entries since this ISO 8601 timestamp.')
+
+    def handle(self, *args, chunk_size, changed_since, **options):
+        profiles = Profile.objects.order_by('pk')
+        if changed_since:
+            profiles = profiles.filter(pk__in=ProfilePlanLog.objects
+                                       .filter(timestamp__gte=changed_since)
+                                       .values('profile'))
+        last_pk = None
+        updated = 0
+        while True:
+            chunk = profiles
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            chunk = list(chunk.only('pk', 'subscribed_plan', 'effective_plan', 'effective_until')[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            with transaction.atomic():
+                updated += update_effective_plans(chunk)
+        self.stdout.write('Updated %d profiles' % updated)
@@ -0,0 +1,30 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...export_jobs import run_pending
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run the export jobs queued in the admin.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, polling for new jobs every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls in --loop mode. Default: 5')
+
+    def handle(self, *args, loop, interval, **options):
+        if not loop:
+            run_pending()
+            return
+        while True:
+            try:
+                run_pending()
+            except Exception:
+                # E.g. the database restarting; failures of the jobs themselves are recorded in the jobs.
+                logger.exception('Failed to run export jobs')
+            time.sleep(interval)
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...outbox import send_queued
+
+
+class Command(BaseCommand):
+    help = 'Send the mails queued in the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of mails sent over one connection. Default: 100')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, polling the outbox every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls in --loop mode. Default: 5')
+
+    def handle(self, *args, batch_size, loop, interval, **options):
+        while True:
+            # Drain everything that is due before sleeping.
+            while send_queued(batch_size) == batch_size:
+                pass
+            if not loop:
+                break
+            time.sleep(interval)
@@ -0,0 +1,68 @@
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .monitoring import VIEW_QUERIES, VIEW_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Collapses "IN (%s, %s, ...)" lists, so that queries differing only in the number of parameters share a fingerprint.
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+def fingerprint(sql):
+    return IN_LIST.sub('IN (...)', sql)
+
+
+class QueryStats:
+    """Database execute wrapper (see connection.execute_wrapper) counting and timing the queries."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+
+class QueryMetricsMiddleware:
+    """
+    Record the number of SQL queries and the time spent in the database per request, by resolved view name.
+
+    Enabled by the QUERY_METRICS setting. Requests with more than QUERY_BUDGET queries are logged as warnings with
+    their request ID and the most frequent query fingerprints, which points out N+1 query patterns. Queries run
+    while a streaming response is sent are not included.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_METRICS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        VIEW_QUERIES.labels(view).observe(stats.count)
+        VIEW_QUERY_SECONDS.labels(view).observe(stats.seconds)
+        if stats.count > settings.QUERY_BUDGET:
+            logger.warning('Request %s to %s made %d queries (%.3f s), over the budget of %d. Most frequent: %s',
+                           getattr(request, 'id', 'none'), view, stats.count, stats.seconds, settings.QUERY_BUDGET,
+                           '; '.join('%d x %s' % (count, sql) for sql, count in stats.fingerprints.most_common(3)))
+        return response
@@ -6,21 +6,22 @@ import django.db.models.deletion
 def migrate_to_plans(apps, schema_editor):
     Plan = apps.get_model('qabel_provider', 'Plan')
     Profile = apps.get_model('qabel_provider', 'Profile')
+    db_alias = schema_editor.connection.alias
 
     default = Plan(id='free', name='Qabel Free')
-    default.save()
+    default.save(using=db_alias)
 
-    for profile in Profile.objects.all():
+    for profile in Profile.objects.using(db_alias).all():
         plan_params = {
             'block_quota': profile.block_quota,
             'monthly_traffic_quota': profile.monthly_traffic_quota,
         }
         try:
-            plan = Plan.objects.get(**plan_params)
+            plan = Plan.objects.using(db_alias).get(**plan_params)
         except ObjectDoesNotExist:
-            name = 'custom-%d' % Plan.objects.count()
+            name = 'custom-%d' % Plan.objects.using(db_alias).count()
             plan = Plan(id=name, name=name, **plan_params)
-            plan.save()
+            plan.save(using=db_alias)
         profile.subscribed_plan = plan
         profile.save()
 
@@ -28,7 +29,7 @@ def migrate_to_plans(apps, schema_editor):
 def migrate_from_plans(apps, schema_editor):
     Profile = apps.get_model('qabel_provider', 'Profile')
 
-    for profile in Profile.objects.all():
+    for profile in Profile.objects.using(schema_editor.connection.alias).all():
         plan = profile.subscribed_plan  # note that this will throw away any intervals and will *not* make them permanent
         profile.block_quota = plan.block_quota
         profile.monthly_traffic_quota = plan.monthly_traffic_quota
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.5 on 2026-10-18 20:17
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0016_auto_20190930_0957'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('from_email', models.CharField(max_length=254)),
+                ('to', models.TextField()),
+                ('cc', models.TextField(blank=True)),
+                ('subject', models.TextField()),
+                ('body', models.TextField()),
+                ('body_subtype', models.CharField(default='plain', max_length=20)),
+                ('html_body', models.TextField(blank=True)),
+                ('send_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'index_together': {('sent_at', 'send_after')},
+            },
+            bases=(models.Model,),
+        ),
+    ]
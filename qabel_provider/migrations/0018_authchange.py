@@ -0,0 +1,24 @@
+# Generated by Django 2.2.5 on 2026-10-18 20:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0017_queuedmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('kind', models.CharField(choices=[('token-created', 'auth token created'), ('token-deleted', 'auth token deleted'), ('user-activated', 'user activated'), ('user-deactivated', 'user deactivated'), ('user-deleted', 'user deleted'), ('email-changed', 'email address changed or confirmed'), ('profile-changed', 'confirmation period or subscribed plan changed'), ('interval-changed', 'plan interval changed'), ('set-plan', 'plan subscription set'), ('add-interval', 'plan interval added'), ('start-interval', 'plan interval started'), ('expired-interval', 'plan interval expired'), ('plan-changed', 'plan quota changed')], max_length=30)),
+                ('user_id', models.IntegerField(blank=True, null=True)),
+                ('plan_id', models.CharField(blank=True, max_length=50)),
+            ],
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 2.2.5 on 2026-10-18 20:26
+
+from collections import defaultdict
+
+from django.db import migrations, models, transaction
+import django.db.models.deletion
+
+CHUNK_SIZE = 1000
+
+
+def effective_plan(profile, intervals):
+    """Profile.plan of *profile* given its in use and pristine *intervals* (most recent first), and its expiry."""
+    for interval in intervals:
+        if interval.state == 'in_use' and interval.started_at:
+            return interval.plan_id, interval.started_at + interval.duration
+    for interval in intervals:
+        if interval.state == 'pristine':
+            return interval.plan_id, None
+    return profile.subscribed_plan_id, None
+
+
+def backfill_effective_plans(apps, schema_editor):
+    Profile = apps.get_model('qabel_provider', 'Profile')
+    PlanInterval = apps.get_model('qabel_provider', 'PlanInterval')
+    db_alias = schema_editor.connection.alias
+    # Chunks of ascending IDs, each in its own transaction, so that large tables are not locked for long.
+    last_pk = 0
+    while True:
+        profiles = list(Profile.objects
+                        .using(db_alias)
+                        .filter(pk__gt=last_pk)
+                        .order_by('pk')
+                        .only('pk', 'subscribed_plan')[:CHUNK_SIZE])
+        if not profiles:
+            break
+        last_pk = profiles[-1].pk
+        intervals = defaultdict(list)
+        usable_intervals = (PlanInterval.objects
+                            .using(db_alias)
+                            .filter(profile__in=profiles, state__in=('in_use', 'pristine'))
+                            .order_by('-id'))
+        for interval in usable_intervals:
+            intervals[interval.profile_id].append(interval)
+        for profile in profiles:
+            profile.effective_plan_id, profile.effective_until = effective_plan(profile, intervals[profile.pk])
+        with transaction.atomic(using=db_alias):
+            Profile.objects.using(db_alias).bulk_update(profiles, ['effective_plan', 'effective_until'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('qabel_provider', '0018_authchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='effective_plan',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='qabel_provider.Plan'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='effective_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_effective_plans, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 2.2.5 on 2026-10-18 20:31
+
+from django.db import migrations, models, transaction
+
+CHUNK_SIZE = 1000
+
+
+def backfill_expires_at(apps, schema_editor):
+    PlanInterval = apps.get_model('qabel_provider', 'PlanInterval')
+    db_alias = schema_editor.connection.alias
+    expires_at = models.ExpressionWrapper(models.F('started_at') + models.F('duration'),
+                                          output_field=models.DateTimeField())
+    # Chunks of ascending IDs, each in its own transaction, so that large tables are not locked for long.
+    last_id = 0
+    while True:
+        ids = list(PlanInterval.objects
+                   .using(db_alias)
+                   .filter(id__gt=last_id, started_at__isnull=False)
+                   .order_by('id')
+                   .values_list('id', flat=True)[:CHUNK_SIZE])
+        if not ids:
+            break
+        with transaction.atomic(using=db_alias):
+            PlanInterval.objects.using(db_alias).filter(id__in=ids).update(expires_at=expires_at)
+        last_id = ids[-1]
+
+
+def expire_duplicate_in_use(apps, schema_editor):
+    # Concurrent requests could start more than one interval of a profile, which the new constraint forbids.
+    # Keep the most recently added one.
+    PlanInterval = apps.get_model('qabel_provider', 'PlanInterval')
+    ProfilePlanLog = apps.get_model('qabel_provider', 'ProfilePlanLog')
+    db_alias = schema_editor.connection.alias
+    duplicates = (PlanInterval.objects
+                  .using(db_alias)
+                  .filter(state='in_use')
+                  .values('profile')
+                  .annotate(count=models.Count('id'), keep=models.Max('id'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        with transaction.atomic(using=db_alias):
+            for interval in PlanInterval.objects.using(db_alias).filter(profile=duplicate['profile'], state='in_use',
+                                                                        id__lt=duplicate['keep']):
+                interval.state = 'expired'
+                interval.save()
+                ProfilePlanLog.objects.using(db_alias).create(profile_id=interval.profile_id, action='expired-interval',
+                                              plan_id=interval.plan_id, interval=interval,
+                                              origin='migration 0020_planinterval_expires_at')
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('qabel_provider', '0019_profile_effective_plan'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='planinterval',
+            options={},
+        ),
+        migrations.AddField(
+            model_name='planinterval',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_expires_at, migrations.RunPython.noop),
+        migrations.RunPython(expire_duplicate_in_use, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='planinterval',
+            index=models.Index(condition=models.Q(state='in_use'), fields=['expires_at'], name='planinterval_in_use_expiry'),
+        ),
+        migrations.AddIndex(
+            model_name='planinterval',
+            index=models.Index(condition=models.Q(state='pristine'), fields=['profile', '-id'], name='planinterval_pristine'),
+        ),
+        migrations.AddConstraint(
+            model_name='planinterval',
+            constraint=models.UniqueConstraint(condition=models.Q(state='in_use'), fields=('profile',), name='planinterval_one_in_use'),
+        ),
+    ]
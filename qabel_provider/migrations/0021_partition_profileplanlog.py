@@ -0,0 +1,93 @@
+import datetime
+
+from django.db import migrations
+from django.utils import timezone
+
+# Partition key columns must be part of the primary key, so it becomes (id, timestamp) in the database.
+# Django still treats id as the primary key, which stays unique since it comes from a sequence.
+PARTITION = """
+ALTER TABLE qabel_provider_profileplanlog RENAME TO qabel_provider_profileplanlog_unpartitioned;
+CREATE TABLE qabel_provider_profileplanlog (
+    LIKE qabel_provider_profileplanlog_unpartitioned INCLUDING DEFAULTS
+) PARTITION BY RANGE ("timestamp");
+ALTER TABLE qabel_provider_profileplanlog ADD PRIMARY KEY (id, "timestamp");
+ALTER TABLE qabel_provider_profileplanlog
+    ADD FOREIGN KEY (profile_id) REFERENCES qabel_provider_profile (user_id) DEFERRABLE INITIALLY DEFERRED,
+    ADD FOREIGN KEY (plan_id) REFERENCES qabel_provider_plan (id) DEFERRABLE INITIALLY DEFERRED,
+    ADD FOREIGN KEY (interval_id) REFERENCES qabel_provider_planinterval (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX qabel_provider_profileplanlog_timestamp ON qabel_provider_profileplanlog ("timestamp");
+CREATE INDEX qabel_provider_profileplanlog_profile_id ON qabel_provider_profileplanlog (profile_id);
+CREATE INDEX qabel_provider_profileplanlog_plan_id ON qabel_provider_profileplanlog (plan_id);
+CREATE INDEX qabel_provider_profileplanlog_interval_id ON qabel_provider_profileplanlog (interval_id);
+CREATE TABLE qabel_provider_profileplanlog_default PARTITION OF qabel_provider_profileplanlog DEFAULT;
+"""
+
+COPY = """
+INSERT INTO qabel_provider_profileplanlog SELECT * FROM qabel_provider_profileplanlog_unpartitioned;
+ALTER SEQUENCE qabel_provider_profileplanlog_id_seq OWNED BY qabel_provider_profileplanlog.id;
+DROP TABLE qabel_provider_profileplanlog_unpartitioned;
+"""
+
+UNPARTITION = """
+CREATE TABLE qabel_provider_profileplanlog_partitioned AS SELECT * FROM qabel_provider_profileplanlog;
+ALTER SEQUENCE qabel_provider_profileplanlog_id_seq OWNED BY NONE;
+DROP TABLE qabel_provider_profileplanlog;
+ALTER TABLE qabel_provider_profileplanlog_partitioned RENAME TO qabel_provider_profileplanlog;
+ALTER TABLE qabel_provider_profileplanlog
+    ALTER COLUMN id SET DEFAULT nextval('qabel_provider_profileplanlog_id_seq'),
+    ADD PRIMARY KEY (id),
+    ADD FOREIGN KEY (profile_id) REFERENCES qabel_provider_profile (user_id) DEFERRABLE INITIALLY DEFERRED,
+    ADD FOREIGN KEY (plan_id) REFERENCES qabel_provider_plan (id) DEFERRABLE INITIALLY DEFERRED,
+    ADD FOREIGN KEY (interval_id) REFERENCES qabel_provider_planinterval (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER SEQUENCE qabel_provider_profileplanlog_id_seq OWNED BY qabel_provider_profileplanlog.id;
+CREATE INDEX qabel_provider_profileplanlog_timestamp ON qabel_provider_profileplanlog ("timestamp");
+CREATE INDEX qabel_provider_profileplanlog_profile_id ON qabel_provider_profileplanlog (profile_id);
+CREATE INDEX qabel_provider_profileplanlog_plan_id ON qabel_provider_profileplanlog (plan_id);
+CREATE INDEX qabel_provider_profileplanlog_interval_id ON qabel_provider_profileplanlog (interval_id);
+"""
+
+
+def next_month(month):
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def midnight(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time()))
+
+
+def partition(apps, schema_editor):
+    # Only PostgreSQL (11+) has declarative partitioning; elsewhere the table stays as it is.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(PARTITION)
+        cursor.execute('SELECT min("timestamp") FROM qabel_provider_profileplanlog_unpartitioned')
+        first = timezone.localtime(cursor.fetchone()[0] or timezone.now())
+        # Up to three months ahead; later ones are created by the archive_plan_log command.
+        last = timezone.localtime(timezone.now() + datetime.timedelta(days=92))
+        month = datetime.date(first.year, first.month, 1)
+        while month <= last.date():
+            cursor.execute(
+                'CREATE TABLE qabel_provider_profileplanlog_y%04dm%02d PARTITION OF qabel_provider_profileplanlog '
+                'FOR VALUES FROM (%%s) TO (%%s)' % (month.year, month.month),
+                [midnight(month), midnight(next_month(month))])
+            month = next_month(month)
+        cursor.execute(COPY)
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(UNPARTITION)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0020_planinterval_expires_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.5 on 2026-10-18 20:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0021_partition_profileplanlog'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='profileplanlog',
+            index=models.Index(fields=['profile', '-timestamp', '-id'], name='profileplanlog_history'),
+        ),
+    ]
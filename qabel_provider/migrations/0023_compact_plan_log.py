@@ -0,0 +1,127 @@
+from django.db import migrations, models, transaction
+import django.db.models.deletion
+import qabel_provider.models
+
+CHUNK_SIZE = 10000
+
+# PlanLogActionField.CODES at the time of this migration
+ACTION_CODES = {
+    'set-plan': 1,
+    'add-interval': 2,
+    'start-interval': 3,
+    'expired-interval': 4,
+}
+
+
+def id_chunks(queryset):
+    """Yield (first, last) ID ranges of at most CHUNK_SIZE IDs covering *queryset*."""
+    bounds = queryset.aggregate(first=models.Min('id'), last=models.Max('id'))
+    if bounds['first'] is None:
+        return
+    for first in range(bounds['first'], bounds['last'] + 1, CHUNK_SIZE):
+        yield first, first + CHUNK_SIZE - 1
+
+
+def encode_actions_and_origins(apps, schema_editor):
+    ProfilePlanLog = apps.get_model('qabel_provider', 'ProfilePlanLog')
+    RequestOrigin = apps.get_model('qabel_provider', 'RequestOrigin')
+    db_alias = schema_editor.connection.alias
+    entries = ProfilePlanLog.objects.using(db_alias)
+
+    origins = entries.exclude(origin='').order_by().values_list('origin', flat=True).distinct()
+    RequestOrigin.objects.using(db_alias).bulk_create((RequestOrigin(value=value) for value in origins.iterator()),
+                                                      batch_size=1000, ignore_conflicts=True)
+
+    action_code = models.Case(*[models.When(action=action, then=models.Value(code))
+                                for action, code in ACTION_CODES.items()], output_field=models.PositiveSmallIntegerField())
+    origin_id = models.Subquery(RequestOrigin.objects.filter(value=models.OuterRef('origin')).values('id')[:1])
+    # One transaction per chunk, so that the table is not locked as a whole for long.
+    for first, last in id_chunks(entries.all()):
+        with transaction.atomic(using=db_alias):
+            entries.filter(id__range=(first, last)).update(action_code=action_code)
+            entries.filter(id__range=(first, last)).exclude(origin='').update(origin_ref=origin_id)
+
+
+def decode_actions_and_origins(apps, schema_editor):
+    ProfilePlanLog = apps.get_model('qabel_provider', 'ProfilePlanLog')
+    RequestOrigin = apps.get_model('qabel_provider', 'RequestOrigin')
+    db_alias = schema_editor.connection.alias
+    entries = ProfilePlanLog.objects.using(db_alias)
+
+    action = models.Case(*[models.When(action_code=code, then=models.Value(action))
+                           for action, code in ACTION_CODES.items()], output_field=models.CharField())
+    origin = models.Subquery(RequestOrigin.objects.filter(id=models.OuterRef('origin_ref')).values('value')[:1])
+    for first, last in id_chunks(entries.all()):
+        with transaction.atomic(using=db_alias):
+            entries.filter(id__range=(first, last)).update(action=action)
+            entries.filter(id__range=(first, last), origin_ref__isnull=False).update(origin=origin)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('qabel_provider', '0022_profileplanlog_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestOrigin',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.CharField(max_length=200, unique=True)),
+            ],
+            bases=(models.Model,),
+        ),
+        # The old columns are kept until the new ones are filled in.
+        migrations.AddField(
+            model_name='profileplanlog',
+            name='action_code',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='profileplanlog',
+            name='origin_ref',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='qabel_provider.RequestOrigin'),
+        ),
+        # Defaults for re-adding the old columns when migrating backwards
+        migrations.AlterField(
+            model_name='profileplanlog',
+            name='action',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='profileplanlog',
+            name='origin',
+            field=models.CharField(blank=True, default='', max_length=200, verbose_name='Request origin'),
+        ),
+        migrations.RunPython(encode_actions_and_origins, decode_actions_and_origins),
+        migrations.RemoveField(
+            model_name='profileplanlog',
+            name='action',
+        ),
+        migrations.RemoveField(
+            model_name='profileplanlog',
+            name='origin',
+        ),
+        migrations.RenameField(
+            model_name='profileplanlog',
+            old_name='action_code',
+            new_name='action',
+        ),
+        migrations.RenameField(
+            model_name='profileplanlog',
+            old_name='origin_ref',
+            new_name='origin',
+        ),
+        migrations.AlterField(
+            model_name='profileplanlog',
+            name='action',
+            field=qabel_provider.models.PlanLogActionField(),
+        ),
+        migrations.AlterField(
+            model_name='profileplanlog',
+            name='origin',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='qabel_provider.RequestOrigin', verbose_name='Request origin'),
+        ),
+    ]
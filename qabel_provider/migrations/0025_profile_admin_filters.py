@@ -0,0 +1,51 @@
+# Generated by Django 2.2.5 on 2026-10-18 20:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+        ('qabel_provider', '0024_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(condition=models.Q(plus_notification_mail=True), fields=['plus_notification_mail'], name='profile_plus_notification'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(condition=models.Q(pro_notification_mail=True), fields=['pro_notification_mail'], name='profile_pro_notification'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['next_confirmation_mail'], name='profile_next_confirmation_mail'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['needs_confirmation_after'], name='profile_needs_confirmation'),
+        ),
+        # The filters of the original UserAdmin (is_staff, is_superuser, is_active) on auth_user. Staff, superusers and
+        # inactive users are the rare cases, so small partial indexes make these filters cheap.
+        #
+        # auth_user belongs to django.contrib.auth, whose models can't be given extra indexes, so they are created
+        # here in raw SQL. Django's migration state doesn't know about them (state_operations=[]): they don't show up
+        # in the model state, makemigrations never touches them, and only this migration drops them again. Django names
+        # the indexes it generates with a hash suffix, so these names don't collide with them. If auth ever changes
+        # these columns, this migration has to be revisited.
+        migrations.RunSQL(
+            sql=[
+                'CREATE INDEX IF NOT EXISTS auth_user_staff ON auth_user (id) WHERE is_staff',
+                'CREATE INDEX IF NOT EXISTS auth_user_superuser ON auth_user (id) WHERE is_superuser',
+                'CREATE INDEX IF NOT EXISTS auth_user_inactive ON auth_user (id) WHERE NOT is_active',
+            ],
+            reverse_sql=[
+                'DROP INDEX IF EXISTS auth_user_staff',
+                'DROP INDEX IF EXISTS auth_user_superuser',
+                'DROP INDEX IF EXISTS auth_user_inactive',
+            ],
+            state_operations=[],
+        ),
+    ]
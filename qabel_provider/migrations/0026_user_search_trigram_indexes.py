@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# Columns searched by admin.UserAdmin.get_search_results. Django's icontains is UPPER(column) LIKE UPPER(%s) on
+# PostgreSQL, so the indexes are on UPPER(column) to be usable for it.
+SEARCHED_COLUMNS = (
+    ('auth_user', 'username'),
+    ('auth_user', 'first_name'),
+    ('auth_user', 'last_name'),
+    ('auth_user', 'email'),
+    ('account_emailaddress', 'email'),
+)
+
+
+def index_name(table, column):
+    return '%s_%s_trgm' % (table, column)
+
+
+def create_indexes(apps, schema_editor):
+    # pg_trgm is PostgreSQL only; elsewhere the searches stay sequential scans.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, column in SEARCHED_COLUMNS:
+            # A failed or interrupted concurrent build leaves an INVALID index behind, which IF NOT EXISTS would keep.
+            cursor.execute('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)',
+                           [index_name(table, column)])
+            invalid = cursor.fetchone()
+            if invalid and invalid[0]:
+                cursor.execute('DROP INDEX CONCURRENTLY %s' % index_name(table, column))
+            # Concurrently, so that users can keep logging in and registering while the indexes are built.
+            cursor.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s USING gin (UPPER(%s) gin_trgm_ops)' % (
+                index_name(table, column), table, column))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table, column in SEARCHED_COLUMNS:
+            cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % index_name(table, column))
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('account', '0002_email_max_length'),
+        ('qabel_provider', '0025_profile_admin_filters'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.5 on 2026-10-18 21:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0026_user_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedmail',
+            name='bcc',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='queuedmail',
+            name='extra_headers',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='queuedmail',
+            name='reply_to',
+            field=models.TextField(blank=True),
+        ),
+    ]
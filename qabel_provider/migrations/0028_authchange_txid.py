@@ -0,0 +1,69 @@
+# Generated by Django 2.2.5 on 2026-10-18 21:37
+
+from django.db import migrations, models
+
+# Every change gets the ID of its writing transaction, the first part of the change feed cursor (see changes.py).
+# Existing changes keep 0, so they come first.
+CREATE_TRIGGER = """
+CREATE FUNCTION qabel_provider_authchange_txid() RETURNS trigger AS $$
+BEGIN
+    NEW.txid := txid_current();
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER qabel_provider_authchange_txid BEFORE INSERT ON qabel_provider_authchange
+    FOR EACH ROW EXECUTE PROCEDURE qabel_provider_authchange_txid();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER qabel_provider_authchange_txid ON qabel_provider_authchange;
+DROP FUNCTION qabel_provider_authchange_txid();
+"""
+
+
+def create_trigger(apps, schema_editor):
+    # Elsewhere txid stays 0, see changes.py.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(CREATE_TRIGGER)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(DROP_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0027_queuedmail_headers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='authchange',
+            name='txid',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='authchange',
+            name='kind',
+            field=models.CharField(choices=[('token-created', 'auth token created'), ('token-deleted', 'auth token deleted'), ('user-activated', 'user activated'), ('user-deactivated', 'user deactivated'), ('user-deleted', 'user deleted'), ('email-changed', 'email address changed or confirmed'), ('profile-changed', 'confirmation period or subscribed plan changed'), ('interval-changed', 'plan interval changed'), ('set-plan', 'plan subscription set'), ('add-interval', 'plan interval added'), ('start-interval', 'plan interval started'), ('expired-interval', 'plan interval expired'), ('plan-changed', 'plan quota changed'), ('confirmation-expired', 'confirmation period ended')], max_length=30),
+        ),
+        migrations.AddIndex(
+            model_name='authchange',
+            index=models.Index(fields=['txid', 'id'], name='authchange_feed'),
+        ),
+        migrations.AddIndex(
+            model_name='authchange',
+            index=models.Index(fields=['timestamp'], name='authchange_timestamp'),
+        ),
+        migrations.AddIndex(
+            model_name='authchange',
+            index=models.Index(fields=['user_id', 'kind'], name='authchange_user_kind'),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
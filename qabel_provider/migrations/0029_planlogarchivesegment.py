@@ -0,0 +1,30 @@
+# Generated by Django 2.2.5 on 2026-10-18 21:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0028_authchange_txid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanLogArchiveSegment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('profile_id', models.IntegerField()),
+                ('month', models.DateField()),
+                ('file_name', models.CharField(max_length=200)),
+                ('offset', models.BigIntegerField()),
+                ('length', models.BigIntegerField()),
+                ('entries', models.PositiveIntegerField()),
+            ],
+            bases=(models.Model,),
+        ),
+        migrations.AddIndex(
+            model_name='planlogarchivesegment',
+            index=models.Index(fields=['profile_id', '-month'], name='planlogarchive_profile'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.5 on 2026-10-18 21:56
+
+from django.db import migrations, models
+
+
+def fail_unfinished_user_exports(apps, schema_editor):
+    # Their selection was stored as a pickled query, which is dropped.
+    ExportJob = apps.get_model('qabel_provider', 'ExportJob')
+    (ExportJob.objects.using(schema_editor.connection.alias)
+     .filter(kind__in=('users', 'users-extended'), state__in=('pending', 'running'))
+     .update(state='failed', error='Queued before the export of selected user IDs, please export again'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0029_planlogarchivesegment'),
+    ]
+
+    operations = [
+        migrations.RunPython(fail_unfinished_user_exports, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='query',
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='user_ids',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.5 on 2026-10-18 22:28
+
+import json
+
+from django.db import migrations
+
+
+def move_user_ids_to_parameters(apps, schema_editor):
+    ExportJob = apps.get_model('qabel_provider', 'ExportJob')
+    jobs = ExportJob.objects.using(schema_editor.connection.alias).exclude(user_ids='')
+    for job in jobs.filter(state__in=('pending', 'running')).only('pk', 'user_ids').iterator():
+        ExportJob.objects.using(schema_editor.connection.alias).filter(pk=job.pk).update(
+            parameters=json.dumps({'user_ids': json.loads(job.user_ids)}))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0030_exportjob_user_ids'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_user_ids_to_parameters, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='user_ids',
+        ),
+    ]
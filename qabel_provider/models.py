@@ -1,12 +1,17 @@
 import datetime
+import json
 import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 
 from allauth.account.models import EmailAddress
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, transaction, DatabaseError
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.core.mail import EmailMultiAlternatives
+from django.db import models, transaction, DatabaseError, IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
 from django.utils import timezone
 from django_prometheus.models import ExportModelOperationsMixin
 
@@ -46,16 +51,87 @@ class Profile(models.Model, ExportModelOperationsMixin('profile')):
     # The default value is constructed during the 0014_add_plans database migration.
     subscribed_plan = models.ForeignKey(Plan, default='free', on_delete=models.PROTECT)
 
+    # Denormalized result of the plan property, valid until *effective_until* (if set). Maintained by
+    # update_effective_plan whenever the subscribed plan or a plan interval changes (see plan_interval_changed);
+    # the recompute_effective_plans command rebuilds them for all profiles.
+    effective_plan = models.ForeignKey(Plan, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    effective_until = models.DateTimeField(null=True, blank=True)
+
+    DENORMALIZED_FIELDS = ('effective_plan', 'effective_until')
+
+    # Whether effective_plan and effective_until of this instance are up to date, see plan. Set for instances loaded
+    # from the database and after update_effective_plan.
+    _effective_plan_read = False
+    # subscribed_plan_id as loaded or last saved, see save
+    _saved_subscribed_plan_id = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded(field_names)
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        self._loaded(fields or [field.attname for field in self._meta.concrete_fields])
+
+    def _loaded(self, field_names):
+        if 'effective_plan_id' in field_names and 'effective_until' in field_names:
+            self._effective_plan_read = True
+        if 'subscribed_plan_id' in field_names:
+            self._saved_subscribed_plan_id = self.subscribed_plan_id
+
     @property
     def plan(self):
+        if not self._effective_plan_read:
+            # Only loaded partially or created in Python; read the denormalized columns once, in a single query.
+            stored = Profile.objects.select_related('effective_plan').get(pk=self.pk)
+            self.effective_plan, self.effective_until = stored.effective_plan, stored.effective_until
+            self._effective_plan_read = True
+        if self.effective_plan_id and (self.effective_until is None or timezone.now() <= self.effective_until):
+            return self.effective_plan
         interval = PlanInterval.peek_interval(self)
         if interval:
             return interval.plan
         return self.subscribed_plan
 
+    def update_effective_plan(self):
+        """Recompute and store effective_plan and effective_until from the plan intervals of this profile."""
+        intervals = PlanInterval.objects.filter(profile=self, state__in=('in_use', 'pristine')).order_by('-id')
+        self.effective_plan_id, self.effective_until = effective_plan(self.subscribed_plan_id, intervals)
+        # Setting the ID doesn't invalidate an already loaded plan.
+        self._state.fields_cache.pop('effective_plan', None)
+        self._effective_plan_read = True
+        Profile.objects.filter(pk=self.pk).update(effective_plan=self.effective_plan_id,
+                                                  effective_until=self.effective_until)
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            if self.effective_plan_id is None:
+                self.effective_plan_id = self.subscribed_plan_id
+            super().save(*args, **kwargs)
+            # The denormalized columns are still read on the first access to plan, since the intervals added to a new
+            # profile are saved through other instances.
+            self._saved_subscribed_plan_id = self.subscribed_plan_id
+            return
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            # Don't overwrite the denormalized columns with a possibly stale copy; see update_effective_plan.
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.DENORMALIZED_FIELDS]
+        # Changes of the plan intervals are handled by plan_interval_changed.
+        if update_fields is None and self.subscribed_plan_id == self._saved_subscribed_plan_id:
+            return super().save(*args, **kwargs)
+        if update_fields is not None and 'subscribed_plan' not in update_fields:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.update_effective_plan()
+        self._saved_subscribed_plan_id = self.subscribed_plan_id
+
     def use_plan(self):
-        """Process active use of plan properties."""
-        PlanInterval.get_or_start_interval(self)
+        """Process active use of plan properties. Return the plan interval in use, or None."""
+        return PlanInterval.get_or_start_interval(self)
 
     @property
     def primary_email(self):
@@ -89,39 +165,83 @@ class Profile(models.Model, ExportModelOperationsMixin('profile')):
 
     def check_confirmation_and_send_mail(self) -> bool:
         if not self.is_allowed():
-            # First we commit to the DB as-if we already sent the mail. If that fails, then another concurrent txn
-            # already did this. Then we actually send the mail, if that fails, we rollback the DB manually.
-            # In other words, 2PC between the DB and the mail server.
+            # The confirmation mail is only queued in the outbox (see outbox.py), in the same transaction that updates
+            # the mail state. Either both are committed or neither is; the mail itself is sent in the background.
+            # This instance may have been read from a replica (see resolver), the mail state is always read and written
+            # on the primary database.
             try:
-                with transaction.atomic():
-                    self.refresh_from_db()
-                    send_mail = not self.was_email_sent_last_24_hours()
-                    if send_mail:
-                        # Store original timestamp, so we can rollback manually
-                        original_next_confirmation_mail = self.next_confirmation_mail
+                with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                    self.refresh_from_db(using=DEFAULT_DB_ALIAS)
+                    if not self.was_email_sent_last_24_hours():
                         self.set_next_mail_date()
-                        self.save()
+                        self.save(using=DEFAULT_DB_ALIAS)
+                        self.send_confirmation_mail()
             except DatabaseError as exc:
                 logger.warning('check_confirmation_and_send_mail: raced transaction, assuming it worked for the other end: %s', str(exc))
-                # Raced commit, someone else send it already.
-                return True
-            if send_mail:
-                try:
-                    self.send_confirmation_mail()
-                except Exception:
-                    logger.exception('Failed to send confirmation mail to user %d, email %r', self.user.pk, self.primary_email)
-                    # Rollback!
-                    with transaction.atomic():
-                        self.next_confirmation_mail = original_next_confirmation_mail
-                        self.save()
+                # Raced commit, someone else queued it already.
             return True
         return False
 
     def send_confirmation_mail(self):
         mail = self.primary_email
-        logger.info('Sending confirmation mail to %r', mail.email)
+        if mail is None:
+            logger.warning('User %d has no primary email address to send a confirmation mail to', self.user.pk)
+            return
         mail.send_confirmation(signup=False)
-        logger.info('Sent confirmation mail to %r', mail.email)
+        logger.info('Queued confirmation mail to %r', mail.email)
+
+    class Meta:
+        # Back the filters of the user admin. Only few profiles have the notification flags set.
+        indexes = [
+            models.Index(fields=['plus_notification_mail'], name='profile_plus_notification',
+                         condition=models.Q(plus_notification_mail=True)),
+            models.Index(fields=['pro_notification_mail'], name='profile_pro_notification',
+                         condition=models.Q(pro_notification_mail=True)),
+            models.Index(fields=['next_confirmation_mail'], name='profile_next_confirmation_mail'),
+            models.Index(fields=['needs_confirmation_after'], name='profile_needs_confirmation'),
+        ]
+
+
+def effective_plan(subscribed_plan_id, intervals):
+    """
+    Return ``(plan_id, until)`` for the plan of a profile subscribed to *subscribed_plan_id*, given its in use and
+    pristine *intervals* (most recent first). *until* is the expiry of the interval in use, or None.
+    """
+    intervals = list(intervals)
+    for interval in intervals:
+        if interval.state == 'in_use':
+            return interval.plan_id, interval.expires_at
+    for interval in intervals:
+        if interval.state == 'pristine':
+            return interval.plan_id, None
+    return subscribed_plan_id, None
+
+
+def update_effective_plans(profiles):
+    """
+    Recompute the effective plan of *profiles* with one query for their intervals and one bulk update.
+
+    Return the number of profiles that changed.
+    """
+    profiles = list(profiles)
+    intervals = defaultdict(list)
+    usable_intervals = (
+        PlanInterval.objects
+        .filter(profile__in=profiles, state__in=('in_use', 'pristine'))
+        .only('profile', 'plan', 'state', 'expires_at')
+        .order_by('-id')
+    )
+    for interval in usable_intervals:
+        intervals[interval.profile_id].append(interval)
+
+    changed = []
+    for profile in profiles:
+        plan_id, until = effective_plan(profile.subscribed_plan_id, intervals[profile.pk])
+        if (plan_id, until) != (profile.effective_plan_id, profile.effective_until):
+            profile.effective_plan_id, profile.effective_until = plan_id, until
+            changed.append(profile)
+    Profile.objects.bulk_update(changed, Profile.DENORMALIZED_FIELDS)
+    return len(changed)
 
 
 class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
@@ -142,6 +262,12 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
 
     # Use started at <timestamp>
     started_at = models.DateTimeField(null=True, blank=True)
+    # started_at + duration, stored so that due intervals can be found with an index. Set by save() and try_start.
+    expires_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.expires_at = self.started_at + self.duration if self.started_at else None
+        return super().save(*args, **kwargs)
 
     def check_expiry(self):
         """
@@ -154,13 +280,12 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
         elif self.state == 'expired':
             logger.warning('PlanInterval.check_expiry on expired interval.')
             return
-        if timezone.now() > (self.started_at + self.duration):
+        if timezone.now() > self.expires_at:
             self.state = 'expired'
-            audit_log = ProfilePlanLog(profile=self.profile,
-                                       action='expired-interval', plan=self.plan, interval=self)
-            with transaction.atomic():
+            with ProfilePlanLog.objects.buffered():
                 self.save()
-                audit_log.save()
+                ProfilePlanLog.objects.log(profile=self.profile, action='expired-interval', plan=self.plan,
+                                           interval=self)
             return
         return self
 
@@ -170,11 +295,40 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
             raise ValueError('Cannot start using a %s interval' % self.state)
         self.state = 'in_use'
         self.started_at = timezone.now()
-        audit_log = ProfilePlanLog(profile=self.profile,
-                                   action='start-interval', plan=self.plan, interval=self)
-        with transaction.atomic():
+        with ProfilePlanLog.objects.buffered():
             self.save()
-            audit_log.save()
+            ProfilePlanLog.objects.log(profile=self.profile, action='start-interval', plan=self.plan, interval=self)
+
+    def try_start(self):
+        """
+        Start using this interval if it is still pristine in the database. Return whether this call started it.
+
+        Unlike start() this is a single conditional UPDATE, which is safe against concurrent callers without
+        locking, since only one of them can win the state transition.
+        """
+        started_at = timezone.now()
+        return self._transition('pristine', 'start-interval', state='in_use', started_at=started_at,
+                                expires_at=started_at + self.duration)
+
+    def try_expire(self):
+        """Mark this interval as expired if it is still in use in the database. Return whether this call did."""
+        return self._transition('in_use', 'expired-interval', state='expired')
+
+    def _transition(self, from_state, action, **fields):
+        try:
+            with ProfilePlanLog.objects.buffered():
+                updated = PlanInterval.objects.filter(pk=self.pk, state=from_state).update(**fields)
+                if not updated:
+                    return False
+                ProfilePlanLog.objects.log(profile=self.profile, action=action, plan=self.plan, interval=self)
+                # A queryset update doesn't send post_save, see plan_interval_changed.
+                self.profile.update_effective_plan()
+        except IntegrityError:
+            # Another interval of the profile was started concurrently (see the planinterval_one_in_use constraint).
+            return False
+        for name, value in fields.items():
+            setattr(self, name, value)
+        return True
 
     @classmethod
     def peek_interval(model, profile):
@@ -202,11 +356,17 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
         except ObjectDoesNotExist:
             return
         else:
+            # So that state changes update the effective plan of this very instance
+            interval.profile = profile
             return interval.check_expiry()
 
     @classmethod
     def _get_pristine_interval(model, profile):
-        return model.objects.filter(profile=profile, state='pristine').first()
+        # The most recently added pristine interval is used first.
+        interval = model.objects.filter(profile=profile, state='pristine').order_by('-id').first()
+        if interval:
+            interval.profile = profile
+        return interval
 
     @classmethod
     def _start_interval(model, profile):
@@ -224,16 +384,154 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
         index_together = [
             ['profile', 'state'],
         ]
-        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['expires_at'], name='planinterval_in_use_expiry',
+                         condition=models.Q(state='in_use')),
+            models.Index(fields=['profile', '-id'], name='planinterval_pristine',
+                         condition=models.Q(state='pristine')),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['profile'], name='planinterval_one_in_use',
+                                    condition=models.Q(state='in_use')),
+        ]
+
+
+class RequestOrigin(models.Model, ExportModelOperationsMixin('requestorigin')):
+    """A distinct request origin (see utils.get_request_origin) of ProfilePlanLog entries."""
+    value = models.CharField(max_length=200, unique=True)
+
+    # value -> id of committed origins
+    _ids = {}
+    MAX_CACHED_IDS = 10000
+
+    @classmethod
+    def ids_for(cls, values):
+        """Return a dict mapping each of *values* to the ID of its RequestOrigin, creating missing ones."""
+        ids = {value: cls._ids[value] for value in values if value in cls._ids}
+        missing = set(values) - set(ids)
+        if missing:
+            cls.objects.bulk_create([cls(value=value) for value in missing], ignore_conflicts=True)
+            created = dict(cls.objects.filter(value__in=missing).values_list('value', 'id'))
+            ids.update(created)
+
+            def remember():
+                if len(cls._ids) > cls.MAX_CACHED_IDS:
+                    cls._ids.clear()
+                cls._ids.update(created)
+            # Only once committed; the IDs of rolled back origins must not be reused.
+            transaction.on_commit(remember)
+        return ids
+
+    def __str__(self):
+        return self.value
+
+
+class PlanLogActionField(models.PositiveSmallIntegerField):
+    """The action of a ProfilePlanLog entry: a string in Python, stored as a small integer."""
+    # Append only, the codes are stored.
+    CODES = {
+        'set-plan': 1,
+        'add-interval': 2,
+        'start-interval': 3,
+        'expired-interval': 4,
+    }
+    NAMES = {code: name for name, code in CODES.items()}
+
+    @property
+    def validators(self):
+        # The integer range validators don't apply to the Python values.
+        return self._validators
+
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return self.NAMES[value]
+
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            try:
+                value = self.CODES[value]
+            except KeyError:
+                raise ValueError('Unknown plan log action %r' % value)
+        return super().get_prep_value(value)
+
+
+_plan_log_buffer = threading.local()
+
+# Sent with the list of *entries* after ProfilePlanLog.objects.log() wrote them, in the writing transaction.
+plan_logs_written = Signal(providing_args=['entries'])
+
+
+class ProfilePlanLogManager(models.Manager):
+    def log(self, **fields):
+        """
+        Append a log entry with *fields*. Within buffered() it is written when the outermost buffered() block exits,
+        otherwise right away. The *origin* is given as a string.
+        """
+        origin = fields.pop('origin', '')
+        entry = self.model(**fields)
+        entry.origin_value = origin
+        entries = getattr(_plan_log_buffer, 'entries', None)
+        if entries is None:
+            self._write([entry])
+        else:
+            entries.append(entry)
+        return entry
+
+    @contextmanager
+    def buffered(self):
+        """
+        Atomic block collecting the entries passed to log(). They are written with one bulk_create at the end of the
+        outermost block, before its transaction commits. Entries logged in a nested block that raised are discarded,
+        like its savepoint.
+        """
+        entries = getattr(_plan_log_buffer, 'entries', None)
+        if entries is not None:
+            mark = len(entries)
+            try:
+                with transaction.atomic():
+                    yield
+            except BaseException:
+                del entries[mark:]
+                raise
+            return
+        _plan_log_buffer.entries = entries = []
+        try:
+            with transaction.atomic():
+                yield
+                _plan_log_buffer.entries = None
+                self._write(entries)
+        finally:
+            _plan_log_buffer.entries = None
+
+    def _write(self, entries):
+        if any(entry.pk is not None for entry in entries):
+            raise ValueError('Cannot modify existing ProfilePlanLog entry.')
+        with transaction.atomic():
+            origins = RequestOrigin.ids_for({entry.origin_value for entry in entries if entry.origin_value})
+            for entry in entries:
+                entry.origin_id = origins.get(entry.origin_value)
+            self.bulk_create(entries)
+            # bulk_create sends no post_save signals
+            plan_logs_written.send(sender=self.model, entries=entries)
 
 
 class ProfilePlanLog(models.Model, ExportModelOperationsMixin('profileplanlog')):
+    """
+    Append-only audit log of plan events. Write entries with ProfilePlanLog.objects.log(), batching them with
+    ProfilePlanLog.objects.buffered().
+    """
     profile = models.ForeignKey(Profile, on_delete=models.PROTECT)
     timestamp = models.DateTimeField(auto_now_add=True)
-    action = models.CharField(max_length=100)
+    action = PlanLogActionField()
     plan = models.ForeignKey(Plan, on_delete=models.PROTECT)
     interval = models.ForeignKey(PlanInterval, blank=True, null=True, on_delete=models.PROTECT)
 
+    objects = ProfilePlanLogManager()
+
     def save(self, *args, **kwargs):
         if self.id is None:
             return super().save(*args, **kwargs)
@@ -242,8 +540,9 @@ class ProfilePlanLog(models.Model, ExportModelOperationsMixin('profileplanlog'))
     def delete(self, *args, **kwargs):
         raise ValueError('Cannot delete ProfilePlanLog entry.')
 
-    # A JsonField may be a slightly better choice here.
-    origin = models.CharField(max_length=200, verbose_name='Request origin')
+    # Empty origins are stored as NULL.
+    origin = models.ForeignKey(RequestOrigin, null=True, blank=True, on_delete=models.PROTECT,
+                               verbose_name='Request origin', related_name='+')
 
     def __str__(self):
         return ''
@@ -253,9 +552,218 @@ class ProfilePlanLog(models.Model, ExportModelOperationsMixin('profileplanlog'))
             ['timestamp'],
             ['profile']
         ]
+        indexes = [
+            # History pages, see history.py
+            models.Index(fields=['profile', '-timestamp', '-id'], name='profileplanlog_history'),
+        ]
         ordering = ['-timestamp']
 
 
+class PlanLogArchiveSegment(models.Model, ExportModelOperationsMixin('planlogarchivesegment')):
+    """
+    The archived log entries of a profile for one month: a gzip member of *length* bytes at *offset* of an archive
+    file (see plan_log_archive), so that they can be read without decompressing the whole month.
+    """
+    # Plain value instead of a foreign key, like the archived entries themselves.
+    profile_id = models.IntegerField()
+    month = models.DateField()
+    # Relative to PLAN_LOG_ARCHIVE_DIR
+    file_name = models.CharField(max_length=200)
+    offset = models.BigIntegerField()
+    length = models.BigIntegerField()
+    entries = models.PositiveIntegerField()
+
+    def __str__(self):
+        return '%s@%d' % (self.file_name, self.offset)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['profile_id', '-month'], name='planlogarchive_profile'),
+        ]
+
+
+class QueuedMail(models.Model, ExportModelOperationsMixin('queuedmail')):
+    """
+    A mail in the outbox. Written in the transaction that decided to send it, sent by the send_queued_mail command.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    from_email = models.CharField(max_length=254)
+    # Newline separated addresses
+    to = models.TextField()
+    cc = models.TextField(blank=True)
+    bcc = models.TextField(blank=True)
+    reply_to = models.TextField(blank=True)
+    # JSON object of additional headers
+    extra_headers = models.TextField(blank=True)
+    subject = models.TextField()
+    body = models.TextField()
+    body_subtype = models.CharField(max_length=20, default='plain')
+    html_body = models.TextField(blank=True)
+
+    send_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Return an unsaved QueuedMail for the EmailMessage *message*.
+
+        Raise ValueError if *message* has attachments or alternatives other than one HTML body, which can't be queued.
+        """
+        alternatives = getattr(message, 'alternatives', ())
+        if message.attachments:
+            raise ValueError('Mails with attachments cannot be queued')
+        if len(alternatives) > 1 or any(mimetype != 'text/html' for content, mimetype in alternatives):
+            raise ValueError('Only mails with (at most) one HTML alternative can be queued')
+        return cls(
+            from_email=message.from_email,
+            to='\n'.join(message.to),
+            cc='\n'.join(message.cc),
+            bcc='\n'.join(message.bcc),
+            reply_to='\n'.join(message.reply_to),
+            extra_headers=json.dumps(message.extra_headers) if message.extra_headers else '',
+            subject=message.subject,
+            body=message.body,
+            body_subtype=message.content_subtype,
+            html_body=alternatives[0][0] if alternatives else '',
+        )
+
+    def to_message(self):
+        def addresses(value):
+            return value.split('\n') if value else None
+        message = EmailMultiAlternatives(self.subject, self.body, self.from_email, addresses(self.to),
+                                         cc=addresses(self.cc), bcc=addresses(self.bcc),
+                                         reply_to=addresses(self.reply_to),
+                                         headers=json.loads(self.extra_headers) if self.extra_headers else None)
+        message.content_subtype = self.body_subtype
+        if self.html_body:
+            message.attach_alternative(self.html_body, 'text/html')
+        return message
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        index_together = [
+            ['sent_at', 'send_after'],
+        ]
+
+
+class AuthChange(models.Model, ExportModelOperationsMixin('authchange')):
+    """
+    A change that may affect the answer of the auth resource for a user (or all subscribers of a plan).
+
+    (txid, id) is the cursor of the change feed (see changes.feed). Rows are written by the signal handlers in
+    changes.py, in the transaction making the change.
+    """
+    id = models.BigAutoField(primary_key=True)
+    # ID of the writing transaction, set by a trigger on PostgreSQL (see migration 0028_authchange_txid)
+    txid = models.BigIntegerField(default=0, editable=False)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    KINDS = (
+        ('token-created', 'auth token created'),
+        ('token-deleted', 'auth token deleted'),
+        ('user-activated', 'user activated'),
+        ('user-deactivated', 'user deactivated'),
+        ('user-deleted', 'user deleted'),
+        ('email-changed', 'email address changed or confirmed'),
+        ('profile-changed', 'confirmation period or subscribed plan changed'),
+        ('interval-changed', 'plan interval changed'),
+        ('set-plan', 'plan subscription set'),
+        ('add-interval', 'plan interval added'),
+        ('start-interval', 'plan interval started'),
+        ('expired-interval', 'plan interval expired'),
+        ('plan-changed', 'plan quota changed'),
+        ('confirmation-expired', 'confirmation period ended'),
+    )
+    kind = models.CharField(choices=KINDS, max_length=30)
+    # Plain values instead of foreign keys, so that changes outlive deleted users.
+    user_id = models.IntegerField(null=True, blank=True)
+    plan_id = models.CharField(max_length=50, blank=True)
+
+    def __str__(self):
+        return self.kind
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['txid', 'id'], name='authchange_feed'),
+            models.Index(fields=['timestamp'], name='authchange_timestamp'),
+            models.Index(fields=['user_id', 'kind'], name='authchange_user_kind'),
+        ]
+
+
+class ExportJob(models.Model, ExportModelOperationsMixin('exportjob')):
+    """
+    An export running in the background (see export_jobs), for selections too large to stream from a web worker.
+
+    Created by the admin, run by the run_export_jobs command, which writes the result to a compressed file in
+    EXPORT_JOB_DIR.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+
+    KINDS = (
+        ('users', 'users with confirmed address'),
+        ('users-extended', 'users with plan and confirmation state'),
+        ('plan-log', 'plan log'),
+    )
+    kind = models.CharField(choices=KINDS, max_length=20)
+    # JSON encoded selection for user exports (see export_jobs.queue_user_export), filters and output format for plan
+    # log exports (see plan_log_export.export)
+    parameters = models.TextField(blank=True)
+
+    STATES = (
+        ('pending', 'pending'),
+        ('running', 'running'),
+        ('done', 'done'),
+        ('failed', 'failed'),
+    )
+    state = models.CharField(choices=STATES, max_length=20, default='pending')
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Last sign of life of a running job; jobs without one for EXPORT_JOB_STALE_AFTER seconds are run again
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    processed = models.PositiveIntegerField(default=0)
+    written = models.PositiveIntegerField(default=0)
+    # Relative to EXPORT_JOB_DIR
+    file_name = models.CharField(max_length=200, blank=True)
+    error = models.TextField(blank=True)
+
+    @property
+    def progress(self):
+        """Percentage of processed rows, None if the total is not known yet."""
+        if self.state == 'done':
+            return 100
+        if not self.total:
+            return None
+        return min(100, self.processed * 100 // self.total)
+
+    def __str__(self):
+        return '%s (%s)' % (self.get_kind_display(), self.created_at)
+
+    class Meta:
+        index_together = [
+            ['state', 'created_at'],
+        ]
+
+
+@receiver((post_save, post_delete), sender=PlanInterval)
+def plan_interval_changed(sender, instance, **kwargs):
+    # Intervals are also added and changed outside of the API, e.g. in the admin.
+    try:
+        profile = instance.profile
+    except Profile.DoesNotExist:
+        # Deleted along with its profile
+        return
+    profile.update_effective_plan()
+
+
 @receiver(post_save, sender=User)
 def create_profile_for_new_user(sender, created, instance, **kwargs):
     if created:
@@ -1,34 +1,171 @@
+"""
+Business metrics for Prometheus: numbers of profiles and plan intervals, and subscriptions by plan.
+
+Scrapes don't query the database. The collector serves the statistics last stored in the default cache, which all
+workers share. When they are older than METRICS_REFRESH_INTERVAL seconds, the scrape starts a refresh in a background
+thread; a lock in the cache makes sure that only one worker runs the aggregate queries at a time. The
+business_metrics_age_seconds gauge tells how old the served values are.
+
+AUTH_PHASE_SECONDS and API_OUTCOMES break the answers of the auth resource (and its batch and ticket variants) down
+into phases and outcomes, beyond the whole-view latency of django_prometheus. VIEW_QUERIES and VIEW_QUERY_SECONDS
+are the number of SQL queries and the database time per request (see middleware.QueryMetricsMiddleware), BLOCK_*
+the requests to the block server (see block.request).
+
+registry() is what views.metrics exports.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.db.models import Count
-from prometheus_client.core import CounterMetricFamily, REGISTRY
+from prometheus_client import Counter, Histogram, multiprocess
+from prometheus_client.core import CollectorRegistry, CounterMetricFamily, GaugeMetricFamily, REGISTRY
 
+from . import prometheus_multiprocess
 from .models import Profile, PlanInterval, Plan
 
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'business-metrics'
+LOCK_KEY = 'business-metrics-refreshing'
+
+AUTH_PHASES = (
+    'api_key',          # views.check_api_key, for views.AUTH_VIEWS only
+    'cache',            # auth_cache lookups and stores
+    'lookup',           # resolver: profiles by token or user ID
+    'plan_resolution',  # resolver: usable plan intervals
+    'plan_activation',  # resolver.use_interval: starting and expiring intervals
+    'confirmation',     # resolver: confirmation check and mail (Profile.check_confirmation_and_send_mail)
+)
+AUTH_PHASE_SECONDS = Histogram(
+    'auth_phase_seconds', 'Time spent in the phases of answering the auth resource, by phase', ['phase'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, float('inf')))
+API_OUTCOMES = Counter(
+    'api_outcomes', 'Answers of the internal API by view and outcome (active, inactive, bad_request, '
+    'invalid_api_key, unknown_user)', ['view', 'outcome'])
+for phase in AUTH_PHASES:
+    AUTH_PHASE_SECONDS.labels(phase)
+
+# Recorded by middleware.QueryMetricsMiddleware
+VIEW_QUERIES = Histogram(
+    'view_queries', 'SQL queries per request, by view', ['view'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')))
+VIEW_QUERY_SECONDS = Histogram(
+    'view_query_seconds', 'Time spent in the database per request, by view', ['view'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, float('inf')))
+
+# Recorded by block.request
+BLOCK_REQUEST_SECONDS = Histogram(
+    'block_request_seconds', 'Latency of the requests to the block server (including retries), by path', ['path'])
+BLOCK_RESPONSES = Counter(
+    'block_responses', 'Responses of the block server by path and status code', ['path', 'status'])
+BLOCK_ERRORS = Counter(
+    'block_errors', 'Failed requests to the block server (no response) by path and error', ['path', 'error'])
+
+
+def phase_timer(phase):
+    """Context manager measuring the time of an auth resource *phase* (see AUTH_PHASES)."""
+    return AUTH_PHASE_SECONDS.labels(phase).time()
+
+
+def count_outcome(view, outcome, count=1):
+    API_OUTCOMES.labels(view, outcome).inc(count)
+
+
+def aggregate():
+    """Compute the statistics: one aggregate query over the profiles and a count of the plan intervals."""
+    subscriptions = dict.fromkeys(Plan.objects.values_list('id', flat=True), 0)
+    subscriptions.update(Profile.objects.order_by().values_list('subscribed_plan').annotate(Count('pk')))
+    return {
+        'profiles': sum(subscriptions.values()),
+        'plan_intervals': PlanInterval.objects.count(),
+        'subscriptions': subscriptions,
+        'refreshed_at': time.time(),
+    }
+
+
+def refresh():
+    """Compute and store the statistics. Return them."""
+    stats = aggregate()
+    cache.set(STATS_KEY, stats, timeout=None)
+    return stats
+
+
+def _refresh_and_unlock():
+    try:
+        refresh()
+    except Exception:
+        logger.exception('Failed to refresh the business metrics')
+    finally:
+        cache.delete(LOCK_KEY)
+        # The connection belongs to this thread and would stay open otherwise.
+        connection.close()
+
+
+def refresh_in_background():
+    """Start a refresh in a background thread, unless another one (in any worker) is running."""
+    # The lock expires by itself, should a worker die while refreshing.
+    if not cache.add(LOCK_KEY, True, timeout=max(settings.METRICS_REFRESH_INTERVAL, 60)):
+        return None
+    thread = threading.Thread(target=_refresh_and_unlock, name='business-metrics-refresh', daemon=True)
+    thread.start()
+    return thread
+
 
 class ProfileStatsCollector:
-    def profile(self):
+    def profile(self, stats):
         c = CounterMetricFamily('profile_count', 'Number of profiles')
-        c.add_metric([], Profile.objects.count())
+        c.add_metric([], stats['profiles'])
         yield c
 
-    def plan_interval(self):
+    def plan_interval(self, stats):
         c = CounterMetricFamily('plan_intervals_count', 'Number of plan intervals')
-        c.add_metric([], PlanInterval.objects.count())
+        c.add_metric([], stats['plan_intervals'])
         yield c
 
-    def subscriptions(self):
+    def subscriptions(self, stats):
         c = CounterMetricFamily('subscriptions_count', 'Subscriptions by plan', labels=['plan'])
-        plans = Plan.objects.annotate(Count('profile'))
-        for plan in plans:
-            c.add_metric([plan.id], plan.profile__count)
+        for plan, count in sorted(stats['subscriptions'].items()):
+            c.add_metric([plan], count)
         yield c
 
+    def age(self, stats):
+        g = GaugeMetricFamily('business_metrics_age_seconds',
+                              'Seconds since the profile, plan interval and subscription counts were computed')
+        g.add_metric([], time.time() - stats['refreshed_at'] if stats else float('inf'))
+        yield g
+
     def collect(self):
-        yield from self.profile()
-        yield from self.plan_interval()
-        yield from self.subscriptions()
+        stats = cache.get(STATS_KEY)
+        if stats is None or time.time() - stats['refreshed_at'] > settings.METRICS_REFRESH_INTERVAL:
+            refresh_in_background()
+        if stats is not None:
+            yield from self.profile(stats)
+            yield from self.plan_interval(stats)
+            yield from self.subscriptions(stats)
+        yield from self.age(stats)
 
     def describe(self):
         return []
 
 
-REGISTRY.register(ProfileStatsCollector())
+collector = ProfileStatsCollector()
+REGISTRY.register(collector)
+
+
+def registry():
+    """
+    Return the registry to export: the aggregate of the metrics of all workers in multiprocess mode (see
+    prometheus_multiprocess), REGISTRY otherwise.
+    """
+    if not prometheus_multiprocess.enabled():
+        return REGISTRY
+    aggregate_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(aggregate_registry)
+    # Served from the cache, so the same in all workers
+    aggregate_registry.register(collector)
+    return aggregate_registry
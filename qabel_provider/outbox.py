@@ -0,0 +1,104 @@
+"""
+Transactional mail outbox.
+
+Mails are not sent from within requests. enqueue() stores them as QueuedMail rows in the current database
+transaction, so they are only sent if that transaction commits. The send_queued_mail management command sends them
+over one reused connection, retrying failed mails with exponential backoff. Mails are leased to a sender in a short
+transaction and sent outside of it.
+"""
+
+import datetime
+import logging
+from smtplib import SMTPRecipientsRefused
+
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import QueuedMail
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 10
+BASE_BACKOFF = datetime.timedelta(minutes=1)
+MAX_BACKOFF = datetime.timedelta(hours=6)
+# How long claimed mails are reserved for the sending sender
+LEASE = datetime.timedelta(minutes=10)
+
+
+def enqueue(message):
+    """Queue the EmailMessage *message* for sending. Return the QueuedMail."""
+    queued = QueuedMail.from_message(message)
+    queued.save()
+    logger.info('Queued mail %d to %r', queued.pk, message.to)
+    return queued
+
+
+def backoff(attempts):
+    # The exponent is capped to keep the timedelta from overflowing.
+    return min(MAX_BACKOFF, BASE_BACKOFF * 2 ** min(attempts - 1, 20))
+
+
+def claim(batch_size, now):
+    """
+    Lease up to *batch_size* mails due at *now* to this sender and return them.
+
+    The mails are claimed in a short transaction by pushing send_after LEASE into the future, so that no transaction
+    stays open while talking to the mail server. If the sender dies, they become due again once the lease ends.
+    """
+    with transaction.atomic():
+        due = list(
+            QueuedMail.objects
+            .select_for_update(skip_locked=True)
+            .filter(sent_at=None, send_after__lte=now, attempts__lt=MAX_ATTEMPTS)
+            .order_by('send_after')[:batch_size]
+        )
+        # Counted as an attempt right away, so that a mail crashing the sender is given up on eventually.
+        QueuedMail.objects.filter(pk__in=[queued.pk for queued in due]).update(
+            send_after=now + LEASE, attempts=F('attempts') + 1)
+    for queued in due:
+        queued.attempts += 1
+    return due
+
+
+def send_queued(batch_size=100):
+    """
+    Send up to *batch_size* due mails over one connection. Return the number of mails sent.
+
+    The mails are leased (see claim) before they are sent, so multiple senders can run concurrently.
+    """
+    due = claim(batch_size, timezone.now())
+    if not due:
+        return 0
+    sent = 0
+    connection = get_connection()
+    try:
+        for queued in due:
+            message = queued.to_message()
+            message.connection = connection
+            try:
+                message.send()
+            except Exception as exc:
+                # The connection may be broken now; it is reopened for the next message.
+                connection.close()
+                queued.last_error = repr(exc)
+                if isinstance(exc, SMTPRecipientsRefused):
+                    # Retrying won't help with addresses the server refuses.
+                    queued.attempts = MAX_ATTEMPTS
+                queued.send_after = timezone.now() + backoff(queued.attempts)
+                if queued.attempts >= MAX_ATTEMPTS:
+                    logger.error('Giving up on mail %d to %r: %s', queued.pk, message.to, queued.last_error)
+                else:
+                    logger.warning('Failed to send mail %d to %r, retrying at %s: %s',
+                                   queued.pk, message.to, queued.send_after, queued.last_error)
+                QueuedMail.objects.filter(pk=queued.pk).update(
+                    attempts=queued.attempts, last_error=queued.last_error, send_after=queued.send_after)
+            else:
+                queued.sent_at = timezone.now()
+                QueuedMail.objects.filter(pk=queued.pk).update(sent_at=queued.sent_at)
+                sent += 1
+    finally:
+        connection.close()
+    logger.info('Sent %d of %d queued mails', sent, len(due))
+    return sent
@@ -0,0 +1,237 @@
+"""
+Monthly partitions and cold archive of the ProfilePlanLog.
+
+On PostgreSQL the log table is partitioned by month of its timestamp (see migration 0021), with a default partition
+for rows outside of all monthly partitions. ensure_partitions() creates the partitions of the coming months.
+
+archive() moves whole months of the log into gzip compressed JSONL files in PLAN_LOG_ARCHIVE_DIR, one or more files
+per month, and drops their partitions (or deletes the rows on databases without partitioning). Each profile's entries
+are a separate gzip member of the file, indexed by a PlanLogArchiveSegment; archived_entries() reads back only the
+members of one profile for views.user_history.
+
+The archive_plan_log management command does both and is meant to run monthly.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_duration
+from django.utils.duration import duration_string
+
+from .models import Plan, PlanInterval, PlanLogArchiveSegment, ProfilePlanLog, RequestOrigin
+
+logger = logging.getLogger(__name__)
+
+TABLE = ProfilePlanLog._meta.db_table
+FILE_PREFIX = 'profileplanlog-'
+
+
+def month_start(timestamp):
+    timestamp = timezone.localtime(timestamp) if timezone.is_aware(timestamp) else timezone.make_aware(timestamp)
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(month):
+    return timezone.make_aware(datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1))
+
+
+def partition_name(month):
+    return '%s_y%04dm%02d' % (TABLE, month.year, month.month)
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass", [TABLE])
+        return cursor.fetchone()[0]
+
+
+def partition_exists(month):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [partition_name(month)])
+        return cursor.fetchone()[0]
+
+
+def create_partition(month):
+    """Create the partition for *month*, moving its rows out of the default partition."""
+    qn = connection.ops.quote_name
+    name, parent, default = qn(partition_name(month)), qn(TABLE), qn(TABLE + '_default')
+    bounds = [month, next_month(month)]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS)'.format(name=name, parent=parent))
+        cursor.execute('WITH moved AS (DELETE FROM {default} WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *) '
+                       'INSERT INTO {name} SELECT * FROM moved'.format(name=name, default=default), bounds)
+        cursor.execute('ALTER TABLE {parent} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)'.format(
+            name=name, parent=parent), bounds)
+    logger.info('Created plan log partition %s', partition_name(month))
+
+
+def ensure_partitions(months_ahead=3, now=None):
+    """Create the missing partitions from the current month up to *months_ahead* months ahead."""
+    if not is_partitioned():
+        return
+    month = month_start(now or timezone.now())
+    for i in range(months_ahead + 1):
+        if not partition_exists(month):
+            create_partition(month)
+        month = next_month(month)
+
+
+def archive_directory():
+    return settings.PLAN_LOG_ARCHIVE_DIR
+
+
+def _archive_file(directory, month):
+    """Return the name of a new archive file for *month*. Months archived again get additional files."""
+    base = os.path.join(directory, '%s%04d-%02d' % (FILE_PREFIX, month.year, month.month))
+    path, n = base + '.jsonl.gz', 1
+    while os.path.exists(path):
+        path, n = '%s.%d.jsonl.gz' % (base, n), n + 1
+    return path
+
+
+def _write_segments(raw, entries):
+    """
+    Write *entries* (ordered by profile) to the binary file *raw*, one gzip member per profile.
+
+    Return unsaved PlanLogArchiveSegments (without file_name and month) of the members.
+    """
+    segments = []
+    member = segment = None
+    for entry in entries:
+        if segment is None or entry['profile_id'] != segment.profile_id:
+            if member:
+                member.close()
+                segment.length = raw.tell() - segment.offset
+            segment = PlanLogArchiveSegment(profile_id=entry['profile_id'], offset=raw.tell(), entries=0)
+            segments.append(segment)
+            # Closing the GzipFile finishes the member, but leaves *raw* open.
+            member = gzip.GzipFile(fileobj=raw, mode='wb')
+        duration = entry.pop('interval__duration')
+        entry['origin'] = entry.pop('origin__value') or ''
+        entry['timestamp'] = entry['timestamp'].isoformat()
+        entry['interval_duration'] = duration_string(duration) if duration is not None else None
+        member.write(json.dumps(entry, sort_keys=True).encode() + b'\n')
+        segment.entries += 1
+    if member:
+        member.close()
+        segment.length = raw.tell() - segment.offset
+    return segments
+
+
+def archive_month(month, directory=None):
+    """
+    Write the log entries of *month* to a new archive file and remove them from the database.
+
+    Return the number of archived entries.
+    """
+    directory = directory or archive_directory()
+    os.makedirs(directory, exist_ok=True)
+    entries = (ProfilePlanLog.objects
+               .filter(timestamp__gte=month, timestamp__lt=next_month(month))
+               .order_by('profile', 'timestamp', 'id')
+               .values('id', 'profile_id', 'timestamp', 'action', 'plan_id', 'interval_id', 'interval__duration',
+                       'origin__value'))
+    path = _archive_file(directory, month)
+    # Written under a temporary name first, so that readers never see partial files.
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            segments = _write_segments(raw, entries.iterator())
+            raw.flush()
+            os.fsync(raw.fileno())
+        if not segments:
+            os.unlink(temporary)
+            return 0
+        os.rename(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+    for segment in segments:
+        segment.file_name = os.path.basename(path)
+        segment.month = month.date()
+    with transaction.atomic():
+        PlanLogArchiveSegment.objects.bulk_create(segments)
+        if is_partitioned() and partition_exists(month):
+            qn = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (qn(TABLE), qn(partition_name(month))))
+                cursor.execute('DROP TABLE %s' % qn(partition_name(month)))
+        else:
+            # QuerySet.delete() does not go through ProfilePlanLog.delete(), which refuses to delete single entries.
+            ProfilePlanLog.objects.filter(timestamp__gte=month, timestamp__lt=next_month(month)).delete()
+    count = sum(segment.entries for segment in segments)
+    logger.info('Archived %d plan log entries of %s to %s', count, month.strftime('%Y-%m'), path)
+    return count
+
+
+def archive(before, directory=None):
+    """Archive all months before the month of *before*. Return the number of archived entries."""
+    before = month_start(before)
+    months = ProfilePlanLog.objects.filter(timestamp__lt=before).datetimes('timestamp', 'month')
+    return sum(archive_month(month_start(month), directory) for month in months)
+
+
+def _read_segment(directory, segment):
+    with open(os.path.join(directory, segment.file_name), 'rb') as file:
+        file.seek(segment.offset)
+        data = gzip.decompress(file.read(segment.length))
+    return [json.loads(line) for line in data.decode().splitlines()]
+
+
+def archived_entries(profile_id, before=None, limit=None, directory=None):
+    """
+    Return the archived log entries of *profile_id* as unsaved ProfilePlanLog instances, most recent first: those
+    before the (timestamp, id) position *before*, if given, and at most *limit* of them.
+
+    Months are read newest first, until *limit* entries are found. Their plan and interval are filled in as far as
+    they are needed to describe the entries; intervals may have been deleted since.
+    """
+    directory = directory or archive_directory()
+    segments = PlanLogArchiveSegment.objects.filter(profile_id=profile_id)
+    if before:
+        segments = segments.filter(month__lte=month_start(before[0]).date())
+    months = {}
+    for segment in segments.order_by('-month', 'file_name', 'offset'):
+        months.setdefault(segment.month, []).append(segment)
+
+    entries = []
+    for month_segments in months.values():
+        # A month archived more than once has several segments; they are sorted together.
+        month_entries = []
+        for segment in month_segments:
+            for entry in _read_segment(directory, segment):
+                entry['timestamp'] = parse_datetime(entry['timestamp'])
+                if not before or (entry['timestamp'], entry['id']) < before:
+                    month_entries.append(entry)
+        month_entries.sort(key=lambda entry: (entry['timestamp'], entry['id']), reverse=True)
+        entries.extend(month_entries)
+        if limit is not None and len(entries) >= limit:
+            del entries[limit:]
+            break
+    if not entries:
+        return []
+
+    plans = Plan.objects.in_bulk({entry['plan_id'] for entry in entries})
+    result = []
+    for entry in entries:
+        log = ProfilePlanLog(id=entry['id'], profile_id=entry['profile_id'], timestamp=entry['timestamp'],
+                             action=entry['action'])
+        if entry['origin']:
+            log.origin = RequestOrigin(value=entry['origin'])
+        log.plan = plans.get(entry['plan_id']) or Plan(id=entry['plan_id'], name=entry['plan_id'])
+        if entry['interval_id'] is not None:
+            log.interval = PlanInterval(id=entry['interval_id'], plan=log.plan,
+                                        duration=parse_duration(entry['interval_duration']))
+        result.append(log)
+    return result
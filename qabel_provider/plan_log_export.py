@@ -0,0 +1,95 @@
+"""
+Streaming export of the ProfilePlanLog for audits (views.plan_log_export and the export_plan_log command).
+
+Entries are read with a server-side cursor (QuerySet.iterator) and encoded on the fly, so memory use does not depend
+on the size of the log. Months moved to the archive (see plan_log_archive) are not part of the export; their files
+already are NDJSON.
+"""
+
+import csv
+import io
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import PlanLogActionField, ProfilePlanLog
+
+FIELDS = ('id', 'timestamp', 'user_id', 'action', 'plan_id', 'interval_id', 'origin')
+FORMATS = ('ndjson', 'csv')
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'application/gzip',
+}
+ACTIONS = tuple(PlanLogActionField.CODES)
+FILE_EXTENSIONS = {
+    'ndjson': 'ndjson',
+    'csv': 'csv.gz',
+}
+CHUNK_SIZE = 2000
+
+
+def filtered(since=None, until=None, plan=None, action=None):
+    """
+    Return the log entries in the time range [*since*, *until*), optionally only of *plan* and *action*.
+
+    Raise ValueError for unknown actions (see ACTIONS).
+    """
+    if action and action not in ACTIONS:
+        raise ValueError('Unknown plan log action %r' % action)
+    queryset = ProfilePlanLog.objects.order_by('timestamp', 'id')
+    if since:
+        queryset = queryset.filter(timestamp__gte=since)
+    if until:
+        queryset = queryset.filter(timestamp__lt=until)
+    if plan:
+        queryset = queryset.filter(plan_id=plan)
+    if action:
+        queryset = queryset.filter(action=action)
+    return queryset
+
+
+def entries(**filters):
+    """Return an iterator over the log entries matching *filters* (see filtered()) as dicts of FIELDS."""
+    # Not a generator itself, so that invalid filters raise here rather than once the rows are consumed.
+    return _rows(filtered(**filters))
+
+
+def _rows(queryset):
+    columns = {'user_id': 'profile_id', 'origin': 'origin__value'}
+    for row in queryset.values_list(*[columns.get(field, field) for field in FIELDS]).iterator(chunk_size=CHUNK_SIZE):
+        row = dict(zip(FIELDS, row))
+        row['origin'] = row['origin'] or ''
+        yield row
+
+
+def ndjson(rows):
+    """Encode *rows* as newline delimited JSON; yield one line (bytes) per row."""
+    encoder = DjangoJSONEncoder(sort_keys=True)
+    for row in rows:
+        yield encoder.encode(row).encode() + b'\n'
+
+
+def gzip_csv(rows, chunk_rows=CHUNK_SIZE):
+    """Encode *rows* as gzip compressed CSV with a header line; yield the compressed data in chunks."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, FIELDS)
+    writer.writeheader()
+    for i, row in enumerate(rows, 1):
+        row['timestamp'] = row['timestamp'].isoformat()
+        writer.writerow(row)
+        if i % chunk_rows == 0:
+            yield compressor.compress(buffer.getvalue().encode())
+            buffer.seek(0)
+            buffer.truncate()
+    yield compressor.compress(buffer.getvalue().encode()) + compressor.flush()
+
+
+def export(format, **filters):
+    """Yield the export of the log entries matching *filters* (see entries()) in *format* (see FORMATS)."""
+    rows = entries(**filters)
+    if format == 'ndjson':
+        return ndjson(rows)
+    elif format == 'csv':
+        return gzip_csv(rows)
+    raise ValueError('Unknown export format %r' % format)
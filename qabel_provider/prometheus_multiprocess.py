@@ -0,0 +1,71 @@
+"""
+prometheus_client multiprocess mode for the uWSGI workers.
+
+Every worker process has its own metrics, so a scrape of /metrics would only see those of the worker that happens to
+answer it. If PROMETHEUS_MULTIPROC_DIR is set in the environment (by the uWSGI config, so that it is set before
+prometheus_client is first imported), all workers write their metrics to memory mapped files in that directory
+instead, and views.metrics exports the aggregate (see monitoring.registry).
+
+The directory should be emptied whenever uWSGI (re)starts, see examples/uwsgi-accounting_ini_example. The files
+of workers that exit are cleaned up by the uWSGI atexit hook installed by setup(), or by setup() in a later worker
+if a worker died: their live gauges are removed, while their counters and histograms stay so that totals don't
+decrease.
+
+This module is imported by the WSGI modules before Django is set up, so it must not import any models.
+"""
+
+import glob
+import os
+import re
+
+ENVIRONMENT_VARIABLE = 'PROMETHEUS_MULTIPROC_DIR'
+
+
+def directory():
+    return os.environ.get(ENVIRONMENT_VARIABLE)
+
+
+def enabled():
+    return bool(directory())
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def cleanup():
+    """Remove the live gauges of processes that are no longer running. Return their PIDs."""
+    from prometheus_client import multiprocess
+
+    pids = set()
+    for path in glob.glob(os.path.join(glob.escape(directory()), 'gauge_live*_*.db')):
+        pids.add(int(re.search(r'_(\d+)\.db$', path).group(1)))
+    dead = sorted(pid for pid in pids if not is_running(pid))
+    for pid in dead:
+        multiprocess.mark_process_dead(pid, directory())
+    return dead
+
+
+def mark_this_process_dead():
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(os.getpid(), directory())
+
+
+def setup():
+    """Prepare the metrics directory for this worker, if multiprocess mode is enabled. Call before Django is set up."""
+    if not enabled():
+        return
+    os.makedirs(directory(), exist_ok=True)
+    cleanup()
+    try:
+        import uwsgi
+    except ImportError:
+        return
+    uwsgi.atexit = mark_this_process_dead
@@ -0,0 +1,127 @@
+"""
+Resolution of the answers of the auth resource with set-based queries.
+
+Instead of following token → user → profile → plan (and the primary email and the plan intervals) one lazy
+relation at a time, all profiles asked for are loaded in one query and their usable plan intervals in a second one.
+
+Both queries only read and use the AUTH_READ_DATABASE, which may be a replica. Writes only happen when a plan
+interval is due to be started or expired; these are conditional UPDATEs on the primary database.
+"""
+
+import logging
+from collections import defaultdict, namedtuple
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from .models import PlanInterval, Profile
+from .monitoring import phase_timer
+
+logger = logging.getLogger(__name__)
+
+
+class Resolved(namedtuple('Resolved', 'profile,token,plan,interval,active')):
+    """Answer of the auth resource for one profile (and the *token* it was looked up by, if any)."""
+
+    @property
+    def data(self):
+        return {
+            'user_id': self.profile.user_id,
+            'active': self.active,
+            'block_quota': self.plan.block_quota,
+            'monthly_traffic_quota': self.plan.monthly_traffic_quota,
+        }
+
+
+def resolve(tokens=(), user_ids=()):
+    """
+    Return a list of Resolved answers for the users identified by *tokens* and *user_ids*.
+
+    Unknown tokens and user IDs are left out. Like the auth resource this processes active use of the plans
+    and sends confirmation mails to users which are not allowed anymore.
+    """
+    tokens = list(tokens)
+    user_ids = list(user_ids)
+    if not tokens and not user_ids:
+        return []
+    database = settings.AUTH_READ_DATABASE
+    primary_email = EmailAddress.objects.filter(user=OuterRef('user_id'), primary=True)
+    with phase_timer('lookup'):
+        profiles = list(
+            Profile.objects
+            .using(database)
+            .filter(Q(user_id__in=user_ids) | Q(user__auth_token__key__in=tokens))
+            .select_related('user', 'subscribed_plan')
+            .annotate(token=F('user__auth_token__key'),
+                      email_verified=Subquery(primary_email.values('verified')[:1]))
+        )
+    intervals = defaultdict(list)
+    usable_intervals = (
+        PlanInterval.objects
+        .using(database)
+        .filter(profile__in=profiles, state__in=('in_use', 'pristine'))
+        .select_related('plan')
+        .order_by('-id')
+    )
+    with phase_timer('plan_resolution'):
+        for interval in usable_intervals:
+            intervals[interval.profile_id].append(interval)
+
+    resolved = []
+    for profile in profiles:
+        with phase_timer('plan_activation'):
+            interval = use_interval(profile, intervals[profile.pk])
+        plan = interval.plan if interval else profile.subscribed_plan
+        with phase_timer('confirmation'):
+            active = is_allowed(profile)
+            if not active:
+                profile.check_confirmation_and_send_mail()
+        resolved.append(Resolved(profile, profile.token, plan, interval, active))
+    return resolved
+
+
+def resolve_one(token=None, user_id=None):
+    """
+    Return the Resolved answer for the user identified by *token* or *user_id*, or None if there is no such user.
+
+    This takes two queries, plus the writes for starting or expiring a plan interval if that is due.
+    """
+    if token is not None:
+        resolved = resolve(tokens=[token])
+    else:
+        resolved = resolve(user_ids=[user_id])
+    if resolved:
+        return resolved[0]
+
+
+def is_allowed(profile):
+    """Profile.is_allowed, using the *email_verified* annotation of resolve() instead of a query."""
+    return profile.user.is_active and (bool(profile.email_verified) or not profile.confirmation_date_exceeded())
+
+
+def use_interval(profile, intervals):
+    """
+    Profile.use_plan for already loaded *intervals* (most recent first). Return the interval in use, or None.
+
+    If nothing is due this does not write. If a concurrent request won a conditional update, or the read database
+    lagged behind, this falls back to Profile.use_plan on the primary database.
+    """
+    for interval in intervals:
+        # Avoid a query for every audit log entry written by try_start/try_expire.
+        interval.profile = profile
+    in_use = [interval for interval in intervals if interval.state == 'in_use']
+    if in_use:
+        interval = in_use[0]
+        if timezone.now() <= interval.expires_at:
+            return interval
+        interval.try_expire()
+    pristine = [interval for interval in intervals if interval.state == 'pristine']
+    if not pristine:
+        return
+    interval = pristine[0]
+    if interval.try_start():
+        return interval
+    logger.info('Plan interval %d of user %d was started concurrently', interval.pk, profile.user_id)
+    return profile.use_plan()
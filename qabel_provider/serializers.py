@@ -79,3 +79,19 @@ class PlanIntervalSerializer(PlanSubscriptionSerializer):
             plan=validated_data['plan'],
             duration=validated_data['duration'],
         )
+
+
+class AuthBatchSerializer(serializers.Serializer):
+    AuthBatch = namedtuple('AuthBatch', 'auth,user_id')
+    MAX_SIZE = 1000
+
+    auth = serializers.ListField(child=serializers.CharField(), required=False, default=[], max_length=MAX_SIZE)
+    user_id = serializers.ListField(child=serializers.IntegerField(), required=False, default=[], max_length=MAX_SIZE)
+
+    def validate(self, data):
+        if not data['auth'] and not data['user_id']:
+            raise serializers.ValidationError('No user identification supplied')
+        return data
+
+    def create(self, validated_data):
+        return self.AuthBatch(**validated_data)
@@ -1,6 +1,17 @@
+import csv
+import io
+
 from allauth.account.models import EmailAddress
 from django.contrib.auth.models import User
+from django.db import connection
+from django.forms.models import inlineformset_factory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.translation import gettext as _
+
+from .admin import CappedInlineFormSet
+from .models import Profile, ProfilePlanLog
+from .test_rest import best_plan
 
 
 def test_an_admin_view(admin_client):
@@ -31,8 +42,104 @@ def test_export_user_data(admin_client, user):
     })
     assert response.status_code == 200
     assert response['Content-Type'] == 'text/csv'
-    content = response.content.decode()
+    content = b''.join(response.streaming_content).decode()
     assert 'qabel_user,qabeluser@example.com' in content
     assert 'no_mail' not in content
     assert 'unconfirmed' not in content
     assert 'unrelated' not in content
+
+
+def test_export_user_data_extended(admin_client, user):
+    change_url = reverse('admin:auth_user_changelist')
+    unconfirmed = User.objects.create_user('unconfirmed', 'unconfirmed@example.com', 'password')
+    EmailAddress.objects.create(user=unconfirmed, email=unconfirmed.email, primary=True)
+    no_mail = User.objects.create_user('no_mail', 'no_mail@example.com', 'password')
+
+    response = admin_client.post(change_url, {
+        'action': 'export_user_data_extended',
+        '_selected_action': [user.pk, unconfirmed.pk, no_mail.pk],
+    })
+    assert response.status_code == 200
+    rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+    assert rows[0] == ['username', 'email', 'email_verified', 'plan', 'created_at', 'created_on_behalf',
+                       'needs_confirmation_after']
+    assert [row[:4] for row in rows[1:]] == [
+        ['qabel_user', 'qabeluser@example.com', 'False', 'free'],
+        ['unconfirmed', 'unconfirmed@example.com', 'False', 'free'],
+    ]
+
+    # The counts are shown on the next page
+    response = admin_client.get(change_url)
+    assert [str(message) for message in response.context['messages']] == [
+        _('admin user data export {written_rows} {failed_no_address}').format(written_rows=2, failed_no_address=1),
+    ]
+
+
+def test_user_changelist_queries(admin_client, user):
+    change_url = reverse('admin:auth_user_changelist')
+    admin_client.get(change_url)
+    with CaptureQueriesContext(connection) as few_users:
+        admin_client.get(change_url)
+    for i in range(5):
+        User.objects.create_user('user%d' % i, 'user%d@example.com' % i, 'password')
+    with CaptureQueriesContext(connection) as more_users:
+        response = admin_client.get(change_url)
+    assert len(more_users) == len(few_users)
+    assert response.context['cl'].result_count == User.objects.count()
+    assert response.context['cl'].full_result_count is None
+
+
+def test_user_change_inlines_are_capped(admin_client, profile, best_plan):
+    with ProfilePlanLog.objects.buffered():
+        for i in range(25):
+            ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+    change_url = reverse('admin:auth_user_change', args=[profile.pk])
+
+    response = admin_client.get(change_url)
+    formset = next(formset for formset in response.context['inline_admin_formsets'][0].formset.forms[0].nested_formsets
+                   if formset.model is ProfilePlanLog)
+    assert len(formset.forms) == 20
+    content = response.content.decode()
+    assert _('admin inline latest {shown} of {total}').format(shown=20, total=25) in content
+    assert '?profileplanlog_shown=40' in content
+
+    response = admin_client.get(change_url + '?profileplanlog_shown=40')
+    formset = next(formset for formset in response.context['inline_admin_formsets'][0].formset.forms[0].nested_formsets
+                   if formset.model is ProfilePlanLog)
+    assert len(formset.forms) == 25
+    assert '?profileplanlog_shown=60' not in response.content.decode()
+
+
+def test_user_search(admin_client, user):
+    other = User.objects.create_user('other', 'other@example.com', 'password', first_name='Jane', last_name='Doe')
+    EmailAddress.objects.create(user=other, email='secondary@example.net', primary=False)
+    change_url = reverse('admin:auth_user_changelist')
+
+    def search(term):
+        response = admin_client.get(change_url, {'q': term})
+        return sorted(user.username for user in response.context['cl'].result_list)
+
+    assert search('secondary@') == ['other']
+    assert search('example.com') == ['admin', 'other', 'qabel_user']
+    assert search('jane example') == ['other']
+    assert search('"jane doe"') == []
+    assert search('QABEL') == ['qabel_user']
+
+
+def test_bound_capped_formset_loads_only_submitted_objects(profile, best_plan):
+    with ProfilePlanLog.objects.buffered():
+        for i in range(25):
+            ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+    FormSet = inlineformset_factory(Profile, ProfilePlanLog, formset=CappedInlineFormSet, fields=('plan',), extra=0)
+    FormSet.limit = 20
+    submitted = list(ProfilePlanLog.objects.order_by('-id')[:2])
+    data = {
+        'logs-TOTAL_FORMS': '3',
+        'logs-INITIAL_FORMS': '3',
+        'logs-0-id': str(submitted[0].pk),
+        'logs-1-id': str(submitted[1].pk),
+        'logs-2-id': 'garbage',
+    }
+    formset = FormSet(data, instance=profile, prefix='logs')
+    assert set(formset.get_queryset()) == set(submitted)
+    assert FormSet(instance=profile, prefix='logs').get_queryset().count() == 20
@@ -0,0 +1,111 @@
+from datetime import timedelta
+
+import pytest
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import auth_cache
+from .models import PlanInterval
+from .test_rest import auth_resource_path, best_plan
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+@pytest.fixture
+def confirmed_user(user):
+    user.profile.confirm_email()
+    return user
+
+
+@pytest.fixture
+def call_auth_resource(external_api_client, auth_resource_path, token):
+    def make_request():
+        response = external_api_client.post(auth_resource_path, {'auth': 'Token {}'.format(token)})
+        assert response.status_code == 200
+        return response.json()
+    return make_request
+
+
+def test_answer_is_cached(confirmed_user, token, call_auth_resource):
+    data = call_auth_resource()
+    assert auth_cache.lookup(token=token) == data
+    assert auth_cache.lookup(user_id=confirmed_user.id) == data
+
+
+def test_cached_answer_needs_no_queries(confirmed_user, call_auth_resource, django_assert_num_queries):
+    data = call_auth_resource()
+    with django_assert_num_queries(0):
+        assert call_auth_resource() == data
+
+
+def test_inactive_answer_is_not_cached(user, token, call_auth_resource):
+    user.is_active = False
+    user.save()
+    assert not call_auth_resource()['active']
+    assert auth_cache.lookup(token=token) is None
+
+
+def test_user_change_invalidates(confirmed_user, token, call_auth_resource):
+    call_auth_resource()
+    confirmed_user.is_active = False
+    confirmed_user.save()
+    assert auth_cache.lookup(token=token) is None
+    assert not call_auth_resource()['active']
+
+
+def test_token_delete_invalidates(confirmed_user, token, call_auth_resource):
+    call_auth_resource()
+    confirmed_user.auth_token.delete()
+    assert auth_cache.lookup(token=token) is None
+
+
+def test_plan_change_invalidates(confirmed_user, token, call_auth_resource, best_plan):
+    confirmed_user.profile.subscribed_plan = best_plan
+    confirmed_user.profile.save()
+    assert call_auth_resource()['block_quota'] == best_plan.block_quota
+
+    best_plan.block_quota = 1234
+    best_plan.save()
+    assert auth_cache.lookup(token=token) is None
+    assert call_auth_resource()['block_quota'] == 1234
+
+
+def test_timeout_bounded_by_interval(confirmed_user, best_plan, settings):
+    settings.AUTH_CACHE_TIMEOUT = 300
+    profile = confirmed_user.profile
+    interval = PlanInterval(profile=profile, plan=best_plan, duration=timedelta(seconds=60))
+    interval.save()
+    interval.start()
+    assert 0 < auth_cache.timeout_for(profile, interval) <= 60
+
+
+def test_timeout_bounded_by_confirmation(confirmed_user, settings):
+    settings.AUTH_CACHE_TIMEOUT = 300
+    profile = confirmed_user.profile
+    profile.needs_confirmation_after = timezone.now() + timedelta(seconds=30)
+    assert 0 < auth_cache.timeout_for(profile) <= 30
+    profile.created_on_behalf = True
+    assert auth_cache.timeout_for(profile) == 300
+
+
+def test_plan_versions_are_independent(confirmed_user, token, call_auth_resource, best_plan):
+    call_auth_resource()
+    auth_cache.bump_plan_version(best_plan.id)
+    assert auth_cache.lookup(token=token) is not None
+    auth_cache.bump_plan_version('free')
+    assert auth_cache.lookup(token=token) is None
+
+
+def test_evicted_plan_version_invalidates(confirmed_user, token, call_auth_resource):
+    call_auth_resource()
+    cache.delete(auth_cache.plan_version_key('free'))
+    assert auth_cache.lookup(token=token) is None
+    call_auth_resource()
+    assert auth_cache.lookup(token=token) is not None
+    cache.delete(auth_cache.plan_version_key('free'))
+    auth_cache.bump_plan_version('free')
+    assert auth_cache.lookup(token=token) is None
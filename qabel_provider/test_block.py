@@ -0,0 +1,97 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+from prometheus_client.core import REGISTRY
+
+from . import block, monitoring
+
+
+class BlockServer(HTTPServer):
+    """Answers with the queued (status, body) pairs, 200 with the quota once they are used up."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), BlockHandler)
+        self.answers = []
+        self.connections = 0
+        self.requests = []
+
+    def get_request(self):
+        self.connections += 1
+        return super().get_request()
+
+
+class BlockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Authorization')))
+        status, body = self.server.answers.pop(0) if self.server.answers else (200, {'quota': 10, 'size': 5})
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def block_server(settings, monkeypatch):
+    server = BlockServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    settings.BLOCK_URL = 'http://127.0.0.1:%d' % server.server_port
+    monkeypatch.setattr(block, 'BASE_URL', settings.BLOCK_URL + '/api/v0/')
+    monkeypatch.setattr(block, 'session', block.create_session())
+    # Reading samples from the registry would start a refresh of the business metrics otherwise.
+    monkeypatch.setattr(monitoring, 'refresh_in_background', lambda: None)
+    yield server
+    block.session.close()
+    server.shutdown()
+    server.server_close()
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_get_block_quota_of_user(block_server, user):
+    responses = sample('block_responses_total', path='quota/', status='200')
+    latencies = sample('block_request_seconds_count', path='quota/')
+    assert block.get_block_quota_of_user(user) == (10, 5)
+    assert block.get_block_quota_of_user(user) == (10, 5)
+    assert block_server.connections == 1
+    path, authorization = block_server.requests[0]
+    assert path == '/api/v0/quota/'
+    assert authorization.startswith('Token ')
+    assert sample('block_responses_total', path='quota/', status='200') == responses + 2
+    assert sample('block_request_seconds_count', path='quota/') == latencies + 2
+
+
+def test_retry(block_server, user):
+    block_server.answers = [(503, {}), (502, {})]
+    assert block.get_block_quota_of_user(user) == (10, 5)
+    assert len(block_server.requests) == 3
+
+
+def test_retries_are_bounded(block_server, user, settings):
+    block_server.answers = [(503, {})] * (settings.BLOCK_RETRIES + 1)
+    responses = sample('block_responses_total', path='quota/', status='503')
+    with pytest.raises(requests.HTTPError):
+        block.get_block_quota_of_user(user)
+    assert len(block_server.requests) == settings.BLOCK_RETRIES + 1
+    assert sample('block_responses_total', path='quota/', status='503') == responses + 1
+
+
+def test_connection_error(block_server, user, monkeypatch):
+    block_server.shutdown()
+    block_server.server_close()
+    errors = sample('block_errors_total', path='quota/', error='ConnectionError')
+    with pytest.raises(requests.ConnectionError):
+        block.request('GET', 'quota/', timeout=1)
+    assert sample('block_errors_total', path='quota/', error='ConnectionError') == errors + 1
@@ -0,0 +1,143 @@
+from datetime import timedelta
+
+import pytest
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from . import changes
+from .models import AuthChange, Profile, ProfilePlanLog
+from .test_rest import best_plan
+
+
+@pytest.fixture
+def changes_path():
+    return '/api/v0/internal/changes/'
+
+
+@pytest.fixture
+def kinds(db):
+    def recorded_kinds():
+        return [(change.kind, change.user_id, change.plan_id) for change in AuthChange.objects.order_by('id')]
+    AuthChange.objects.all().delete()
+    return recorded_kinds
+
+
+def test_token(user, kinds):
+    token = Token.objects.create(user=user)
+    token.delete()
+    assert kinds() == [('token-created', user.id, ''), ('token-deleted', user.id, '')]
+
+
+def test_user_deactivated(user, kinds):
+    user.first_name = 'Manfred'
+    user.save()
+    assert not kinds()
+    user.is_active = False
+    user.save()
+    assert kinds() == [('user-deactivated', user.id, '')]
+
+
+def test_saves_need_no_queries(user, kinds):
+    user = User.objects.get(pk=user.pk)
+    user.is_active = False
+    with CaptureQueriesContext(connection) as queries:
+        user.save()
+    assert not [query for query in queries if query['sql'].startswith('SELECT') and 'FROM "auth_user"' in query['sql']]
+    assert kinds() == [('user-deactivated', user.id, '')]
+
+
+def test_profile_changed(profile, kinds):
+    profile = Profile.objects.get(pk=profile.pk)
+    profile.plus_notification_mail = True
+    profile.save()
+    assert not kinds()
+    profile.needs_confirmation_after = timezone.now()
+    profile.save()
+    profile.save()
+    assert kinds() == [('profile-changed', profile.pk, '')]
+
+
+def test_deferred_field_set(user, kinds):
+    user = User.objects.only('pk').get(pk=user.pk)
+    user.is_active = False
+    user.save()
+    assert kinds() == [('user-deactivated', user.id, '')]
+
+
+def test_email_confirmed(profile, kinds):
+    profile.confirm_email()
+    assert kinds() == [('email-changed', profile.user_id, '')]
+
+
+def test_plan_log(profile, best_plan, kinds):
+    ProfilePlanLog(profile=profile, action='set-plan', plan=best_plan).save()
+    assert kinds() == [('set-plan', profile.user_id, best_plan.id)]
+
+
+def test_plan_changed(kinds, best_plan):
+    best_plan.block_quota = 1234
+    best_plan.save()
+    assert kinds() == [('plan-changed', None, best_plan.id)]
+
+
+def test_feed(external_api_client, changes_path, user, kinds):
+    Token.objects.create(user=user).delete()
+    Token.objects.create(user=user)
+    response = external_api_client.get(changes_path, {'limit': 2})
+    assert response.status_code == 200, response.json()
+    data = response.json()
+    assert [change['kind'] for change in data['changes']] == ['token-created', 'token-deleted']
+
+    response = external_api_client.get(changes_path, {'since': data['cursor']})
+    data = response.json()
+    assert [change['kind'] for change in data['changes']] == ['token-created']
+    assert data['changes'][0]['user_id'] == user.id
+
+    response = external_api_client.get(changes_path, {'since': data['cursor']})
+    assert response.json() == {'changes': [], 'cursor': data['cursor']}
+
+
+def test_feed_cursor(external_api_client, changes_path, user, kinds):
+    Token.objects.create(user=user)
+    change = AuthChange.objects.get()
+    assert changes.parse_cursor(changes.format_cursor((change.txid, change.id))) == (change.txid, change.id)
+    # Cursors of the feed before it was ordered by transaction
+    assert changes.parse_cursor(str(change.id)) == (0, change.id)
+    for malformed in ('x', '1-', '-1', '1-2-3'):
+        response = external_api_client.get(changes_path, {'since': malformed})
+        assert response.status_code == 400
+
+
+def test_confirmation_deadline(user, kinds):
+    profile = user.profile
+    profile.needs_confirmation_after = timezone.now() + timedelta(hours=1)
+    profile.save()
+    AuthChange.objects.all().delete()
+    assert changes.record_confirmation_deadlines() == 0
+    profile.needs_confirmation_after = timezone.now() - timedelta(hours=1)
+    profile.save()
+    AuthChange.objects.all().delete()
+    assert changes.record_confirmation_deadlines() == 1
+    assert changes.record_confirmation_deadlines() == 0
+    assert kinds() == [('confirmation-expired', user.id, '')]
+
+    AuthChange.objects.all().delete()
+    profile.confirm_email()
+    assert changes.record_confirmation_deadlines() == 0
+
+
+def test_prune(user, kinds, settings):
+    settings.CHANGE_FEED_RETENTION = 7
+    Token.objects.create(user=user)
+    assert changes.prune() == 0
+    assert changes.prune(now=timezone.now() + timedelta(days=8)) == 1
+    assert not kinds()
+
+
+def test_feed_requires_api_key(client, changes_path):
+    response = client.get(changes_path)
+    assert response.status_code == 403
@@ -0,0 +1,122 @@
+from datetime import timedelta
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import expiry
+from .models import AuthChange, PlanInterval, ProfilePlanLog
+from .test_rest import best_plan, better_plan
+
+
+@pytest.fixture
+def add_interval(profile):
+    def add(plan, **kwargs):
+        interval = PlanInterval(profile=profile, plan=plan, duration=timedelta(days=1), **kwargs)
+        interval.save()
+        return interval
+    return add
+
+
+@pytest.fixture
+def due_interval(add_interval, best_plan):
+    return add_interval(best_plan, state='in_use', started_at=timezone.now() - timedelta(days=2))
+
+
+def actions(profile):
+    return list(ProfilePlanLog.objects.filter(profile=profile).order_by('id').values_list('action', flat=True))
+
+
+def test_expire_due(profile, due_interval):
+    assert expiry.expire_due() == 1
+    due_interval.refresh_from_db()
+    assert due_interval.state == 'expired'
+    log = ProfilePlanLog.objects.get(profile=profile)
+    assert log.action == 'expired-interval'
+    assert log.interval == due_interval
+    assert log.origin.value == expiry.ORIGIN
+    assert AuthChange.objects.filter(kind='expired-interval', user_id=profile.pk).exists()
+    profile.refresh_from_db()
+    assert profile.effective_plan_id == 'free'
+
+
+def test_not_due(profile, add_interval, best_plan):
+    interval = add_interval(best_plan, state='in_use', started_at=timezone.now())
+    assert expiry.expire_due() == 0
+    interval.refresh_from_db()
+    assert interval.state == 'in_use'
+    assert not actions(profile)
+
+
+def test_starts_next_pristine_interval(profile, due_interval, add_interval, best_plan, better_plan):
+    add_interval(best_plan)
+    latest = add_interval(better_plan)
+    now = timezone.now()
+    expiry.expire_due(now=now)
+    latest.refresh_from_db()
+    assert latest.state == 'in_use'
+    assert latest.started_at == now
+    assert actions(profile) == ['expired-interval', 'start-interval']
+    profile.refresh_from_db()
+    assert profile.effective_plan_id == better_plan.id
+    assert profile.effective_until == now + latest.duration
+    assert PlanInterval.objects.filter(profile=profile, state='pristine').count() == 1
+
+
+def test_chunks(django_user_model, best_plan):
+    started_at = timezone.now() - timedelta(days=2)
+    for i in range(5):
+        user = django_user_model.objects.create_user('user%d' % i)
+        PlanInterval(profile=user.profile, plan=best_plan, duration=timedelta(days=1), state='in_use',
+                     started_at=started_at).save()
+    assert expiry.expire_due(chunk_size=2) == 5
+    assert not PlanInterval.objects.filter(state='in_use').exists()
+    assert ProfilePlanLog.objects.filter(action='expired-interval').count() == 5
+
+
+def test_one_interval_in_use(due_interval, add_interval, best_plan):
+    with pytest.raises(IntegrityError), transaction.atomic():
+        add_interval(best_plan, state='in_use', started_at=timezone.now())
+
+
+def test_expires_at(add_interval, best_plan):
+    interval = add_interval(best_plan)
+    assert interval.expires_at is None
+    interval.start()
+    assert interval.expires_at == interval.started_at + interval.duration
+
+
+def test_command(due_interval):
+    out = StringIO()
+    call_command('expire_intervals', stdout=out)
+    assert 'Expired 1 intervals' in out.getvalue()
+
+
+@pytest.mark.django_db(databases=['default', 'replica'])
+def test_update_returning_uses_the_queryset_database(due_interval):
+    # The replica test database is not a mirror of default and has no intervals
+    assert expiry._update_returning(PlanInterval.objects.using('replica').all(), state='expired') == []
+    due_interval.refresh_from_db()
+    assert due_interval.state == 'in_use'
+
+
+def test_command_loop_survives_errors(monkeypatch):
+    class Stop(Exception):
+        pass
+
+    calls = []
+
+    def expire_due(chunk_size):
+        calls.append(chunk_size)
+        raise RuntimeError('database went away')
+
+    def sleep(seconds):
+        if len(calls) == 2:
+            raise Stop
+    monkeypatch.setattr('qabel_provider.management.commands.expire_intervals.expire_due', expire_due)
+    monkeypatch.setattr('qabel_provider.management.commands.expire_intervals.time.sleep', sleep)
+    with pytest.raises(Stop):
+        call_command('expire_intervals', '--loop')
+    assert len(calls) == 2
@@ -0,0 +1,190 @@
+import csv
+import gzip
+import io
+import json
+from datetime import timedelta
+
+import pytest
+from allauth.account.models import EmailAddress
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.urls import reverse
+
+from . import export_jobs
+from .models import ExportJob, ProfilePlanLog
+from .test_rest import best_plan, better_plan
+
+
+@pytest.fixture(autouse=True)
+def export_job_dir(settings, tmp_path):
+    settings.EXPORT_JOB_DIR = str(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def users(user):
+    primary_email = user.profile.primary_email
+    primary_email.verified = True
+    primary_email.save()
+    unconfirmed = User.objects.create_user('unconfirmed', 'unconfirmed@example.com', 'password')
+    EmailAddress.objects.create(user=unconfirmed, email=unconfirmed.email, primary=True)
+    User.objects.create_user('no_mail', 'no_mail@example.com', 'password')
+    return User.objects.all()
+
+
+def read_csv(job):
+    with gzip.open(export_jobs.path(job), 'rt') as file:
+        return list(csv.reader(file))
+
+
+def test_user_export(users, monkeypatch):
+    monkeypatch.setattr(export_jobs, 'CHUNK_SIZE', 1)
+    selected = users.filter(username__in=['qabel_user', 'unconfirmed'])
+    job = export_jobs.queue_user_export('users', user_ids=[user.pk for user in selected])
+    assert export_jobs.run_pending() == 1
+    job.refresh_from_db()
+    assert job.state == 'done'
+    assert (job.total, job.processed, job.written, job.progress) == (2, 2, 1, 100)
+    assert job.started_at <= job.finished_at
+    assert read_csv(job) == [['username', 'email'], ['qabel_user', 'qabeluser@example.com']]
+
+
+def test_user_export_extended(users):
+    job = export_jobs.queue_user_export('users-extended', changelist='')
+    call_command('run_export_jobs')
+    job.refresh_from_db()
+    assert job.file_name.endswith('.csv.gz')
+    rows = read_csv(job)
+    assert rows[0] == export_jobs.user_header('users-extended')
+    assert [row[:4] for row in rows[1:]] == [
+        ['qabel_user', 'qabeluser@example.com', 'True', 'free'],
+        ['unconfirmed', 'unconfirmed@example.com', 'False', 'free'],
+    ]
+
+
+def test_user_export_of_selected_ids(users):
+    selected = users.filter(username__in=['qabel_user', 'unconfirmed'])
+    job = export_jobs.queue_user_export('users-extended', user_ids=[str(user.pk) for user in selected])
+    assert json.loads(job.parameters) == {'user_ids': sorted(user.pk for user in selected)}
+    User.objects.filter(username='unconfirmed').delete()
+    export_jobs.run_pending()
+    job.refresh_from_db()
+    assert (job.state, job.total, job.processed) == ('done', 1, 1)
+    assert [row[0] for row in read_csv(job)[1:]] == ['qabel_user']
+
+
+def test_user_export_of_changelist(users):
+    job = export_jobs.queue_user_export('users', changelist='q=unconfirmed')
+    # Only the selection is stored, the users are listed by the worker
+    assert json.loads(job.parameters) == {'changelist': 'q=unconfirmed'}
+    export_jobs.run_pending()
+    job.refresh_from_db()
+    assert (job.state, job.total) == ('done', 1)
+
+
+def test_stale_job_is_requeued(users, settings):
+    job = export_jobs.queue_user_export('users', changelist='')
+    claimed = export_jobs.claim()
+    assert (claimed.pk, claimed.attempts) == (job.pk, 1)
+    # The worker died without progress
+    now = claimed.heartbeat_at + timedelta(seconds=settings.EXPORT_JOB_STALE_AFTER - 1)
+    assert export_jobs.requeue_stale(now) == 0
+    assert export_jobs.requeue_stale(now + timedelta(seconds=2)) == 1
+    job.refresh_from_db()
+    assert job.state == 'pending'
+
+    assert export_jobs.run_pending() == 1
+    job.refresh_from_db()
+    assert (job.state, job.attempts, job.processed) == ('done', 2, 3)
+
+
+def test_stale_job_fails_after_max_attempts(users, settings):
+    job = export_jobs.queue_user_export('users', changelist='')
+    ExportJob.objects.filter(pk=job.pk).update(attempts=export_jobs.MAX_ATTEMPTS - 1)
+    claimed = export_jobs.claim()
+    later = claimed.heartbeat_at + timedelta(seconds=settings.EXPORT_JOB_STALE_AFTER + 1)
+    assert export_jobs.requeue_stale(later) == 0
+    job.refresh_from_db()
+    assert (job.state, job.error) == ('failed', 'Worker stopped responding')
+
+
+def test_plan_log_export(profile, best_plan, better_plan):
+    ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+    ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=better_plan)
+    job = export_jobs.queue_plan_log_export('ndjson', plan=better_plan.pk)
+    export_jobs.run_pending()
+    job.refresh_from_db()
+    assert (job.state, job.total, job.written) == ('done', 1, 1)
+    with gzip.open(export_jobs.path(job), 'rt') as file:
+        assert [json.loads(line)['plan_id'] for line in file] == [better_plan.pk]
+
+
+def test_failed_job(db, export_job_dir):
+    job = ExportJob.objects.create(kind='plan-log', parameters='{}')
+    export_jobs.run_pending()
+    job.refresh_from_db()
+    assert job.state == 'failed'
+    assert 'output' in job.error
+    assert not list(export_job_dir.iterdir())
+
+
+def test_nothing_pending(db):
+    assert export_jobs.run_pending() == 0
+
+
+def test_large_selection_is_queued(admin_client, users, settings):
+    settings.ADMIN_EXPORT_BACKGROUND_THRESHOLD = 2
+    response = admin_client.post(reverse('admin:auth_user_changelist'), {
+        'action': 'export_user_data',
+        '_selected_action': [user.pk for user in users],
+    }, follow=True)
+    job = ExportJob.objects.get()
+    assert (job.kind, job.state, job.created_by.username) == ('users', 'pending', 'admin')
+    assert reverse('admin:qabel_provider_exportjob_change', args=[job.pk]) in response.content.decode()
+
+    export_jobs.run_pending()
+    job.refresh_from_db()
+    response = admin_client.get(reverse('admin:qabel_provider_exportjob_download', args=[job.pk]))
+    assert response['Content-Disposition'] == 'attachment; filename="%s"' % job.file_name
+    with gzip.open(io.BytesIO(b''.join(response.streaming_content)), 'rt') as file:
+        assert list(csv.reader(file)) == [['username', 'email'], ['qabel_user', 'qabeluser@example.com']]
+
+
+def test_queue_plan_log_export_in_admin(admin_client, best_plan):
+    response = admin_client.post(reverse('admin:qabel_provider_exportjob_add'), {
+        'since': '2019-01-01 00:00', 'until': '', 'plan': best_plan.pk, 'action': 'set-plan', 'output': 'csv',
+    })
+    assert response.status_code == 302
+    job = ExportJob.objects.get()
+    assert job.kind == 'plan-log'
+    assert json.loads(job.parameters)['plan'] == best_plan.pk
+    assert admin_client.get(reverse('admin:qabel_provider_exportjob_changelist')).status_code == 200
+    assert admin_client.get(reverse('admin:qabel_provider_exportjob_change', args=[job.pk])).status_code == 200
+
+    export_jobs.run_pending()
+    job.refresh_from_db()
+    assert job.state == 'done'
+    assert job.file_name.endswith('.csv.gz')
+
+
+def test_queue_plan_log_export_unknown_action(admin_client):
+    response = admin_client.post(reverse('admin:qabel_provider_exportjob_add'), {'action': 'bogus', 'output': 'csv'})
+    assert response.status_code == 200
+    assert not ExportJob.objects.exists()
+    with pytest.raises(ValueError):
+        export_jobs.queue_plan_log_export('csv', action='bogus')
+
+
+def test_select_across_is_queued_as_changelist(admin_client, users, settings):
+    settings.ADMIN_EXPORT_BACKGROUND_THRESHOLD = 0
+    admin_client.post(reverse('admin:auth_user_changelist') + '?q=confirmed', {
+        'action': 'export_user_data_extended',
+        'select_across': '1',
+        # Only the checkboxes of the first page are sent, select_across covers all matching users
+        '_selected_action': [users.get(username='qabel_user').pk],
+    })
+    job = ExportJob.objects.get()
+    assert json.loads(job.parameters) == {'changelist': 'q=confirmed'}
+    export_jobs.run_pending()
+    job.refresh_from_db()
+    assert [row[0] for row in read_csv(job)[1:]] == ['unconfirmed']
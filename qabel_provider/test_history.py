@@ -0,0 +1,104 @@
+import datetime
+
+import pytest
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import history, plan_log_archive, views
+from .models import ProfilePlanLog
+from .test_rest import best_plan
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(settings, tmp_path):
+    settings.PLAN_LOG_ARCHIVE_DIR = str(tmp_path)
+    cache.clear()
+
+
+@pytest.fixture
+def page_size(monkeypatch):
+    monkeypatch.setattr(history, 'PAGE_SIZE', 2)
+    return 2
+
+
+@pytest.fixture
+def entries(profile, best_plan):
+    # Five entries, two of them with the same timestamp
+    now = timezone.now()
+    for i in range(5):
+        ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan, origin=str(i))
+    for i, entry in enumerate(ProfilePlanLog.objects.order_by('id')):
+        ProfilePlanLog.objects.filter(pk=entry.pk).update(timestamp=now - datetime.timedelta(days=min(4 - i, 3)))
+    return list(ProfilePlanLog.objects.order_by('-timestamp', '-id'))
+
+
+def pages(profile_id):
+    cursor, result = None, []
+    while True:
+        entries, cursor = history.load_page(profile_id, history.parse_cursor(cursor) if cursor else None)
+        result.append([entry.id for entry in entries])
+        if not cursor:
+            return result
+
+
+def test_keyset_pagination(profile, entries, page_size):
+    ids = [entry.id for entry in entries]
+    assert pages(profile.pk) == [ids[0:2], ids[2:4], ids[4:5]]
+
+
+def test_pagination_into_archive(profile, entries, page_size):
+    ids = [entry.id for entry in entries]
+    # Archive the two oldest entries (three days old or more) by moving them to last year
+    ProfilePlanLog.objects.filter(pk__in=ids[3:]).update(timestamp=timezone.now() - datetime.timedelta(days=365))
+    plan_log_archive.archive(timezone.now())
+    assert pages(profile.pk) == [ids[0:2], ids[2:4], ids[4:5]]
+
+
+def test_load_page_queries(profile, entries, django_assert_num_queries):
+    # The live entries and the archive index
+    with django_assert_num_queries(2):
+        history.load_page(profile.pk)
+
+
+def test_malformed_cursor(user, rf):
+    assert history.parse_cursor('yesterday_1') is None
+    assert history.parse_cursor('2020-02-30T00:00:00+00:00_1') is None
+    assert history.parse_cursor('2020-02-01T00:00:00+00:00_x') is None
+    request = rf.get('/account/history', {'before': '2020-02-30T00:00:00+00:00_1'})
+    request.user = user
+    assert views.user_history(request).status_code == 400
+
+
+def test_cursor_is_normalized(profile, entries):
+    utc = history.parse_cursor('2020-02-01T00:00:00+00:00_1')
+    assert history.parse_cursor('2020-02-01T01:00:00+01:00_1') == utc
+    assert history.parse_cursor('2020-02-01T00:00:00_1') == utc
+    assert history.page_key(profile.pk, 'v', utc) == \
+        history.page_key(profile.pk, 'v', history.parse_cursor('2020-01-31T19:00:00-05:00_1'))
+    assert history.format_position(history.parse_cursor('2020-02-01T01:00:00+01:00_1')) == \
+        '2020-02-01T00:00:00+00:00_1'
+
+
+def test_page_cache(profile, entries, best_plan, django_assert_num_queries):
+    first = history.page(profile.pk)
+    assert len(first['events']) == 5
+    assert first['events'][0]['description'] == 'Subscribed to best plan'
+    with django_assert_num_queries(0):
+        assert history.page(profile.pk) == first
+
+    ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+    assert len(history.page(profile.pk)['events']) == 6
+
+
+def test_user_history(profile, user, entries, page_size, rf):
+    request = rf.get('/account/history')
+    request.user = user
+    response = views.user_history(request)
+    assert len(response.context_data['events']) == 2
+    cursor = response.context_data['next_page']
+
+    request = rf.get('/account/history', {'before': cursor})
+    request.user = user
+    response = views.user_history(request)
+    assert [event['timestamp'] for event in response.context_data['events']] == \
+        [entry.timestamp for entry in entries[2:4]]
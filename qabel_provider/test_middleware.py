@@ -0,0 +1,60 @@
+import logging
+
+import pytest
+from django.test import Client
+from prometheus_client.core import REGISTRY
+
+from . import monitoring
+from .middleware import fingerprint
+
+
+@pytest.fixture(autouse=True)
+def no_business_metrics_refresh(monkeypatch):
+    # Reading samples from the registry scrapes the business metrics, which would start a refresh thread.
+    monkeypatch.setattr(monitoring, 'refresh_in_background', lambda: None)
+
+
+@pytest.fixture
+def query_metrics_client(settings, admin_user):
+    settings.QUERY_METRICS = True
+    client = Client()
+    client.force_login(admin_user)
+    return client
+
+
+def sample(name, view):
+    return REGISTRY.get_sample_value(name, {'view': view}) or 0
+
+
+def test_fingerprint():
+    assert fingerprint('SELECT 1 FROM t WHERE id IN (%s, %s, %s) AND x = %s') == \
+        'SELECT 1 FROM t WHERE id IN (...) AND x = %s'
+
+
+def test_queries_are_recorded(query_metrics_client, settings, caplog):
+    settings.QUERY_BUDGET = 1000
+    requests = sample('view_queries_count', 'admin:index')
+    queries = sample('view_queries_sum', 'admin:index')
+    with caplog.at_level(logging.WARNING, 'qabel_provider.middleware'):
+        assert query_metrics_client.get('/admin/').status_code == 200
+    assert sample('view_queries_count', 'admin:index') == requests + 1
+    assert sample('view_queries_sum', 'admin:index') > queries
+    assert sample('view_query_seconds_count', 'admin:index') == requests + 1
+    assert not caplog.records
+
+
+def test_over_budget(query_metrics_client, settings, caplog):
+    settings.QUERY_BUDGET = 0
+    with caplog.at_level(logging.WARNING, 'qabel_provider.middleware'):
+        query_metrics_client.get('/admin/')
+    message = caplog.records[-1].getMessage()
+    assert 'to admin:index' in message
+    assert 'over the budget of 0' in message
+    assert 'SELECT' in message
+
+
+def test_disabled(admin_client, settings):
+    assert not settings.QUERY_METRICS
+    requests = sample('view_queries_count', 'admin:index')
+    admin_client.get('/admin/')
+    assert sample('view_queries_count', 'admin:index') == requests
@@ -1,9 +1,14 @@
 from datetime import timedelta
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 import pytest
 
-from .models import PlanInterval, ProfilePlanLog
+from .models import AuthChange, PlanInterval, Profile, ProfilePlanLog, RequestOrigin
 from .test_rest import best_plan
 
 
@@ -123,3 +128,206 @@ class TestPlanInterval:
         assert log.plan == best_plan
         assert log.interval == interval
         assert log.action == 'expired-interval'
+
+    def test_try_start(self, interval, profile_plan_log):
+        assert interval.try_start()
+        assert interval.state == 'in_use'
+        assert interval.started_at
+        assert profile_plan_log.get().action == 'start-interval'
+
+    def test_try_start_raced(self, interval, profile_plan_log):
+        PlanInterval.objects.filter(pk=interval.pk).update(state='in_use')
+        assert not interval.try_start()
+        assert interval.state == 'pristine'
+        assert not profile_plan_log
+
+    def test_try_expire(self, interval, profile_plan_log):
+        interval.start()
+        profile_plan_log.delete()  # clear old entry
+        assert interval.try_expire()
+        assert not interval.try_expire()
+        interval.refresh_from_db()
+        assert interval.state == 'expired'
+        assert profile_plan_log.get().action == 'expired-interval'
+
+
+class TestEffectivePlan:
+    @pytest.fixture
+    def interval(self, profile, best_plan):
+        interval = PlanInterval(profile=profile, plan=best_plan, duration=timedelta(days=1))
+        interval.save()
+        return interval
+
+    def effective(self, profile):
+        profile.refresh_from_db()
+        return profile.effective_plan_id, profile.effective_until
+
+    def test_new_profile(self, profile):
+        assert self.effective(profile) == ('free', None)
+        assert profile.plan.id == 'free'
+
+    def test_subscription(self, profile, best_plan):
+        profile.subscribed_plan = best_plan
+        profile.save()
+        assert self.effective(profile) == (best_plan.id, None)
+
+    def test_pristine_interval(self, profile, interval, best_plan):
+        assert self.effective(profile) == (best_plan.id, None)
+
+    def test_start_and_expiry(self, profile, interval, best_plan, monkeypatch):
+        interval.start()
+        assert self.effective(profile) == (best_plan.id, interval.started_at + interval.duration)
+
+        into_the_future = interval.started_at + timedelta(days=2)
+        monkeypatch.setattr(timezone, 'now', lambda: into_the_future)
+        assert not interval.check_expiry()
+        assert self.effective(profile) == ('free', None)
+
+    def test_try_start(self, profile, interval, best_plan):
+        assert interval.try_start()
+        assert self.effective(profile)[1] == interval.started_at + interval.duration
+
+    def test_stale_effective_until(self, profile, interval, best_plan, monkeypatch):
+        interval.start()
+        profile.refresh_from_db()
+        into_the_future = interval.started_at + timedelta(days=2)
+        monkeypatch.setattr(timezone, 'now', lambda: into_the_future)
+        assert profile.plan.id == 'free'
+
+    def test_save_keeps_denormalized_fields(self, profile, interval, best_plan):
+        stale = Profile.objects.get(pk=profile.pk)
+        interval.start()
+        stale.plus_notification_mail = True
+        stale.save()
+        assert self.effective(profile)[0] == best_plan.id
+        assert profile.plus_notification_mail
+
+    def test_interval_created_elsewhere(self, profile, best_plan):
+        interval = PlanInterval.objects.create(profile=profile, plan=best_plan, duration=timedelta(days=1))
+        assert profile.plan == best_plan
+        assert Profile.objects.get(pk=profile.pk).plan == best_plan
+        interval.delete()
+        assert Profile.objects.get(pk=profile.pk).plan.id == 'free'
+
+    def test_plan_needs_no_queries(self, profile, interval, best_plan, django_assert_num_queries):
+        assert profile.plan == best_plan
+        with django_assert_num_queries(0):
+            assert profile.plan == best_plan
+
+    def test_loaded_profile_is_not_read_again(self, profile, interval, best_plan, django_assert_num_queries):
+        loaded = Profile.objects.select_related('effective_plan').get(pk=profile.pk)
+        with django_assert_num_queries(0):
+            assert loaded.plan == best_plan
+
+    def test_save_without_subscription_change(self, profile, interval, best_plan):
+        def interval_queries():
+            return [query for query in queries.captured_queries if 'qabel_provider_planinterval' in query['sql']]
+        loaded = Profile.objects.get(pk=profile.pk)
+        loaded.plus_notification_mail = True
+        with CaptureQueriesContext(connection) as queries:
+            loaded.save()
+        assert not interval_queries()
+        loaded.subscribed_plan = best_plan
+        with CaptureQueriesContext(connection) as queries:
+            loaded.save()
+        assert interval_queries()
+        assert self.effective(profile) == (best_plan.id, None)
+
+    def test_recompute_command(self, profile, interval, best_plan):
+        Profile.objects.update(effective_plan=None)
+        out = StringIO()
+        call_command('recompute_effective_plans', stdout=out)
+        assert 'Updated 1 profiles' in out.getvalue()
+        assert self.effective(profile) == (best_plan.id, None)
+
+    def test_recompute_command_changed_since(self, profile, interval):
+        Profile.objects.update(effective_plan=None)
+        out = StringIO()
+        call_command('recompute_effective_plans', changed_since=timezone.now(), stdout=out)
+        assert 'Updated 0 profiles' in out.getvalue()
+
+    def test_recompute_command_bad_timestamp(self):
+        with pytest.raises(CommandError):
+            call_command('recompute_effective_plans', '--changed-since', 'yesterday', stdout=StringIO())
+
+
+def test_try_start_other_interval_in_use(profile, best_plan):
+    first, second = (PlanInterval(profile=profile, plan=best_plan, duration=timedelta(days=1)) for i in range(2))
+    first.save()
+    second.save()
+    assert first.try_start()
+    assert not second.try_start()
+    second.refresh_from_db()
+    assert second.state == 'pristine'
+
+
+class TestPlanLogWriter:
+    @pytest.fixture
+    def entries(self, profile):
+        return ProfilePlanLog.objects.filter(profile=profile)
+
+    def test_log_unbuffered(self, profile, best_plan, entries):
+        ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+        assert entries.get().action == 'set-plan'
+        assert AuthChange.objects.filter(kind='set-plan', user_id=profile.pk).exists()
+
+    def test_buffered(self, profile, best_plan, entries):
+        with CaptureQueriesContext(connection) as queries:
+            with ProfilePlanLog.objects.buffered():
+                for i in range(3):
+                    ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+                assert not entries.exists()
+        assert entries.count() == 3
+        # One for the entries, one for their change feed rows
+        assert sum(query['sql'].startswith('INSERT') for query in queries) == 2
+
+    def test_nested_rollback(self, profile, best_plan, entries):
+        with ProfilePlanLog.objects.buffered():
+            ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan, origin='outer')
+            with pytest.raises(ValueError), ProfilePlanLog.objects.buffered():
+                ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan, origin='inner')
+                raise ValueError
+        assert entries.get().origin.value == 'outer'
+
+    def test_rollback(self, profile, best_plan, entries):
+        with pytest.raises(ValueError), ProfilePlanLog.objects.buffered():
+            ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+            raise ValueError
+        assert not entries.exists()
+        # The buffer is reset
+        ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+        assert entries.exists()
+
+    def test_append_only(self, profile, best_plan, entries):
+        ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+        entry = entries.get()
+        with pytest.raises(ValueError):
+            entry.save()
+        with pytest.raises(ValueError):
+            entry.delete()
+        with pytest.raises(ValueError):
+            ProfilePlanLog.objects.log(id=entry.id, profile=profile, action='set-plan', plan=best_plan)
+
+
+class TestCompactPlanLog:
+    def test_action_stored_as_code(self, profile, best_plan):
+        ProfilePlanLog.objects.log(profile=profile, action='expired-interval', plan=best_plan)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT action FROM qabel_provider_profileplanlog')
+            assert cursor.fetchone()[0] == 4
+        entry = ProfilePlanLog.objects.get(action='expired-interval')
+        assert entry.action == 'expired-interval'
+        assert list(ProfilePlanLog.objects.values_list('action', flat=True)) == ['expired-interval']
+
+    def test_unknown_action(self, profile, best_plan):
+        with pytest.raises(ValueError):
+            ProfilePlanLog.objects.log(profile=profile, action='cheese', plan=best_plan)
+
+    def test_origins_deduplicated(self, profile, best_plan):
+        with ProfilePlanLog.objects.buffered():
+            for origin in ('address 1', 'address 2', 'address 1', ''):
+                ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan, origin=origin)
+        ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan, origin='address 2')
+        assert RequestOrigin.objects.count() == 2
+        origins = [entry.origin.value if entry.origin else '' for entry in ProfilePlanLog.objects.order_by('id')]
+        assert origins == ['address 1', 'address 2', 'address 1', '', 'address 2']
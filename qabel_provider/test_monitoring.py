@@ -0,0 +1,139 @@
+import datetime
+
+import pytest
+from django.core.cache import cache
+from prometheus_client import generate_latest
+from prometheus_client.core import REGISTRY, CollectorRegistry
+
+from . import monitoring
+from .models import PlanInterval
+from .test_rest import auth_resource_batch_path, auth_resource_path, auth_ticket_path, best_plan, plan_subscription_path
+
+
+@pytest.fixture
+def collector(db):
+    cache.delete(monitoring.STATS_KEY)
+    cache.delete(monitoring.LOCK_KEY)
+    collector = monitoring.ProfileStatsCollector()
+    registry = CollectorRegistry()
+    registry.register(collector)
+    yield lambda: generate_latest(registry).decode()
+    cache.delete(monitoring.STATS_KEY)
+
+
+@pytest.fixture
+def synchronous_refresh(monkeypatch):
+    """Run the background refreshes in the scraping thread, so that they see the test transaction."""
+    refreshes = []
+
+    def refresh_in_background():
+        refreshes.append(monitoring.refresh())
+    monkeypatch.setattr(monitoring, 'refresh_in_background', refresh_in_background)
+    return refreshes
+
+
+def test_aggregate(profile, best_plan):
+    profile.subscribed_plan = best_plan
+    profile.save()
+    PlanInterval.objects.create(profile=profile, plan=best_plan, duration=datetime.timedelta(days=30))
+    stats = monitoring.aggregate()
+    assert stats['profiles'] == 1
+    assert stats['plan_intervals'] == 1
+    assert stats['subscriptions'][best_plan.id] == 1
+    assert stats['subscriptions']['free'] == 0
+
+
+def test_first_scrape_has_no_values(collector, synchronous_refresh):
+    output = collector()
+    assert 'business_metrics_age_seconds +Inf' in output
+    assert 'profile_count' not in output
+    assert len(synchronous_refresh) == 1
+    assert 'profile_count' in collector()
+
+
+def test_scrapes_use_the_cache(collector, profile, synchronous_refresh, django_assert_num_queries):
+    monitoring.refresh()
+    with django_assert_num_queries(0):
+        output = collector()
+    assert 'profile_count_total 1.0' in output
+    assert not synchronous_refresh
+
+
+def test_stale_values_are_refreshed(collector, profile, synchronous_refresh, settings):
+    stats = monitoring.refresh()
+    stats['refreshed_at'] -= settings.METRICS_REFRESH_INTERVAL + 1
+    cache.set(monitoring.STATS_KEY, stats)
+    collector()
+    assert len(synchronous_refresh) == 1
+
+
+def test_refresh_in_background_is_locked(db, monkeypatch):
+    started = []
+    monkeypatch.setattr(monitoring.threading, 'Thread', lambda **kwargs: type('Thread', (), {
+        'start': lambda self: started.append(kwargs['target'])})())
+    cache.delete(monitoring.LOCK_KEY)
+    assert monitoring.refresh_in_background()
+    assert monitoring.refresh_in_background() is None
+    assert len(started) == 1
+    cache.delete(monitoring.LOCK_KEY)
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_auth_resource_outcomes(external_api_client, user, token, auth_resource_path, synchronous_refresh):
+    cache.clear()
+    outcomes = ['active', 'inactive', 'bad_request', 'unknown_user', 'invalid_api_key']
+    before = {outcome: sample('api_outcomes_total', view='auth_resource', outcome=outcome) for outcome in outcomes}
+    lookups = sample('auth_phase_seconds_count', phase='lookup')
+
+    external_api_client.post(auth_resource_path, {'user_id': user.id})
+    external_api_client.post(auth_resource_path, {'user_id': user.id})  # cached
+    user.is_active = False
+    user.save()
+    external_api_client.post(auth_resource_path, {'user_id': user.id})
+    external_api_client.post(auth_resource_path, {'auth': 'Foobar {}'.format(token)})
+    external_api_client.post(auth_resource_path, {'user_id': user.id + 1})
+    external_api_client.post(auth_resource_path, {'user_id': user.id}, HTTP_APISECRET='wrong')
+
+    increments = {outcome: sample('api_outcomes_total', view='auth_resource', outcome=outcome) - before[outcome]
+                  for outcome in outcomes}
+    assert increments == {'active': 2, 'inactive': 1, 'bad_request': 1, 'unknown_user': 1, 'invalid_api_key': 1}
+    assert sample('auth_phase_seconds_count', phase='lookup') - lookups == 3
+    for phase in monitoring.AUTH_PHASES:
+        assert sample('auth_phase_seconds_count', phase=phase) > 0
+
+
+def increments(view, outcomes, request):
+    before = {outcome: sample('api_outcomes_total', view=view, outcome=outcome) for outcome in outcomes}
+    request()
+    return {outcome: sample('api_outcomes_total', view=view, outcome=outcome) - before[outcome] for outcome in outcomes}
+
+
+def test_auth_ticket_outcomes(external_api_client, user, auth_ticket_path):
+    def request():
+        external_api_client.post(auth_ticket_path, {'user_id': user.id})
+        external_api_client.post(auth_ticket_path, {'user_id': user.id + 1})
+        external_api_client.post(auth_ticket_path, {})
+    assert increments('auth_ticket', ['active', 'unknown_user', 'bad_request'], request) == \
+        {'active': 1, 'unknown_user': 1, 'bad_request': 1}
+
+
+def test_auth_resource_batch_outcomes(external_api_client, user, token, auth_resource_batch_path):
+    def request():
+        external_api_client.post(auth_resource_batch_path, {
+            'auth': ['Token {}'.format(token), 'Token foobar', 'Foobar {}'.format(token)],
+            'user_id': [user.id, user.id + 1],
+        }, format='json')
+        external_api_client.post(auth_resource_batch_path, {}, format='json')
+    assert increments('auth_resource_batch', ['active', 'unknown_user', 'bad_request'], request) == \
+        {'active': 2, 'unknown_user': 2, 'bad_request': 2}
+
+
+def test_api_key_phase_only_for_auth_views(external_api_client, user, plan_subscription_path, auth_resource_path):
+    checks = sample('auth_phase_seconds_count', phase='api_key')
+    external_api_client.post(plan_subscription_path, {'user_email': user.email, 'plan': 'free'})
+    assert sample('auth_phase_seconds_count', phase='api_key') == checks
+    external_api_client.post(auth_resource_path, {'user_id': user.id})
+    assert sample('auth_phase_seconds_count', phase='api_key') == checks + 1
@@ -0,0 +1,130 @@
+from smtplib import SMTPException, SMTPRecipientsRefused
+
+import pytest
+
+from django.core import mail
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.db import transaction
+from django.utils import timezone
+
+from . import outbox
+from .models import QueuedMail
+
+
+@pytest.fixture
+def queued(db):
+    message = EmailMultiAlternatives('Subject', 'Body', 'noreply@example.com', ['to@example.com'],
+                                     cc=['cc@example.com'])
+    message.attach_alternative('<p>Body</p>', 'text/html')
+    return outbox.enqueue(message)
+
+
+def test_enqueue_does_not_send(queued):
+    assert not mail.outbox
+    assert not queued.sent_at
+
+
+def test_send_queued(queued):
+    assert outbox.send_queued() == 1
+    sent = mail.outbox.pop()
+    assert sent.subject == 'Subject'
+    assert sent.to == ['to@example.com']
+    assert sent.cc == ['cc@example.com']
+    assert sent.alternatives == [('<p>Body</p>', 'text/html')]
+    queued.refresh_from_db()
+    assert queued.sent_at
+    assert outbox.send_queued() == 0
+
+
+def test_html_only_message(db):
+    message = EmailMessage('Subject', '<p>Body</p>', 'noreply@example.com', ['to@example.com'])
+    message.content_subtype = 'html'
+    outbox.enqueue(message)
+    outbox.send_queued()
+    assert mail.outbox.pop().content_subtype == 'html'
+
+
+def test_send_queued_reuses_connection(db, mocker):
+    for i in range(3):
+        outbox.enqueue(EmailMessage('Subject %d' % i, 'Body', 'noreply@example.com', ['to@example.com']))
+    get_connection = mocker.spy(outbox, 'get_connection')
+    assert outbox.send_queued() == 3
+    assert get_connection.call_count == 1
+
+
+def test_send_queued_retry(queued, monkeypatch):
+    def explode(self):
+        raise SMTPException('Have you in fact got any cheese here at all? ')
+    monkeypatch.setattr(EmailMultiAlternatives, 'send', explode)
+    assert outbox.send_queued() == 0
+    queued.refresh_from_db()
+    assert queued.attempts == 1
+    assert queued.send_after > timezone.now()
+    assert 'cheese' in queued.last_error
+
+    # Not due again yet
+    monkeypatch.undo()
+    assert outbox.send_queued() == 0
+    QueuedMail.objects.update(send_after=timezone.now())
+    assert outbox.send_queued() == 1
+
+
+def test_send_queued_refused(queued, monkeypatch):
+    def refuse(self):
+        raise SMTPRecipientsRefused(self.to)
+    monkeypatch.setattr(EmailMultiAlternatives, 'send', refuse)
+    outbox.send_queued()
+    queued.refresh_from_db()
+    assert queued.attempts == outbox.MAX_ATTEMPTS
+
+    monkeypatch.undo()
+    QueuedMail.objects.update(send_after=timezone.now())
+    assert outbox.send_queued() == 0
+
+
+def test_claimed_mails_are_leased(queued, monkeypatch):
+    now = timezone.now()
+    claimed, = outbox.claim(10, now)
+    assert claimed.attempts == 1
+    # Sent outside of a transaction; another sender doesn't get it until the lease ends
+    assert outbox.claim(10, now) == []
+    queued.refresh_from_db()
+    assert (queued.send_after, queued.attempts) == (now + outbox.LEASE, 1)
+    assert outbox.claim(10, now + outbox.LEASE) == [queued]
+
+
+def test_send_outside_transaction(queued, monkeypatch):
+    # The test itself runs in a transaction; sending must not add a savepoint to it.
+    savepoints = len(transaction.get_connection().savepoint_ids)
+    sent_in = []
+
+    def send(self):
+        sent_in.append(len(transaction.get_connection().savepoint_ids))
+    monkeypatch.setattr(EmailMultiAlternatives, 'send', send)
+    assert outbox.send_queued() == 1
+    assert sent_in == [savepoints]
+
+
+def test_backoff():
+    assert outbox.backoff(1) == outbox.BASE_BACKOFF
+    assert outbox.backoff(2) == 2 * outbox.BASE_BACKOFF
+    assert outbox.backoff(100) == outbox.MAX_BACKOFF
+
+
+def test_send_queued_keeps_headers(db):
+    message = EmailMessage('Subject', 'Body', 'noreply@example.com', ['to@example.com'], bcc=['bcc@example.com'],
+                           reply_to=['support@example.com'], headers={'X-Qabel': 'yes'})
+    outbox.enqueue(message)
+    outbox.send_queued()
+    sent = mail.outbox.pop()
+    assert sent.bcc == ['bcc@example.com']
+    assert sent.reply_to == ['support@example.com']
+    assert sent.extra_headers == {'X-Qabel': 'yes'}
+
+
+def test_enqueue_rejects_attachments(db):
+    message = EmailMessage('Subject', 'Body', 'noreply@example.com', ['to@example.com'])
+    message.attach('invoice.txt', 'Spam, spam, spam, eggs and spam', 'text/plain')
+    with pytest.raises(ValueError):
+        outbox.enqueue(message)
+    assert not QueuedMail.objects.exists()
@@ -0,0 +1,120 @@
+import datetime
+import gzip
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from . import plan_log_archive, views
+from .models import PlanInterval, PlanLogArchiveSegment, ProfilePlanLog
+from .test_rest import best_plan
+
+LAST_YEAR = timezone.now() - datetime.timedelta(days=365)
+
+
+@pytest.fixture
+def archive_dir(settings, tmp_path):
+    settings.PLAN_LOG_ARCHIVE_DIR = str(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def old_entry(profile, best_plan):
+    interval = PlanInterval(profile=profile, plan=best_plan, duration=datetime.timedelta(days=30))
+    interval.save()
+    ProfilePlanLog.objects.log(profile=profile, action='add-interval', plan=best_plan, interval=interval)
+    ProfilePlanLog.objects.update(timestamp=LAST_YEAR)
+    return ProfilePlanLog.objects.get()
+
+
+def test_next_month():
+    december = timezone.make_aware(datetime.datetime(2016, 12, 1))
+    assert plan_log_archive.next_month(december) == timezone.make_aware(datetime.datetime(2017, 1, 1))
+
+
+def test_archive(archive_dir, old_entry, profile, best_plan):
+    ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+    assert plan_log_archive.archive(timezone.now()) == 1
+    assert ProfilePlanLog.objects.get().action == 'set-plan'
+
+    path, = archive_dir.glob('profileplanlog-*.jsonl.gz')
+    assert path.name == LAST_YEAR.strftime('profileplanlog-%Y-%m.jsonl.gz')
+    with gzip.open(str(path), 'rt') as file:
+        entry = json.loads(file.readline())
+    assert entry['id'] == old_entry.id
+    assert entry['interval_duration'] == '30 00:00:00'
+
+
+def test_archive_again(archive_dir, old_entry, profile, best_plan):
+    plan_log_archive.archive(timezone.now())
+    ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+    ProfilePlanLog.objects.update(timestamp=LAST_YEAR)
+    plan_log_archive.archive(timezone.now())
+    assert len(list(archive_dir.glob('profileplanlog-*.jsonl.gz'))) == 2
+    assert [entry.action for entry in plan_log_archive.archived_entries(profile.pk)] == ['set-plan', 'add-interval']
+
+
+def test_archived_entries(archive_dir, old_entry, profile, user):
+    plan_log_archive.archive(timezone.now())
+    entry, = plan_log_archive.archived_entries(profile.pk)
+    assert entry.id == old_entry.id
+    assert entry.timestamp == old_entry.timestamp
+    assert entry.plan == old_entry.plan
+    assert entry.interval.duration == datetime.timedelta(days=30)
+    assert not plan_log_archive.archived_entries(profile.pk + 1)
+
+
+def test_archived_entries_read_only_the_profile(archive_dir, old_entry, profile, django_user_model, best_plan):
+    other = django_user_model.objects.create_user('other').profile
+    ProfilePlanLog.objects.log(profile=other, action='set-plan', plan=best_plan)
+    ProfilePlanLog.objects.update(timestamp=LAST_YEAR)
+    assert plan_log_archive.archive(timezone.now()) == 2
+
+    segments = PlanLogArchiveSegment.objects.order_by('offset')
+    assert [(segment.profile_id, segment.entries) for segment in segments] == [(profile.pk, 1), (other.pk, 1)]
+    assert segments[0].month == plan_log_archive.month_start(LAST_YEAR).date()
+    # One gzip member per profile, the file as a whole stays readable
+    path, = archive_dir.glob('profileplanlog-*.jsonl.gz')
+    with gzip.open(str(path), 'rt') as file:
+        assert len(file.readlines()) == 2
+
+    entry, = plan_log_archive.archived_entries(other.pk)
+    assert entry.action == 'set-plan'
+    path.unlink()
+    # Profiles without archived months don't touch the archive files
+    assert plan_log_archive.archived_entries(other.pk + profile.pk) == []
+
+
+def test_archived_entries_stop_at_limit(archive_dir, old_entry, profile, best_plan):
+    ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan)
+    newer = ProfilePlanLog.objects.exclude(pk=old_entry.pk).get()
+    ProfilePlanLog.objects.filter(pk=newer.pk).update(timestamp=LAST_YEAR + datetime.timedelta(days=40))
+    plan_log_archive.archive(timezone.now())
+    older_file = archive_dir / LAST_YEAR.strftime('profileplanlog-%Y-%m.jsonl.gz')
+    older_file.unlink()
+
+    # The newest month fills the page, the older one isn't read
+    entry, = plan_log_archive.archived_entries(profile.pk, limit=1)
+    assert entry.id == newer.id
+    with pytest.raises(FileNotFoundError):
+        plan_log_archive.archived_entries(profile.pk, limit=2)
+    with pytest.raises(FileNotFoundError):
+        plan_log_archive.archived_entries(profile.pk, before=(entry.timestamp, entry.id), limit=1)
+
+
+def test_user_history(archive_dir, old_entry, user, rf):
+    plan_log_archive.archive(timezone.now())
+    request = rf.get('/account/history')
+    request.user = user
+    response = views.user_history(request)
+    event, = response.context_data['events']
+    assert event['description'] == 'Prepaid plan best plan of duration 30 days, 0:00:00 added'
+
+
+def test_command(archive_dir, old_entry):
+    out = StringIO()
+    call_command('archive_plan_log', before=timezone.now().date(), stdout=out)
+    assert 'Archived 1 plan log entries' in out.getvalue()
+    assert not ProfilePlanLog.objects.exists()
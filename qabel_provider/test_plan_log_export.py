@@ -0,0 +1,97 @@
+import csv
+import gzip
+import io
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+
+from . import plan_log_export
+from .models import ProfilePlanLog
+from .test_rest import best_plan, better_plan
+
+
+@pytest.fixture
+def plan_log_path():
+    return '/api/v0/internal/plan-log/'
+
+
+@pytest.fixture
+def entries(profile, best_plan, better_plan):
+    with ProfilePlanLog.objects.buffered():
+        ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=best_plan, origin='first')
+        ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=better_plan, origin='second')
+    return list(ProfilePlanLog.objects.order_by('id'))
+
+
+def test_ndjson(entries, profile):
+    lines = list(plan_log_export.export('ndjson'))
+    assert len(lines) == 2
+    first = json.loads(lines[0].decode())
+    assert first['user_id'] == profile.pk
+    assert first['plan_id'] == 'best_plan'
+    assert first['origin'] == 'first'
+
+
+def test_gzip_csv(entries):
+    data = gzip.decompress(b''.join(plan_log_export.gzip_csv(plan_log_export.entries(), chunk_rows=1)))
+    rows = list(csv.DictReader(io.StringIO(data.decode())))
+    assert [row['origin'] for row in rows] == ['first', 'second']
+    assert rows[0]['timestamp'] == entries[0].timestamp.isoformat()
+
+
+def test_filters(entries, better_plan):
+    assert [row['origin'] for row in plan_log_export.entries(plan=better_plan.id)] == ['second']
+    assert not list(plan_log_export.entries(action='add-interval'))
+    assert not list(plan_log_export.entries(since=timezone.now()))
+    assert len(list(plan_log_export.entries(until=timezone.now()))) == 2
+
+
+def test_api(external_api_client, plan_log_path, entries):
+    response = external_api_client.get(plan_log_path, {'plan': 'best_plan'})
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/x-ndjson'
+    lines = b''.join(response.streaming_content).splitlines()
+    assert [json.loads(line.decode())['origin'] for line in lines] == ['first']
+
+
+def test_api_csv(external_api_client, plan_log_path, entries):
+    response = external_api_client.get(plan_log_path, {'output': 'csv'})
+    assert response.status_code == 200
+    assert 'plan-log.csv.gz' in response['Content-Disposition']
+    data = gzip.decompress(b''.join(response.streaming_content)).decode()
+    assert len(data.splitlines()) == 3
+
+
+@pytest.mark.parametrize('params', ({'output': 'xml'}, {'since': 'yesterday'}, {'until': '2020-02-30T00:00:00'},
+                                    {'action': 'bogus'}))
+def test_api_bad_request(external_api_client, plan_log_path, params):
+    response = external_api_client.get(plan_log_path, params)
+    assert response.status_code == 400
+
+
+def test_api_protected(client, plan_log_path):
+    response = client.get(plan_log_path)
+    assert response.status_code == 403
+
+
+def test_command(entries, tmp_path):
+    output = tmp_path / 'export.ndjson'
+    call_command('export_plan_log', output=str(output), action='set-plan', stdout=StringIO())
+    assert len(output.read_bytes().splitlines()) == 2
+
+
+@pytest.mark.parametrize('since', ('yesterday', '2020-02-30T00:00:00'))
+def test_command_bad_timestamp(since):
+    with pytest.raises(CommandError):
+        call_command('export_plan_log', '--since', since, stdout=StringIO())
+
+
+def test_unknown_action():
+    # Raised right away, not once the export is streamed
+    with pytest.raises(ValueError):
+        plan_log_export.export('ndjson', action='bogus')
+    with pytest.raises(CommandError):
+        call_command('export_plan_log', '--action', 'bogus', stdout=StringIO())
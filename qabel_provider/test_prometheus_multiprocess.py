@@ -0,0 +1,47 @@
+import os
+
+import pytest
+from prometheus_client import values
+
+from . import monitoring, prometheus_multiprocess
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(prometheus_multiprocess.ENVIRONMENT_VARIABLE, str(tmp_path / 'metrics'))
+    prometheus_multiprocess.setup()
+    return tmp_path / 'metrics'
+
+
+def write_counter(pid, amount):
+    Value = values.MultiProcessValue(lambda: pid)
+    Value('counter', 'test_requests', 'test_requests_total', [], [], 'Test requests').inc(amount)
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.delenv(prometheus_multiprocess.ENVIRONMENT_VARIABLE, raising=False)
+    assert not prometheus_multiprocess.enabled()
+    prometheus_multiprocess.setup()
+
+
+def test_cleanup(metrics_dir, monkeypatch):
+    monkeypatch.setattr(prometheus_multiprocess, 'is_running', lambda pid: pid == 1)
+    for name in ('gauge_livesum_1.db', 'gauge_livesum_2.db', 'gauge_liveall_2.db', 'counter_2.db'):
+        (metrics_dir / name).touch()
+    assert prometheus_multiprocess.cleanup() == [2]
+    assert sorted(os.listdir(str(metrics_dir))) == ['counter_2.db', 'gauge_livesum_1.db']
+
+
+def test_is_running():
+    assert prometheus_multiprocess.is_running(os.getpid())
+
+
+def test_metrics_are_aggregated(client, db, metrics_dir, monkeypatch):
+    monkeypatch.setattr(monitoring, 'refresh_in_background', lambda: None)
+    write_counter(1, 2)
+    write_counter(2, 3)
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    content = response.content.decode()
+    assert 'test_requests_total 5.0' in content
+    assert 'business_metrics_age_seconds' in content
@@ -0,0 +1,102 @@
+from datetime import timedelta
+
+import pytest
+
+from allauth.account.models import EmailAddress
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import resolver
+from .models import PlanInterval, Profile, QueuedMail
+from .test_rest import auth_resource_path, best_plan, better_plan, call_auth_resource
+
+
+@pytest.fixture
+def intervals(profile, best_plan, better_plan):
+    expired = PlanInterval(profile=profile, plan=better_plan, duration=timedelta(days=1), state='expired',
+                           started_at=timezone.now() - timedelta(days=2))
+    expired.save()
+    in_use = PlanInterval(profile=profile, plan=best_plan, duration=timedelta(days=1))
+    in_use.save()
+    in_use.start()
+    pristine = PlanInterval(profile=profile, plan=better_plan, duration=timedelta(days=1))
+    pristine.save()
+    return in_use, pristine
+
+
+def test_resolve_query_budget(user, token, intervals, django_assert_num_queries):
+    with django_assert_num_queries(2):
+        resolved = resolver.resolve_one(token=token)
+    in_use, pristine = intervals
+    assert resolved.profile.user_id == user.id
+    assert resolved.token == token
+    assert resolved.interval == in_use
+    assert resolved.plan == in_use.plan
+    assert resolved.active
+
+
+def test_auth_resource_query_budget(call_auth_resource, intervals, django_assert_max_num_queries):
+    cache.clear()
+    with django_assert_max_num_queries(2):
+        response = call_auth_resource()
+    assert response.status_code == 200
+
+
+def test_resolve_starts_pristine_interval(user, profile, best_plan):
+    interval = PlanInterval(profile=profile, plan=best_plan, duration=timedelta(days=1))
+    interval.save()
+    resolved = resolver.resolve_one(user_id=user.id)
+    assert resolved.interval == interval
+    interval.refresh_from_db()
+    assert interval.state == 'in_use'
+
+
+def test_resolve_start_raced(user, profile, best_plan, monkeypatch):
+    # Another request starts the interval between our read and our conditional update.
+    raced = PlanInterval(profile=profile, plan=best_plan, duration=timedelta(days=1))
+    raced.save()
+
+    def lose_race(self):
+        PlanInterval.objects.filter(pk=self.pk).update(state='in_use', started_at=timezone.now(),
+                                                       expires_at=timezone.now() + self.duration)
+        return False
+
+    monkeypatch.setattr(PlanInterval, 'try_start', lose_race)
+    resolved = resolver.resolve_one(user_id=user.id)
+    assert resolved.interval == raced
+    assert resolved.plan == best_plan
+
+
+def test_resolve_expires_interval(user, intervals, monkeypatch):
+    in_use, pristine = intervals
+    into_the_future = timezone.now() + timedelta(days=1, minutes=1)
+    monkeypatch.setattr(timezone, 'now', lambda: into_the_future)
+    resolved = resolver.resolve_one(user_id=user.id)
+    assert resolved.interval == pristine
+    assert resolved.plan == pristine.plan
+    in_use.refresh_from_db()
+    assert in_use.state == 'expired'
+
+
+def test_resolve_unknown(db):
+    assert resolver.resolve_one(token='foobar') is None
+    assert resolver.resolve_one(user_id=1234) is None
+
+
+@pytest.mark.django_db(databases=['default', 'replica'])
+def test_confirmation_mail_state_is_written_to_the_primary(user, settings, mailoutbox):
+    profile = user.profile
+    profile.needs_confirmation_after = timezone.now() - timedelta(days=1)
+    profile.save()
+    # The replica has an (outdated) copy of the rows, but is not a mirror of the primary database.
+    User.objects.using('replica').bulk_create([user])
+    Profile.objects.using('replica').bulk_create([Profile.objects.get(pk=profile.pk)])
+    EmailAddress.objects.using('replica').bulk_create(EmailAddress.objects.filter(user=user))
+    settings.AUTH_READ_DATABASE = 'replica'
+
+    resolved = resolver.resolve_one(user_id=user.id)
+    assert not resolved.active
+    assert Profile.objects.get(pk=profile.pk).next_confirmation_mail is not None
+    assert Profile.objects.using('replica').get(pk=profile.pk).next_confirmation_mail is None
+    assert QueuedMail.objects.count() == 1
@@ -11,7 +11,8 @@ from django.db import DatabaseError
 from django.contrib.auth.models import User
 from allauth.account.models import EmailConfirmation, EmailAddress
 
-from .models import Plan, PlanInterval, ProfilePlanLog, Profile
+from .models import Plan, PlanInterval, ProfilePlanLog, Profile, QueuedMail
+from .tickets import key_from_secret, verify
 
 
 def loads(foo):
@@ -31,6 +32,16 @@ def auth_resource_path():
     return '/api/v0/internal/user/'
 
 
+@pytest.fixture
+def auth_resource_batch_path():
+    return '/api/v0/internal/user/batch/'
+
+
+@pytest.fixture
+def auth_ticket_path():
+    return '/api/v0/internal/user/ticket/'
+
+
 @pytest.fixture
 def register_on_behalf_path():
     return '/api/v0/internal/user/register/'
@@ -61,8 +72,9 @@ def test_register_user(api_client):
 
 
 @pytest.mark.django_db
-def test_register_user_with_invalid_mail(api_client, mocker):
+def test_register_user_with_invalid_mail(api_client, mocker, send_queued_mail):
     send_mail = mocker.patch('django.core.mail.backends.locmem.EmailBackend')
+    send_mail.return_value.send_messages.side_effect = SMTPRecipientsRefused(['test@ccccccc.de'])
     response = api_client.post('/api/v0/auth/registration/',
                                {'username': 'test_user',
                                 'email': 'test@ccccccc.de',
@@ -70,7 +82,9 @@ def test_register_user_with_invalid_mail(api_client, mocker):
                                 'password2': 'test1234'})
     assert response.status_code == 201
     assert User.objects.all().count() == 1
-    send_mail.assert_called_with(fail_silently=True)
+    assert not send_mail.called
+    assert send_queued_mail() == 0
+    assert send_mail.called
 
 
 @pytest.mark.django_db
@@ -215,6 +229,75 @@ def test_info_resource_unknown_user(external_api_client, user, auth_resource_pat
     assert data['error']
 
 
+def test_auth_resource_batch(external_api_client, auth_resource_batch_path, user, token):
+    other_user = User.objects.create_user('other_user', 'other@example.com', 'password')
+    other_user.is_active = False
+    other_user.save()
+    response = external_api_client.post(auth_resource_batch_path, {
+        'auth': ['Token {}'.format(token), 'Token foobar', 'Foobar {}'.format(token)],
+        'user_id': [user.id, other_user.id, other_user.id + 1],
+    }, format='json')
+    assert response.status_code == 200, response.json()
+    data = response.json()
+    plan = user.profile.plan
+    expected = {
+        'user_id': user.id,
+        'active': True,
+        'block_quota': plan.block_quota,
+        'monthly_traffic_quota': plan.monthly_traffic_quota,
+    }
+    assert data['auth'][0] == expected
+    assert data['auth'][1]['error'] == 'Invalid token'
+    assert data['auth'][2]['error'] == 'Invalid auth type'
+    assert data['user_id'][0] == expected
+    assert data['user_id'][1]['user_id'] == other_user.id
+    assert data['user_id'][1]['active'] is False
+    assert data['user_id'][2]['error'] == 'Invalid user ID'
+
+
+def test_auth_resource_batch_queries(external_api_client, auth_resource_batch_path, django_assert_max_num_queries):
+    users = [User.objects.create_user('user%d' % i, 'user%d@example.com' % i, 'password') for i in range(10)]
+    with django_assert_max_num_queries(2):
+        response = external_api_client.post(auth_resource_batch_path, {
+            'user_id': [user.id for user in users],
+        }, format='json')
+    assert response.status_code == 200, response.json()
+    assert [data['user_id'] for data in response.json()['user_id']] == [user.id for user in users]
+
+
+def test_auth_resource_batch_no_body(external_api_client, auth_resource_batch_path):
+    response = external_api_client.post(auth_resource_batch_path, {}, format='json')
+    assert response.status_code == 400
+
+
+def test_auth_ticket(external_api_client, auth_ticket_path, user, token, api_secret):
+    response = external_api_client.post(auth_ticket_path, {'auth': 'Token {}'.format(token)})
+    assert response.status_code == 200, response.json()
+    data = response.json()
+    claims = verify(data.pop('ticket'), key_from_secret(api_secret))
+    assert claims == data
+    assert data['user_id'] == user.id
+    assert data['active'] is True
+    assert data['expires'] > timezone.now().timestamp()
+
+
+def test_auth_ticket_short_lived_answer(external_api_client, auth_ticket_path, user, token):
+    user.profile.needs_confirmation_after = timezone.now() + timedelta(seconds=2)
+    user.profile.save()
+    response = external_api_client.post(auth_ticket_path, {'auth': 'Token {}'.format(token)})
+    assert response.status_code == 200
+    data = response.json()
+    assert data['active'] is True
+    assert 'ticket' not in data
+    assert 'expires' not in data
+
+
+def test_auth_ticket_unknown_user(external_api_client, auth_ticket_path, user):
+    response = external_api_client.post(auth_ticket_path, {'user_id': user.id + 1})
+    assert response.status_code == 404
+    assert response.json()['error']
+
+
 def test_auth_resource_no_body(external_api_client, auth_resource_path):
     response = external_api_client.post(auth_resource_path)
     assert response.status_code == 400
@@ -222,7 +305,8 @@ def test_auth_resource_no_body(external_api_client, auth_resource_path):
     assert data['error']
 
 
-def test_failed_auth_resource_after_7_days(external_api_client, user, token, auth_resource_path, write_mail):
+def test_failed_auth_resource_after_7_days(external_api_client, user, token, auth_resource_path, write_mail,
+                                           send_queued_mail):
     user.profile.needs_confirmation_after = timezone.now() - timedelta(days=7)
     user.profile.save()
     user.profile.refresh_from_db()
@@ -231,6 +315,8 @@ def test_failed_auth_resource_after_7_days(external_api_client, user, token, aut
     assert response.status_code == 200
     data = loads(response.content)
     assert data['active'] is False
+    assert not mail.outbox  # Only queued
+    send_queued_mail()
     assert len(mail.outbox) == 1
     assert mail.outbox[0].subject.startswith('[example.com]')
     assert 'English version below.' in mail.outbox[0].body
@@ -240,6 +326,7 @@ def test_failed_auth_resource_after_7_days(external_api_client, user, token, aut
     data = loads(response.content)
     assert data['active'] is False
     assert response.status_code == 200
+    send_queued_mail()
     assert len(mail.outbox) == 1
 
     # Check, that a new mail is send after 24 hours
@@ -248,6 +335,7 @@ def test_failed_auth_resource_after_7_days(external_api_client, user, token, aut
     user.profile.refresh_from_db()
     response = external_api_client.post(auth_resource_path, request_body)
     assert response.status_code == 200
+    send_queued_mail()
     assert len(mail.outbox) == 2
     write_mail('email-confirm-repeated', outbox_index=-1)
 
@@ -277,10 +365,10 @@ def test_confirmation_mail_race1(external_api_client, token, auth_resource_path,
 
 
 def test_confirmation_mail_rollback(external_api_client, token, auth_resource_path, monkeypatch, user_needing_confirmation):
-    # Mail sending explodes after updating the mail state; mail state must be restored to pristinity.
+    # Queueing the mail explodes after updating the mail state; mail state must be restored to pristinity.
 
     def explode(self):
-        raise SMTPException('Have you in fact got any cheese here at all? ')
+        raise RuntimeError('Have you in fact got any cheese here at all? ')
 
     monkeypatch.setattr(Profile, 'send_confirmation_mail', explode)
 
@@ -288,11 +376,9 @@ def test_confirmation_mail_rollback(external_api_client, token, auth_resource_pa
     original_state = profile.next_confirmation_mail
 
     request_body = {'auth': 'Token {}'.format(token)}
-    response = external_api_client.post(auth_resource_path, request_body)
-    assert response.status_code == 200
-    data = loads(response.content)
-    assert data['active'] is False
-    assert len(mail.outbox) == 0
+    with pytest.raises(RuntimeError):
+        external_api_client.post(auth_resource_path, request_body)
+    assert not QueuedMail.objects.exists()
 
     profile.refresh_from_db()
     rollback_state = profile.next_confirmation_mail
@@ -300,7 +386,7 @@ def test_confirmation_mail_rollback(external_api_client, token, auth_resource_pa
 
 
 @pytest.fixture
-def register_on_behalf_base(external_api_client, register_on_behalf_path, auth_resource_path):
+def register_on_behalf_base(external_api_client, register_on_behalf_path, auth_resource_path, send_queued_mail):
     def subtest():
         email = 'manfred@example.net'
         username = 'manfred'
@@ -326,6 +412,7 @@ def register_on_behalf_base(external_api_client, register_on_behalf_path, auth_r
         assert response.status_code == 200, data
         assert data['active']
 
+        send_queued_mail()
         return email, username
     return subtest
 
@@ -407,7 +494,7 @@ def test_register_on_behalf_email(api_client, register_on_behalf_base, write_mai
 
 
 @pytest.mark.django_db
-def test_register_on_behalf_email_cc(external_api_client, register_on_behalf_path, write_mail):
+def test_register_on_behalf_email_cc(external_api_client, register_on_behalf_path, write_mail, send_queued_mail):
     email = 'manfred@example.net'
     secondary_mail = 'mmueller@example.com'
     response = external_api_client.post(register_on_behalf_path, {
@@ -418,6 +505,7 @@ def test_register_on_behalf_email_cc(external_api_client, register_on_behalf_pat
     })
     data = response.json()
     assert response.status_code == 200, data
+    send_queued_mail()
 
     write_mail('register-on-behalf-with-cc')
     sent_mail = mail.outbox.pop()
@@ -426,7 +514,7 @@ def test_register_on_behalf_email_cc(external_api_client, register_on_behalf_pat
     assert secondary_mail in sent_mail.cc
 
 
-def test_register_on_behalf_no_username(external_api_client, register_on_behalf_path):
+def test_register_on_behalf_no_username(external_api_client, register_on_behalf_path, send_queued_mail):
     email = 'foo@example.net'
     response = external_api_client.post(register_on_behalf_path, {
         'email': email,
@@ -436,6 +524,7 @@ def test_register_on_behalf_no_username(external_api_client, register_on_behalf_
     assert response.status_code == 200, response.json()
     assert response.json()['status'] == 'Account created'
     assert User.objects.filter(email=email)
+    send_queued_mail()
     assert mail.outbox
 
 
@@ -452,9 +541,10 @@ def test_register_on_behalf_invalid_mail(external_api_client, register_on_behalf
     assert not mail.outbox
 
 
-def test_register_on_behalf_smtp_error(external_api_client, register_on_behalf_path, monkeypatch):
+def test_register_on_behalf_smtp_error(external_api_client, register_on_behalf_path, monkeypatch, send_queued_mail):
+    # SMTP errors do not affect the API, the mail stays queued for another attempt.
     def erroring_send(self):
-        raise SMTPRecipientsRefused(['foo@bar'])
+        raise SMTPException('Have you in fact got any cheese here at all? ')
     monkeypatch.setattr(mail.EmailMultiAlternatives, 'send', erroring_send)
     response = external_api_client.post(register_on_behalf_path, {
         'email': 'foo@example.com',
@@ -462,10 +552,14 @@ def test_register_on_behalf_smtp_error(external_api_client, register_on_behalf_p
         'newsletter': True,
         'language': 'Deutsch-mit-Umlauten',
     })
-    assert response.status_code == 400, response.json()
-    status = response.json()['status']
-    assert 'SMTP error' in status
-    assert not User.objects.filter(username='foo')
+    assert response.status_code == 200, response.json()
+    assert response.json()['status'] == 'Account created'
+    assert User.objects.filter(username='foo')
+    assert send_queued_mail() == 0
+    queued = QueuedMail.objects.get()
+    assert queued.attempts == 1
+    assert not queued.sent_at
+    assert 'cheese' in queued.last_error
 
 
 @pytest.fixture
@@ -511,6 +605,8 @@ def test_request_id_untrusted(capfd, api_client, patched_uuid):
 
 @pytest.fixture(params=[
     'auth_resource_path',
+    'auth_resource_batch_path',
+    'auth_ticket_path',
     'register_on_behalf_path',
     'plan_subscription_path',
     'plan_interval_path'])
@@ -560,13 +656,14 @@ def test_register_user_with_bad_password(api_client):
 
 
 @pytest.mark.django_db
-def test_confirm_email(api_client, token, write_mail):
+def test_confirm_email(api_client, token, write_mail, send_queued_mail):
     response = api_client.post('/api/v0/auth/registration/',
                                {'username': 'testtest',
                                 'email': 'test@example.com',
                                 'password1': 'foobar1234',
                                 'password2': 'foobar1234'})
     assert response.status_code == 201
+    send_queued_mail()
     assert len(mail.outbox) == 1
     write_mail('confirm')
     assert mail.outbox[0].subject.startswith('[example.com]')
@@ -582,15 +679,17 @@ def test_confirm_email(api_client, token, write_mail):
     assert user.profile.is_confirmed
 
 
-def test_confirm_invalid_email(token, mocker, user, external_api_client, auth_resource_path):
+def test_confirm_invalid_email(token, mocker, user, external_api_client, auth_resource_path, send_queued_mail):
     send_mail = mocker.patch('django.core.mail.backends.locmem.EmailBackend')
+    send_mail.return_value.send_messages.side_effect = SMTPRecipientsRefused([user.email])
     user.profile.needs_confirmation_after = timezone.now() - timedelta(days=7)
     user.profile.save()
     user.profile.refresh_from_db()
     request_body = {'auth': 'Token {}'.format(token)}
     response = external_api_client.post(auth_resource_path, request_body)
     assert response.status_code == 200
-    send_mail.assert_called_with(fail_silently=True)
+    assert send_queued_mail() == 0
+    assert send_mail.called
 
 
 def test_api_root(api_client):
@@ -655,7 +754,7 @@ def require_audit_log(user):
 @pytest.fixture
 def require_interval_state(user):
     def do_assert(*states):
-        intervals = PlanInterval.objects.filter(profile=user.profile)
+        intervals = PlanInterval.objects.filter(profile=user.profile).order_by('-id')
         assert intervals.count() == len(states)
         for interval, required_state in zip(intervals, states):
             assert interval.state == required_state
@@ -0,0 +1,38 @@
+import pytest
+
+from .tickets import InvalidTicket, issue, key_from_secret, verify
+
+ANSWER = {'user_id': 1, 'active': True, 'block_quota': 2, 'monthly_traffic_quota': 3}
+
+
+@pytest.fixture
+def key():
+    return key_from_secret('FOOBAR')
+
+
+def test_roundtrip(key):
+    ticket = issue(ANSWER, 60, key, now=1000)
+    assert verify(ticket, key, now=1059) == dict(ANSWER, expires=1060)
+
+
+def test_expired(key):
+    ticket = issue(ANSWER, 60, key, now=1000)
+    with pytest.raises(InvalidTicket):
+        verify(ticket, key, now=1060)
+
+
+def test_wrong_key(key):
+    ticket = issue(ANSWER, 60, key)
+    with pytest.raises(InvalidTicket):
+        verify(ticket, key_from_secret('BARFOO'))
+
+
+@pytest.mark.parametrize('mangle', (
+    lambda ticket: ticket.replace('.', ''),
+    lambda ticket: 'x' + ticket,
+    lambda ticket: ticket[:-2],
+))
+def test_tampered(key, mangle):
+    ticket = issue(ANSWER, 60, key)
+    with pytest.raises(InvalidTicket):
+        verify(mangle(ticket), key)
@@ -1,9 +1,10 @@
+import argparse
 
 from django.contrib.auth.models import User
 
 import pytest
 
-from .utils import elide, get_request_origin, gen_username
+from .utils import elide, get_request_origin, gen_username, parse_timestamp, timestamp_argument
 
 
 @pytest.mark.parametrize('text, length, output', (
@@ -54,3 +55,11 @@ def test_gen_username_too_long(db):
     too_long = 'abcdefghijklmnopqrstuvwxyz12345@xyz'
     assert len(too_long) > 30
     assert gen_username(too_long) != too_long
+
+
+@pytest.mark.parametrize('value', ('yesterday', '2020-02-30T00:00:00', ''))
+def test_parse_timestamp_invalid(value):
+    with pytest.raises(ValueError):
+        parse_timestamp(value)
+    with pytest.raises(argparse.ArgumentTypeError):
+        timestamp_argument(value)
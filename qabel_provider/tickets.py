@@ -0,0 +1,70 @@
+"""
+Signed, short-lived auth tickets.
+
+A ticket carries the answer of the auth resource (user_id, active, block_quota, monthly_traffic_quota) and its
+expiry, signed with HMAC-SHA256. Whoever knows the API secret (i.e. the block server) can verify a ticket locally
+and use the answer until it expires, instead of asking the auth resource for every request.
+
+This module only uses the standard library, so that it can be copied into other services as is::
+
+    key = key_from_secret(API_SECRET)
+    try:
+        answer = verify(ticket, key)
+    except InvalidTicket:
+        ...  # ask the auth resource
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+
+class InvalidTicket(ValueError):
+    pass
+
+
+def key_from_secret(api_secret):
+    """Derive the ticket signing key from the shared *api_secret*."""
+    return hashlib.sha256(b'qabel-auth-ticket:' + api_secret.encode()).digest()
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(payload, key):
+    return hmac.new(key, payload.encode(), hashlib.sha256).digest()
+
+
+def issue(answer, lifetime, key, now=None):
+    """Return a ticket for the dict *answer*, valid for *lifetime* seconds."""
+    now = time.time() if now is None else now
+    claims = dict(answer, expires=int(now + lifetime))
+    payload = _encode(json.dumps(claims, sort_keys=True, separators=(',', ':')).encode())
+    return payload + '.' + _encode(_sign(payload, key))
+
+
+def verify(ticket, key, now=None):
+    """
+    Return the claims of *ticket* (the answer and its *expires* timestamp).
+
+    Raise InvalidTicket if the ticket is malformed, not signed with *key* or expired.
+    """
+    try:
+        payload, signature = ticket.split('.')
+        signature = _decode(signature)
+    except (ValueError, TypeError):
+        raise InvalidTicket('Malformed ticket')
+    if not hmac.compare_digest(signature, _sign(payload, key)):
+        raise InvalidTicket('Invalid signature')
+    claims = json.loads(_decode(payload).decode())
+    now = time.time() if now is None else now
+    if claims['expires'] <= now:
+        raise InvalidTicket('Expired ticket')
+    return claims
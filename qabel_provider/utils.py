@@ -1,5 +1,7 @@
+import argparse
 import os
 
+from django.utils.dateparse import parse_datetime
 from django.utils.text import Truncator
 from django.contrib.auth.models import User
 
@@ -46,3 +48,20 @@ def gen_username(email):
         return os.urandom(max_length // 2).hex()
 
     return username
+
+
+def parse_timestamp(value):
+    """Return the ISO 8601 timestamp *value* as a datetime. Raise ValueError if it is malformed or invalid."""
+    # parse_datetime returns None for malformed values, but raises ValueError for impossible dates like 2020-02-30.
+    timestamp = parse_datetime(value)
+    if timestamp is None:
+        raise ValueError('Malformed timestamp %r' % value)
+    return timestamp
+
+
+def timestamp_argument(value):
+    """argparse type of ISO 8601 timestamps (see parse_timestamp)."""
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not a valid ISO 8601 timestamp' % value)
@@ -1,10 +1,12 @@
+import collections
 import functools
 import hashlib
 import hmac
 import logging
 import os
-from smtplib import SMTPException
+import time
 
+import prometheus_client
 from allauth.account.models import EmailAddress
 from django import forms
 from django.conf import settings
@@ -15,21 +17,26 @@ from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.mail import EmailMultiAlternatives
 from django.db import transaction
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.template import loader
 from django.template.response import TemplateResponse as render
 from django.utils.translation import ugettext_lazy as _
 from log_request_id import local as request_local
 from rest_auth.registration.views import RegisterView
-from rest_framework.authtoken.models import Token
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
+from . import auth_cache, changes, history, monitoring, plan_log_export, resolver, tickets
 from .block import get_block_quota_of_user
+from .monitoring import count_outcome, phase_timer
 from .models import ProfilePlanLog
-from .serializers import UserSerializer, PlanSubscriptionSerializer, PlanIntervalSerializer, RegisterOnBehalfSerializer
-from .utils import get_request_origin, gen_username
+from .outbox import enqueue
+from .serializers import UserSerializer, PlanSubscriptionSerializer, PlanIntervalSerializer, RegisterOnBehalfSerializer, \
+    AuthBatchSerializer
+from .utils import get_request_origin, gen_username, parse_timestamp
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +61,11 @@ def hashed_api_secret():
     return hashlib.sha512(settings.API_SECRET.encode()).digest()
 
 
+@functools.lru_cache()
+def ticket_key():
+    return tickets.key_from_secret(settings.API_SECRET)
+
+
 def check_api_key(request):
     api_key = request.META.get('HTTP_APISECRET', '')
     # Avoid leaking length of the APISECRET via comparison timing.
@@ -66,10 +78,22 @@ def api_key_error():
     return Response(status=403, data={'error': 'Invalid API key'})
 
 
+# Views answering the auth resource, whose API key check is an auth phase (see monitoring.AUTH_PHASES)
+AUTH_VIEWS = ('auth_resource', 'auth_ticket', 'auth_resource_batch')
+
+
 def require_api_key(view):
+    timed = view.__name__ in AUTH_VIEWS
+
     @functools.wraps(view)
     def view_wrapper(request, format=None):
-        if not check_api_key(request):
+        if timed:
+            with phase_timer('api_key'):
+                valid = check_api_key(request)
+        else:
+            valid = check_api_key(request)
+        if not valid:
+            count_outcome(view.__name__, 'invalid_api_key')
             return api_key_error()
         # Request authorized by API key, so imbue our logs with X-Request-ID
         request_id = request.META.get('HTTP_X_REQUEST_ID')
@@ -80,6 +104,38 @@ def require_api_key(view):
     return view_wrapper
 
 
+def identify_user(data):
+    """
+    Return ``(token, user_id, None)`` for the user identification in the auth resource payload *data*, with either
+    *token* or *user_id* set, or ``(None, None, error_response)`` if it is missing or malformed.
+    """
+    if 'auth' in data and 'user_id' in data:
+        return None, None, Response(status=400, data={'error': 'Pass *either* an auth token *or* an user ID'})
+    elif 'auth' in data:
+        user_auth = data['auth']
+        try:
+            auth_type, token = user_auth.split()
+            if auth_type != 'Token':
+                raise ValueError()
+        except ValueError:
+            return None, None, Response(status=400, data={'error': 'Invalid auth type'})
+        return token, None, None
+    elif 'user_id' in data:
+        try:
+            user_id = int(data['user_id'])
+        except (KeyError, ValueError):
+            return None, None, Response(status=400, data={'error': 'Malformed user ID'})
+        return None, user_id, None
+    else:
+        return None, None, Response(status=400, data={'error': 'No user identification supplied'})
+
+
+def unknown_user_error(token):
+    if token is not None:
+        return Response(status=404, data={'error': 'Invalid token'})
+    return Response(status=404, data={'error': 'Invalid user ID'})
+
+
 @api_view(('POST',))
 @require_api_key
 def auth_resource(request, format=None):
@@ -98,41 +154,162 @@ def auth_resource(request, format=None):
 
     :return: HttpResponseBadRequest|HttpResponse(status=204)|HttpResponse(status=403)|HttpResponse(status=404)
     """
-    if 'auth' in request.data and 'user_id' in request.data:
-        return Response(status=400, data={'error': 'Pass *either* an auth token *or* an user ID'})
-    elif 'auth' in request.data:
-        user_auth = request.data['auth']
+    token, user_id, error = identify_user(request.data)
+    if error:
+        count_outcome('auth_resource', 'bad_request')
+        return error
+    with phase_timer('cache'):
+        cached = auth_cache.lookup(token=token, user_id=user_id)
+    if cached is not None:
+        count_outcome('auth_resource', 'active' if cached['active'] else 'inactive')
+        return Response(cached)
+    resolved = resolver.resolve_one(token=token, user_id=user_id)
+    if not resolved:
+        count_outcome('auth_resource', 'unknown_user')
+        return unknown_user_error(token)
+
+    logger.debug('Auth resource called: user={}'.format(resolved.profile.user))
+    with phase_timer('cache'):
+        auth_cache.store(resolved)
+    count_outcome('auth_resource', 'active' if resolved.active else 'inactive')
+    return Response(resolved.data)
+
+
+@api_view(('POST',))
+@require_api_key
+def auth_ticket(request, format=None):
+    """
+    Issue a signed auth ticket, see tickets.py.
+
+    Takes the same payload as the auth resource and returns the same answer, with the *ticket* and its *expires*
+    timestamp added. The ticket never outlives the answer; it expires after AUTH_TICKET_LIFETIME seconds, or earlier
+    if the plan interval in use expires or the confirmation period ends. If that is less than AUTH_TICKET_MIN_LIFETIME
+    seconds away, the answer is returned without a ticket.
+    """
+    token, user_id, error = identify_user(request.data)
+    if error:
+        count_outcome('auth_ticket', 'bad_request')
+        return error
+    resolved = resolver.resolve_one(token=token, user_id=user_id)
+    if not resolved:
+        count_outcome('auth_ticket', 'unknown_user')
+        return unknown_user_error(token)
+
+    with phase_timer('cache'):
+        auth_cache.store(resolved)
+    count_outcome('auth_ticket', 'active' if resolved.active else 'inactive')
+    now = time.time()
+    lifetime = auth_cache.timeout_for(resolved.profile, resolved.interval, settings.AUTH_TICKET_LIFETIME)
+    if lifetime is None or lifetime < settings.AUTH_TICKET_MIN_LIFETIME:
+        # The ticket would expire before the block server could make use of it.
+        return Response(resolved.data)
+    ticket = tickets.issue(resolved.data, lifetime, ticket_key(), now=now)
+    return Response(dict(resolved.data, ticket=ticket, expires=int(now + lifetime)))
+
+
+@api_view(('POST',))
+@require_api_key
+def auth_resource_batch(request, format=None):
+    """
+    Batch variant of the auth resource, for the block server to authorize many users at once.
+
+    Payload layout::
+
+        {
+            'auth': [STR (e.g. 'Token abc'), ...],
+            'user_id': [INT, ...],
+        }
+
+    Either list may be omitted. The response contains the same lists, where each element is replaced by the
+    answer auth_resource would give for it, or by an object with an *error* key.
+    """
+    serializer = AuthBatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        count_outcome('auth_resource_batch', 'bad_request')
+        raise ValidationError(serializer.errors)
+    batch = serializer.save()
+
+    tokens = {}
+    for user_auth in batch.auth:
         try:
             auth_type, token = user_auth.split()
             if auth_type != 'Token':
                 raise ValueError()
         except ValueError:
-            return Response(status=400, data={'error': 'Invalid auth type'})
-        try:
-            user = Token.objects.get(key=token).user
-        except Token.DoesNotExist:
-            return Response(status=404, data={'error': 'Invalid token'})
-    elif 'user_id' in request.data:
-        try:
-            user_id = int(request.data['user_id'])
-        except (KeyError, ValueError):
-            return Response(status=400, data={'error': 'Malformed user ID'})
-        try:
-            user = User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return Response(status=404, data={'error': 'Invalid user ID'})
-    else:
-        return Response(status=400, data={'error': 'No user identification supplied'})
+            continue
+        tokens[user_auth] = token
+
+    with phase_timer('cache'):
+        by_token, by_user_id = auth_cache.lookup_many(tokens=tokens.values(), user_ids=batch.user_id)
+    missing_tokens = set(tokens.values()) - set(by_token)
+    missing_user_ids = set(batch.user_id) - set(by_user_id)
+    resolved_answers = resolver.resolve(tokens=missing_tokens, user_ids=missing_user_ids)
+    for resolved in resolved_answers:
+        data = resolved.data
+        if resolved.token is not None:
+            by_token[resolved.token] = data
+        by_user_id[resolved.profile.user_id] = data
+    with phase_timer('cache'):
+        auth_cache.store_many(resolved_answers)
+
+    def answer_auth(user_auth):
+        if user_auth not in tokens:
+            return {'error': 'Invalid auth type'}
+        return by_token.get(tokens[user_auth], {'error': 'Invalid token'})
+
+    answers = {
+        'auth': [answer_auth(user_auth) for user_auth in batch.auth],
+        'user_id': [by_user_id.get(user_id, {'error': 'Invalid user ID'}) for user_id in batch.user_id],
+    }
+    # One outcome per answer of the batch
+    outcomes = collections.Counter()
+    for answer in answers['auth'] + answers['user_id']:
+        if 'error' not in answer:
+            outcomes['active' if answer['active'] else 'inactive'] += 1
+        elif answer['error'] == 'Invalid auth type':
+            outcomes['bad_request'] += 1
+        else:
+            outcomes['unknown_user'] += 1
+    for outcome, count in outcomes.items():
+        count_outcome('auth_resource_batch', outcome, count)
+    return Response(answers)
 
-    logger.debug('Auth resource called: user={}'.format(user))
-    is_disabled = user.profile.check_confirmation_and_send_mail()
-    profile = user.profile
-    profile.use_plan()
+
+@api_view(('GET',))
+@require_api_key
+def auth_changes(request, format=None):
+    """
+    Change feed of the auth resource, see changes.py.
+
+    Returns the changes after the cursor *since* (default: from the beginning) in order, at most *limit* (default
+    and maximum: 1000) of them::
+
+        {
+            'changes': [
+                {'cursor': STR, 'timestamp': STR, 'kind': STR, 'user_id': INT|null, 'plan': STR},
+                ...
+            ],
+            'cursor': STR (pass as *since* for the next call),
+        }
+
+    Changes of transactions that may still be followed by (older) running ones are held back, see changes.py.
+    Changes are kept for CHANGE_FEED_RETENTION days; a consumer that falls further behind must refresh all answers.
+    """
+    try:
+        since = changes.parse_cursor(request.query_params.get('since', '0-0'))
+        limit = min(int(request.query_params.get('limit', 1000)), 1000)
+    except ValueError:
+        return Response(status=400, data={'error': 'Malformed cursor or limit'})
+    data = [{
+        'cursor': changes.format_cursor((change.txid, change.id)),
+        'timestamp': change.timestamp,
+        'kind': change.kind,
+        'user_id': change.user_id,
+        'plan': change.plan_id,
+    } for change in changes.feed(since, limit)]
     return Response({
-        'user_id': user.id,
-        'active': (not is_disabled),
-        'block_quota': profile.plan.block_quota,
-        'monthly_traffic_quota': profile.plan.monthly_traffic_quota,
+        'changes': data,
+        'cursor': data[-1]['cursor'] if data else changes.format_cursor(since),
     })
 
 
@@ -140,7 +317,7 @@ class PasswordSetForm(PasswordResetForm):
     def send_mail(self, subject_template_name, email_template_name,
                   context, from_email, to_email, html_email_template_name=None):
         """
-        Sends a django.core.mail.EmailMultiAlternatives to `to_email`.
+        Queues a django.core.mail.EmailMultiAlternatives to `to_email` in the outbox.
         """
         cc_emails = context.pop('cc_emails')
         subject = loader.render_to_string(subject_template_name, context)
@@ -153,7 +330,7 @@ class PasswordSetForm(PasswordResetForm):
             html_email = loader.render_to_string(html_email_template_name, context)
             email_message.attach_alternative(html_email, 'text/html')
 
-        email_message.send()
+        enqueue(email_message)
 
     def save(self, cc_emails, **kwargs):
         # Judica me, Deus, et discerne causam meam de gente non sancta: ab homine iniquo et doloso erue me.
@@ -169,54 +346,81 @@ def register_on_behalf(request, format=None):
     serializer.is_valid(True)
     userdata = serializer.save()
 
-    try:
-        with transaction.atomic():
-            if User.objects.filter(email=userdata.email).count():
-                return Response({'status': 'Account exists'})
-
-            username = gen_username(userdata.email)
-
-            # We set a very long, random password because PasswordResetForm requires a usable password
-            # (to avoid having disabled-by-staff users re-enable their accounts via a passwort reset).
-            password = os.urandom(64).hex()
-            user = User.objects.create_user(username,
-                                            email=userdata.email,
-                                            password=password,
-                                            first_name=userdata.first_name,
-                                            last_name=userdata.last_name)
-            EmailAddress.objects.create(user=user, email=userdata.email,
-                                        primary=True, verified=True)
-            for email in userdata.secondary_emails:
-                EmailAddress.objects.create(user=user, email=email,
-                                            primary=False, verified=True)
-            user.profile.created_on_behalf = True
-            user.profile.save()
-
-            password_form = PasswordSetForm(data={'email': userdata.email})
-            if not password_form.is_valid():
-                # Should not be possible to hit, unless drf3 and django use different email validators w/ different accepting sets
-                logger.error('register_on_behalf failed, password reset form with validated email is invalid?! '
-                             'Errors are: %r', password_form.errors)
-                return Response({'status': 'Registration failed.'}, status=500)
-
-            password_form.save(
-                cc_emails=userdata.secondary_emails,
-                request=request,
-                use_https=request.is_secure(),
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                subject_template_name='registration/account_created_subject.txt',
-                email_template_name='registration/account_created_email.txt',
-                html_email_template_name='registration/account_created_email.html'
-            )
-    except SMTPException as smtp_exception:
-        # zodb has a much, much nicer design here. You can just call doom() inside a transaction, trying to commit it
-        # will fail (with an exception). Leaving the scope does not. Intuitive, correct, avoids huge exception handlers.
-        logger.exception('register_on_behalf failed while sending mail')
-        return Response({'status': 'Registration failed. SMTP error: %s' % smtp_exception}, status=400)
+    with transaction.atomic():
+        if User.objects.filter(email=userdata.email).count():
+            return Response({'status': 'Account exists'})
+
+        username = gen_username(userdata.email)
+
+        # We set a very long, random password because PasswordResetForm requires a usable password
+        # (to avoid having disabled-by-staff users re-enable their accounts via a passwort reset).
+        password = os.urandom(64).hex()
+        user = User.objects.create_user(username,
+                                        email=userdata.email,
+                                        password=password,
+                                        first_name=userdata.first_name,
+                                        last_name=userdata.last_name)
+        EmailAddress.objects.create(user=user, email=userdata.email,
+                                    primary=True, verified=True)
+        for email in userdata.secondary_emails:
+            EmailAddress.objects.create(user=user, email=email,
+                                        primary=False, verified=True)
+        user.profile.created_on_behalf = True
+        user.profile.save()
+
+        password_form = PasswordSetForm(data={'email': userdata.email})
+        if not password_form.is_valid():
+            # Should not be possible to hit, unless drf3 and django use different email validators w/ different accepting sets
+            logger.error('register_on_behalf failed, password reset form with validated email is invalid?! '
+                         'Errors are: %r', password_form.errors)
+            return Response({'status': 'Registration failed.'}, status=500)
+
+        password_form.save(
+            cc_emails=userdata.secondary_emails,
+            request=request,
+            use_https=request.is_secure(),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            subject_template_name='registration/account_created_subject.txt',
+            email_template_name='registration/account_created_email.txt',
+            html_email_template_name='registration/account_created_email.html'
+        )
 
     return Response({'status': 'Account created'})
 
 
+@api_view(('GET',))
+@require_api_key
+def plan_log(request, format=None):
+    """
+    Stream the plan log (see plan_log_export.py), oldest entries first.
+
+    Query parameters (all optional):
+
+    - *since*, *until*: ISO 8601 timestamps limiting the time range [since, until)
+    - *plan*, *action*: only entries of this plan or action
+    - *output*: ``ndjson`` (default) or ``csv`` (gzip compressed)
+
+    API authentication required.
+    """
+    params = request.query_params
+    output = params.get('output', 'ndjson')
+    if output not in plan_log_export.FORMATS:
+        return Response(status=400, data={'error': 'Unknown output format, use one of %s' % ', '.join(plan_log_export.FORMATS)})
+    filters = {'plan': params.get('plan'), 'action': params.get('action')}
+    if filters['action'] and filters['action'] not in plan_log_export.ACTIONS:
+        return Response(status=400, data={'error': 'Unknown action, use one of %s' % ', '.join(plan_log_export.ACTIONS)})
+    for name in ('since', 'until'):
+        if name in params:
+            try:
+                filters[name] = parse_timestamp(params[name])
+            except ValueError:
+                return Response(status=400, data={'error': 'Malformed timestamp %r' % name})
+    response = StreamingHttpResponse(plan_log_export.export(output, **filters),
+                                     content_type=plan_log_export.CONTENT_TYPES[output])
+    response['Content-Disposition'] = 'attachment; filename="plan-log.%s"' % plan_log_export.FILE_EXTENSIONS[output]
+    return response
+
+
 @api_view(('POST',))
 @require_api_key
 def plan_subscription(request, format=None):
@@ -236,14 +440,10 @@ def plan_subscription(request, format=None):
     serializer.is_valid(True)
     profile, plan = serializer.save()
 
-    audit_log = ProfilePlanLog(profile=profile,
-                               action='set-plan', plan=plan,
-                               origin=get_request_origin(request))
-
-    with transaction.atomic():
+    with ProfilePlanLog.objects.buffered():
         profile.subscribed_plan = plan
         profile.save()
-        audit_log.save()
+        ProfilePlanLog.objects.log(profile=profile, action='set-plan', plan=plan, origin=get_request_origin(request))
 
     return Response()
 
@@ -268,13 +468,10 @@ def plan_add_interval(request, format=None):
     serializer.is_valid(True)
     plan_interval = serializer.save()
 
-    audit_log = ProfilePlanLog(profile=plan_interval.profile,
-                               action='add-interval', interval=plan_interval, plan=plan_interval.plan,
-                               origin=get_request_origin(request))
-
-    with transaction.atomic():
+    with ProfilePlanLog.objects.buffered():
         plan_interval.save()
-        audit_log.save()
+        ProfilePlanLog.objects.log(profile=plan_interval.profile, action='add-interval', interval=plan_interval,
+                                   plan=plan_interval.plan, origin=get_request_origin(request))
 
     return Response()
 
@@ -353,26 +550,19 @@ def change_user_profile(request):
     })
 
 
-event_describers = {
-    'start-interval': _('Started using prepaid plan {.plan}').format,
-    'expired-interval': _('Prepaid plan {.plan} expired').format,
-    'add-interval': _('Prepaid plan {.plan} of duration {.interval.duration} added').format,
-    'set-plan': _('Subscribed to {.plan}').format,
-}
-
-
 @login_required
 def user_history(request):
-    user = request.user
-    profile = user.profile
-
-    events = []
-    for event in ProfilePlanLog.objects.filter(profile=profile):
-        events.append(event_describers[event.action](event))
-
+    profile = request.user.profile
+    position = None
+    if 'before' in request.GET:
+        position = history.parse_cursor(request.GET['before'])
+        if position is None:
+            return HttpResponseBadRequest(_('Malformed page cursor'))
+    page = history.page(profile.pk, position)
     return render(request, 'accounts/history.html', {
         'profile': profile,
-        'events': events,
+        'events': page['events'],
+        'next_page': page['next_page'],
     })
 
 
@@ -384,3 +574,9 @@ def user_login(request, **kwargs):
 
 def user_mail_confirmed(request):
     return render(request, 'accounts/confirmed.html')
+
+
+def metrics(request):
+    """Export the Prometheus metrics, of all workers in multiprocess mode (see monitoring.registry)."""
+    return HttpResponse(prometheus_client.generate_latest(monitoring.registry()),
+                        content_type=prometheus_client.CONTENT_TYPE_LATEST)